@@ -1,26 +1,37 @@
 """Flask API for crdtsign functionality."""
 
-import hashlib
+import json
+import mimetypes
 import os
 import signal
 
 # import tempfile
-from asyncio import sleep
 from datetime import datetime, timezone
 from pathlib import Path
+from typing import Optional
 
 import arrow
 from hypercorn import Config
 from hypercorn.asyncio import serve
 from loguru import logger
-from quart import Quart, jsonify, render_template, request
-from quart.helpers import send_from_directory
+from quart import Quart, Response, jsonify, render_template, request
 from werkzeug.utils import secure_filename
 
-from crdtsign.sign import get_file_hash, is_verified_signature, load_keypair, load_public_key, new_keypair, sign
+from crdtsign.sign import (
+    get_file_hash_async,
+    is_verified_signature,
+    iter_file_chunks,
+    load_keypair,
+    load_public_key,
+    new_keypair,
+    sign_stream_async,
+)
 from crdtsign.storage import FileSignatureStorage, UserStorage
 from crdtsign.user import User
 from crdtsign.utils.data_retention import get_time_until_expiration
+from crdtsign.utils.download import FileRangeBody
+from crdtsign.utils.executor import shutdown_executors
+from crdtsign.validation import VerificationCache, validate_signatures
 
 # Initialize app
 app = Quart(
@@ -52,6 +63,11 @@ user_storage = UserStorage(
     client_id=user.user_id, host="0.0.0.0", port=8765, from_file=True if Path(".storage/users.bin").exists() else False
 )
 
+# Parsed public keys and verification outcomes, invalidated as users and signatures change
+verification_cache = VerificationCache(user_storage.get_user_public_key)
+file_storage.files_map.observe_deep(verification_cache.on_files_change)
+user_storage.users_map.observe(verification_cache.on_users_change)
+
 
 @app.route("/", methods=["GET", "POST"])
 async def index():
@@ -61,8 +77,6 @@ async def index():
     """
     global user
 
-    await file_storage.data_retention_routine()
-
     # Handle username registration if submitted
     if request.method == "POST":
         form = await request.form
@@ -94,24 +108,61 @@ async def index():
 
 @app.route("/api/signatures", methods=["GET"])
 async def get_signatures():
-    """Get all signatures."""
-    signatures = file_storage.get_signatures()
-    await file_storage.handle_files_deserialization()
-    return jsonify({"signatures": signatures})
+    """Get all signatures.
+
+    The list is served from a cached serialization, with an ETag changing along with the
+    document, so that polling clients sending `If-None-Match` get a 304 until something changes.
+    """
+    etag, body = file_storage.get_signatures_listing()
+    response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return await response.make_conditional(request)
+
+
+@app.route("/api/signatures/changes", methods=["GET"])
+async def get_signature_changes():
+    """Get the signatures added, changed or removed since the token passed as `since`.
+
+    The response holds the next token to pass; without a valid token, the full list is
+    returned with `reset` set.
+    """
+    changes = file_storage.get_signature_changes(request.args.get("since"))
+    response = jsonify(changes)
+    response.cache_control.no_store = True
+    return response
+
+
+@app.route("/api/materialization", methods=["GET"])
+async def get_materialization_progress():
+    """Get the progress of the files being written to disk as their signatures arrive."""
+    return jsonify(file_storage.materializer.progress)
 
 
 @app.route("/api/signatures/<file_id>", methods=["GET"])
 async def get_signature(file_id):
     """Get a specific signature by its unique ID."""
-    signatures = file_storage.get_signatures()
-    for sig in signatures:
-        if sig["id"] == file_id:
-            print(sig)
-            # sig["time_to_expiration"] = get_time_until_expiration(sig["expiration_date"])
-            if "flag_data_retention" in sig:
-                sig["time_to_data_retention"] = get_time_until_expiration(sig["data_retention_new_exp_date"])
-            return jsonify({"signature": sig})
-    return jsonify({"error": "Signature not found"}), 404
+    sig = file_storage.get_signature(file_id)
+    if sig is None:
+        return jsonify({"error": "Signature not found"}), 404
+
+    # sig["time_to_expiration"] = get_time_until_expiration(sig["expiration_date"])
+    if "flag_data_retention" in sig:
+        sig["time_to_data_retention"] = get_time_until_expiration(sig["data_retention_new_exp_date"])
+    return jsonify({"signature": sig})
+
+
+def parse_expiration_date(expiration_str: Optional[str]) -> Optional[datetime]:
+    """Parse the expiration date submitted with a signing request, None if missing or invalid."""
+    if not expiration_str:
+        return None
+    try:
+        # Parse the datetime-local input format (YYYY-MM-DDThh:mm)
+        return datetime.fromisoformat(expiration_str).astimezone(datetime.now().tzinfo)
+    except ValueError as e:
+        # If parsing fails, log the error and ignore the expiration date
+        print(f"Error parsing expiration date: {e}")
+        return None
 
 
 @app.route("/api/signatures", methods=["POST"])
@@ -129,36 +180,26 @@ async def sign_file():
     user_id = user.user_id
     username = user.username
 
-    # Save a duplicate of the uploaded file in (temporary) storage
     filename = secure_filename(file.filename)
     file_path = Path(app.config["UPLOAD_FOLDER"]) / user_id
     os.makedirs(file_path, exist_ok=True)
-    await file.save(file_path / filename)
-
-    # Small sleep window to ensure correct file reading
-    await sleep(0.2)
 
     # Get or generate keypair
     private_key, public_key = load_keypair()
 
-    # Sign the file
-    signature = sign(file_path / filename, private_key)
+    # Save a duplicate of the uploaded file in (temporary) storage while hashing,
+    # signing and serializing it in the same pass
+    file_hash, signature, serialized_file = await sign_stream_async(
+        iter_file_chunks(file.stream),
+        private_key,
+        to_file=file_path / filename,
+        serialize_chunk=file_storage.serialize_chunk,
+    )
     sig_date = datetime.now().astimezone(datetime.now().tzinfo)
 
-    # Hash the file content
-    file_hash = get_file_hash(file_path / filename)
     # Handle expiration date if provided
     form = await request.form
-    expiration_date = None
-    expiration_str = form.get("expiration_date")
-    if expiration_str:
-        try:
-            # Parse the datetime-local input format (YYYY-MM-DDThh:mm)
-            expiration_date = datetime.fromisoformat(expiration_str).astimezone(datetime.now().tzinfo)
-        except ValueError as e:
-            # If parsing fails, log the error and ignore the expiration date
-            print(f"Error parsing expiration date: {e}")
-            pass
+    expiration_date = parse_expiration_date(form.get("expiration_date"))
 
     await file_storage.add_file_signature(
         file_name=filename,
@@ -169,6 +210,7 @@ async def sign_file():
         signed_on=sig_date,
         expiration_date=expiration_date,
         persist=True,
+        serialized_file=serialized_file,
     )
 
     return jsonify(
@@ -181,22 +223,133 @@ async def sign_file():
     )
 
 
+@app.route("/api/signatures/batch", methods=["POST"])
+async def sign_files_batch():
+    """Sign several files uploaded in a single multipart request and store their signatures.
+
+    The signatures are added to the storage in a single transaction, so that the whole
+    batch results in one sync update and one write of the persisted state. A file which
+    cannot be signed (e.g. whose name is invalid) is reported with an `error` in its result,
+    without failing the rest of the batch.
+    """
+    files = [file for file in (await request.files).getlist("file") if file.filename != ""]
+    if not files:
+        return jsonify({"error": "No file part"}), 400
+
+    user_id = user.user_id
+    username = user.username
+
+    file_path = Path(app.config["UPLOAD_FOLDER"]) / user_id
+    os.makedirs(file_path, exist_ok=True)
+
+    private_key, public_key = load_keypair()
+
+    # The same expiration date applies to the whole batch
+    form = await request.form
+    expiration_date = parse_expiration_date(form.get("expiration_date"))
+
+    signatures = []
+    results = []
+    signed_results = []
+    for file in files:
+        filename = secure_filename(file.filename)
+        if not filename:
+            results.append({"filename": file.filename, "error": "Invalid file name"})
+            continue
+        try:
+            file_hash, signature, serialized_file = await sign_stream_async(
+                iter_file_chunks(file.stream),
+                private_key,
+                to_file=file_path / filename,
+                serialize_chunk=file_storage.serialize_chunk,
+            )
+        except Exception as e:
+            logger.error(f"Could not sign file '{filename}': {e}")
+            results.append({"filename": filename, "error": str(e)})
+            continue
+        signatures.append(
+            {
+                "file_name": filename,
+                "file_hash": file_hash,
+                "signature": signature.hex(),
+                "user_id": user_id,
+                "username": username,
+                "signed_on": datetime.now().astimezone(datetime.now().tzinfo),
+                "expiration_date": expiration_date,
+                "serialized_file": serialized_file,
+            }
+        )
+        signed_results.append({"filename": filename, "signature": signature.hex()})
+        results.append(signed_results[-1])
+
+    if signatures:
+        file_ids = await file_storage.add_file_signatures(signatures, persist=True)
+        for result, file_id in zip(signed_results, file_ids, strict=True):
+            result["id"] = file_id
+
+    return jsonify(
+        {
+            "message": f"{len(signed_results)} of {len(results)} files signed successfully",
+            "files": results,
+            "public_key": public_key.public_bytes_raw().hex(),
+        }
+    ), (200 if signatures else 400)
+
+
 @app.route("/api/download/<file_id>", methods=["GET"])
 async def download_file(file_id):
-    """Retrieve file with given file ID."""
+    """Retrieve file with given file ID.
+
+    Supports single byte ranges (`Range`, `If-Range`) to resume interrupted transfers, and
+    conditional requests (`If-None-Match`, `If-Modified-Since`): the ETag of a file is its
+    signed SHA-256 hash, which the materialized copy is checked against. A copy not matching
+    the hash, e.g. of another signature of a file with the same name, is never served.
+    """
     logger.info(f"Client requested download for file '{file_id}'.")
-    signatures = file_storage.get_signatures()
-    for sig in signatures:
-        if sig["id"] == file_id:
-            try:
-                return await send_from_directory(Path(".storage/uploads") / sig["user_id"], file_name=sig["name"])
-            except FileNotFoundError:
-                logger.error(f"File '{sig['name']}' was not found.")
-            except Exception as e:
-                logger.error(f"Error while retrieving file: {e}")
-                return jsonify({"error": str(e)}), 400
+    sig = file_storage.get_signature(file_id)
+    if sig is None:
+        return jsonify({"error": f"File with ID '{file_id}' does not exist."}), 404
+
+    try:
+        file_path = file_storage.materializer.path_for(sig)
+    except ValueError as e:
+        logger.error(f"Refusing to serve file: {e}")
+        return jsonify({"error": str(e)}), 400
+
+    # The hash of the file on disk is cached along with its size and modification time
+    if not await file_storage.materializer.is_on_disk(file_path, sig["hash"]):
+        if not file_path.exists():
+            logger.error(f"File '{sig['name']}' was not found.")
+            return jsonify({"error": f"File '{sig['name']}' is not available yet."}), 404
+        logger.warning(f"File '{sig['name']}' on disk does not match signature '{file_id}'.")
+        return jsonify({"error": f"File '{sig['name']}' on disk does not match this signature."}), 409
+
+    try:
+        body = FileRangeBody(file_path)
+    except FileNotFoundError:
+        logger.error(f"File '{sig['name']}' was not found.")
+        return jsonify({"error": f"File '{sig['name']}' is not available yet."}), 404
+
+    response = Response(body, mimetype=mimetypes.guess_type(sig["name"])[0] or "application/octet-stream")
+    response.content_length = body.size
+    response.last_modified = datetime.fromtimestamp(file_path.stat().st_mtime, tz=timezone.utc)
+    response.set_etag(sig["hash"])
+    response.cache_control.no_cache = True
+    response.timeout = None  # Large files may take longer than the default response timeout
 
-    return jsonify({"error": f"File with ID '{file_id}' does not exist."})
+    # Unsatisfiable ranges are answered with 416 by Quart
+    return await response.make_conditional(request, accept_ranges=True, complete_length=body.size)
+
+
+def verification_result(digest: bytes, signature_hex: str, public_key_hex: str) -> dict:
+    """Verify a signature against the SHA-256 digest of a file, returning the response payload.
+
+    Raises:
+        ValueError: If the signature or the public key is malformed
+    """
+    public_key = load_public_key(bytes.fromhex(public_key_hex))
+    is_valid = is_verified_signature(digest, bytes.fromhex(signature_hex), public_key)
+    return {"is_valid": is_valid, "message": "Signature is valid" if is_valid else "Signature is invalid"}
 
 
 @app.route("/api/verify", methods=["POST"])
@@ -224,22 +377,16 @@ async def verify_signature():
     await file.save(file_path)
 
     try:
-        # Load the public key
-        public_key = load_public_key(bytes.fromhex(public_key_hex))
-
-        # Hash the file content
-        with open(file_path, "rb") as f:
-            file_content = f.read()
-
-        digest = hashlib.sha256(file_content).digest()
+        # Hash the file content off the event loop
+        digest = bytes.fromhex(await get_file_hash_async(file_path))
 
         # Verify the signature
-        is_valid = is_verified_signature(digest, bytes.fromhex(signature_hex), public_key)
+        result = verification_result(digest, signature_hex, public_key_hex)
 
         # Clean up the uploaded file
         os.unlink(file_path)
 
-        return jsonify({"is_valid": is_valid, "message": "Signature is valid" if is_valid else "Signature is invalid"})
+        return jsonify(result)
     except Exception as e:
         # Clean up the uploaded file if it exists
         if file_path.exists():
@@ -247,72 +394,123 @@ async def verify_signature():
         return jsonify({"error": str(e)}), 400
 
 
+@app.route("/api/verify/digest", methods=["POST"])
+async def verify_digest():
+    """Verify a file signature against the SHA-256 digest of the file, computed by the client.
+
+    Expects a JSON body with the hex-encoded `hash`, `signature` and `public_key`, so that
+    verifying a file of any size only transfers and checks a 32-byte digest.
+    """
+    data = await request.get_json(silent=True) or {}
+    file_hash = data.get("hash")
+    signature_hex = data.get("signature")
+    public_key_hex = data.get("public_key")
+
+    if not file_hash or not signature_hex or not public_key_hex:
+        return jsonify({"error": "Hash, signature and public key are required"}), 400
+
+    try:
+        digest = bytes.fromhex(file_hash)
+        if len(digest) != 32:
+            return jsonify({"error": "Hash must be a hex-encoded SHA-256 digest"}), 400
+        return jsonify(verification_result(digest, signature_hex, public_key_hex))
+    except Exception as e:
+        return jsonify({"error": str(e)}), 400
+
+
 @app.route("/api/validate/<file_id>", methods=["GET"])
 async def validate_signature(file_id):
     """Validate a signature by checking both authenticity and expiration status."""
-    signatures = file_storage.get_signatures()
-    for sig in signatures:
-        if sig["id"] == file_id:
-            # Check expiration if present
-            is_expired = False
+    sig = file_storage.get_signature(file_id)
+    if sig is None:
+        return jsonify({"error": "Signature not found"}), 404
+
+    # Check expiration if present
+    is_expired = False
+    if "data_retention_new_exp_date" in sig:
+        new_expiration_date = datetime.fromisoformat(sig["data_retention_new_exp_date"])
+        exp_date = arrow.get(new_expiration_date.isoformat()).to("local").format("MMMM D, YYYY (HH:mm:ss)")
+        expiration_message = f"Signature valid until {exp_date}"
+    else:
+        expiration_message = "No expiration date set"
+
+    if "expiration_date" in sig:
+        # Parse the expiration date and ensure it's timezone-aware
+        expiration_date = datetime.fromisoformat(sig["expiration_date"])
+
+        now = datetime.now()
+        is_expired = now.replace(tzinfo=timezone.utc) > expiration_date.replace(tzinfo=timezone.utc)
+
+        exp_date = arrow.get(expiration_date.isoformat()).to("local").format("MMMM D, YYYY (HH:mm:ss)")
+
+        if is_expired:
+            expiration_message = f"Signature expired on {exp_date}"
+        else:
             if "data_retention_new_exp_date" in sig:
                 new_expiration_date = datetime.fromisoformat(sig["data_retention_new_exp_date"])
                 exp_date = arrow.get(new_expiration_date.isoformat()).to("local").format("MMMM D, YYYY (HH:mm:ss)")
-                expiration_message = f"Signature valid until {exp_date}"
+            expiration_message = f"Signature valid until {exp_date}"
+
+    # Ensure the signature object has the proper ISO format date with timezone
+    if "expiration_date" in sig:
+        sig["expiration_date"] = expiration_date.isoformat()
+
+    return jsonify(
+        {
+            "is_valid": not is_expired and bool(verification_cache.verify(sig)),
+            "is_expired": is_expired,
+            "message": expiration_message,
+            "signature": sig,
+        }
+    )
+
+
+@app.route("/api/validate/batch", methods=["POST"])
+async def validate_signatures_batch():
+    """Validate several signatures at once, streaming the results as NDJSON.
+
+    The request body is an optional JSON object whose `ids` list selects the signatures
+    to validate, all of them are validated if it is missing or empty. Results are
+    streamed as each verification batch completes, so not in the requested order.
+    """
+    body = await request.get_json(silent=True) or {}
+    file_ids = body.get("ids") or []
+
+    if file_ids:
+        signatures = []
+        unknown_ids = []
+        for file_id in file_ids:
+            sig = file_storage.get_signature(file_id)
+            if sig is None:
+                unknown_ids.append(file_id)
             else:
-                expiration_message = "No expiration date set"
-
-            if "expiration_date" in sig:
-                # Parse the expiration date and ensure it's timezone-aware
-                expiration_date = datetime.fromisoformat(sig["expiration_date"])
-
-                now = datetime.now()
-                is_expired = now.replace(tzinfo=timezone.utc) > expiration_date.replace(tzinfo=timezone.utc)
-
-                exp_date = arrow.get(expiration_date.isoformat()).to("local").format("MMMM D, YYYY (HH:mm:ss)")
-
-                if is_expired:
-                    expiration_message = f"Signature expired on {exp_date}"
-                else:
-                    if "data_retention_new_exp_date" in sig:
-                        new_expiration_date = datetime.fromisoformat(sig["data_retention_new_exp_date"])
-                        exp_date = (
-                            arrow.get(new_expiration_date.isoformat()).to("local").format("MMMM D, YYYY (HH:mm:ss)")
-                        )
-                    expiration_message = f"Signature valid until {exp_date}"
-
-            # Ensure the signature object has the proper ISO format date with timezone
-            if "expiration_date" in sig:
-                sig["expiration_date"] = expiration_date.isoformat()
-
-            digest = bytes.fromhex(sig["hash"])
-            signature = bytes.fromhex(sig["signature"])
-            public_key_hex = user_storage.get_user_public_key(sig["user_id"])
-            public_key = load_public_key(bytes.fromhex(public_key_hex))
-
-            return jsonify(
-                {
-                    "is_valid": not is_expired and is_verified_signature(digest, signature, public_key),
-                    "is_expired": is_expired,
-                    "message": expiration_message,
-                    "signature": sig,
-                }
-            )
+                signatures.append(sig)
+    else:
+        signatures = file_storage.get_signatures_metadata()
+        unknown_ids = []
+
+    async def generate():
+        for file_id in unknown_ids:
+            yield json.dumps({"id": file_id, "is_valid": False, "error": "Signature not found"}) + "\n"
+        async for result in validate_signatures(
+            signatures, user_storage.get_user_public_key, cache=verification_cache
+        ):
+            yield json.dumps(result) + "\n"
 
-    return jsonify({"error": "Signature not found"}), 404
+    response = Response(generate(), mimetype="application/x-ndjson")
+    # Validating the whole store can take longer than the default response timeout
+    response.timeout = None
+    return response
 
 
 @app.route("/api/signatures/<file_id>", methods=["DELETE"])
 async def delete_signature(file_id):
     """Delete a signature by its ID."""
-    signatures = file_storage.get_signatures()
-    for sig in signatures:
-        if sig["id"] == file_id:
-            # Remove the signature from the array
-            await file_storage.remove_file_signature(file_id)
-            return jsonify({"message": "Signature deleted successfully"})
+    if not file_storage.has_signature(file_id):
+        return jsonify({"error": "Signature not found"}), 404
 
-    return jsonify({"error": "Signature not found"}), 404
+    await file_storage.remove_file_signature(file_id)
+    return jsonify({"message": "Signature deleted successfully"})
 
 
 @app.route("/api/user", methods=["GET"])
@@ -328,7 +526,11 @@ async def run_app(host: str, port: int):
     await file_storage.connect()
     await user_storage.connect()
 
-    await file_storage.data_retention_routine()
+    # Apply the data retention policy in the background, as signatures change or come due
+    file_storage.retention.start()
+
+    # Write the received files to disk in the background, as their signatures arrive
+    file_storage.materializer.start()
 
     # Set up graceful shutdown handler
     shutdown_event = False
@@ -361,4 +563,6 @@ async def run_app(host: str, port: int):
         except Exception as e:
             logger.error(f"Error disconnecting user storage: {e}")
 
+        shutdown_executors()
+
         logger.info("Shutdown complete.")
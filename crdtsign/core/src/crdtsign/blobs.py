@@ -0,0 +1,229 @@
+"""Content-addressed storage and transfer of file chunks."""
+
+import asyncio
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import Awaitable, Callable, Iterable, List, Optional
+
+import httpx
+from loguru import logger
+
+from crdtsign.utils.executor import map_ordered, run_in_thread
+from crdtsign.utils.file_utils import CHUNK_SIZE, ChunkCodec, default_codec, iter_file_chunks
+
+
+class BlobStore:
+    """Local store of compressed file chunks, addressed by the SHA-256 hash of their content.
+
+    Each chunk is kept compressed (see `ChunkCodec`) in its own file under `<root>/<hash[:2]>/<hash>`.
+    A file is described by its manifest, the ordered list of the hashes of its chunks.
+    """
+
+    def __init__(self, root: os.PathLike = ".storage/blobs", codec: Optional[ChunkCodec] = None):
+        """Initialize a new BlobStore instance.
+
+        Args:
+            root: Directory where the chunks are stored
+            codec: Codec compressing the chunks added to the store, the one configured in storage.yaml by default
+        """
+        self.root = Path(root)
+        self.codec = codec or default_codec
+
+    @staticmethod
+    def is_valid_hash(blob_hash: str) -> bool:
+        """Check that the given string is a well-formed SHA-256 hex digest."""
+        return len(blob_hash) == 64 and all(c in "0123456789abcdef" for c in blob_hash)
+
+    @staticmethod
+    def decode_payload(blob_hash: str, payload: bytes) -> bytes:
+        """Decompress a stored payload and check it against its hash.
+
+        Raises:
+            ValueError: If the payload is corrupted or does not match the hash
+        """
+        try:
+            chunk = ChunkCodec.decompress(payload)
+        except ValueError as e:
+            raise ValueError(f"Invalid payload for blob '{blob_hash}': {e}") from e
+        if hashlib.sha256(chunk).hexdigest() != blob_hash:
+            raise ValueError(f"Payload does not match blob '{blob_hash}'.")
+        return chunk
+
+    def path_for(self, blob_hash: str) -> Path:
+        """Return the path where the chunk with the given hash is stored."""
+        if not self.is_valid_hash(blob_hash):
+            raise ValueError(f"Invalid blob hash '{blob_hash}'.")
+        return self.root / blob_hash[:2] / blob_hash
+
+    def has(self, blob_hash: str) -> bool:
+        """Check whether the chunk with the given hash is available locally."""
+        return self.path_for(blob_hash).exists()
+
+    def missing(self, manifest: List[str]) -> List[str]:
+        """Return the hashes of the manifest which are not available locally, without duplicates."""
+        return [h for h in dict.fromkeys(manifest) if not self.has(h)]
+
+    def get(self, blob_hash: str) -> Optional[bytes]:
+        """Return the stored (compressed) payload of a chunk, None if it is not available."""
+        try:
+            with open(self.path_for(blob_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, blob_hash: str, payload: bytes) -> None:
+        """Store the (compressed) payload of a chunk after checking it against its hash."""
+        self.decode_payload(blob_hash, payload)
+
+        path = self.path_for(blob_hash)
+        if path.exists():
+            return
+        os.makedirs(path.parent, exist_ok=True)
+
+        # Write to a temporary file first so that partially written chunks are never visible
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+    def put_chunk(self, chunk: bytes) -> str:
+        """Compress and store a chunk of file content, returning its hash."""
+        blob_hash = hashlib.sha256(chunk).hexdigest()
+        if not self.has(blob_hash):
+            self.put(blob_hash, self.codec.compress(chunk))
+        return blob_hash
+
+    def read_chunk(self, blob_hash: str) -> bytes:
+        """Return the uncompressed content of a stored chunk.
+
+        Raises:
+            FileNotFoundError: If the chunk is not available locally
+            ValueError: If the stored chunk is corrupted
+        """
+        payload = self.get(blob_hash)
+        if payload is None:
+            raise FileNotFoundError(f"Blob '{blob_hash}' is not available.")
+        return self.decode_payload(blob_hash, payload)
+
+    def add_file(self, file_path: os.PathLike, chunk_size: int = CHUNK_SIZE) -> List[str]:
+        """Split a file into chunks, store them and return the file's manifest.
+
+        The chunks are hashed, compressed and stored in parallel on the codec pool.
+        """
+        with open(file_path, "rb") as f:
+            return list(map_ordered(self.put_chunk, iter_file_chunks(f, chunk_size)))
+
+    def write_file(self, manifest: List[str], to_file: os.PathLike, check_hash: Optional[str] = None) -> bool:
+        """Reconstruct a file from its manifest, all chunks must be available locally.
+
+        The chunks are read, decompressed and checked in parallel on the codec pool, then
+        written in order while the whole file is hashed.
+
+        Returns:
+            bool: True if the file was written (and matches `check_hash`, when given), False otherwise
+        """
+        hasher = hashlib.sha256()
+        try:
+            with open(to_file, "wb") as f:
+                for chunk in map_ordered(self.read_chunk, manifest):
+                    hasher.update(chunk)
+                    f.write(chunk)
+        except (FileNotFoundError, ValueError) as e:
+            logger.error(f"Could not reconstruct file '{to_file}': {e}")
+            return False
+
+        if check_hash and hasher.hexdigest() != check_hash:
+            logger.warning(f"Reconstructed file '{to_file}' is NOT VALID.")
+            return False
+
+        logger.info(f"File successfully reconstructed as '{to_file}'.")
+        return True
+
+
+class BlobTransferClient:
+    """Client for exchanging chunks with the blob store of the sync server.
+
+    The chunks of a manifest are transferred over a single connection pool, with up to
+    `max_concurrency` requests in flight instead of one round-trip per chunk at a time.
+    """
+
+    def __init__(self, blob_store: BlobStore, host: str, port: int, timeout: float = 30.0, max_concurrency: int = 8):
+        """Initialize a new BlobTransferClient instance.
+
+        Args:
+            blob_store: Local store the chunks are uploaded from and downloaded to
+            host: Hostname or IP address of the sync server
+            port: Port number of the sync server
+            timeout: Timeout in seconds for each transfer request
+            max_concurrency: Maximum number of chunks transferred at the same time
+        """
+        self.blob_store = blob_store
+        self.base_url = f"http://{host}:{port}/blobs"
+        self.timeout = timeout
+        self.max_concurrency = max(1, max_concurrency)
+
+    async def _for_each(self, blob_hashes: Iterable[str], transfer: Callable[[str], Awaitable[bool]]) -> int:
+        """Run a transfer for each hash, `max_concurrency` at a time, stopping at the first failure.
+
+        Returns:
+            int: The number of transfers which returned True
+        """
+        pending = iter(blob_hashes)
+        done = 0
+
+        async def worker():
+            nonlocal done
+            for blob_hash in pending:
+                transferred = await transfer(blob_hash)
+                done += transferred
+
+        try:
+            async with asyncio.TaskGroup() as group:
+                for _ in range(self.max_concurrency):
+                    group.create_task(worker())
+        except ExceptionGroup as e:
+            raise e.exceptions[0] from None
+        return done
+
+    async def upload(self, manifest: List[str]) -> int:
+        """Upload the chunks of a manifest which the server does not have yet.
+
+        Returns:
+            int: The number of uploaded chunks
+        """
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout) as client:
+
+            async def upload_chunk(blob_hash: str) -> bool:
+                response = await client.head(f"/{blob_hash}")
+                if response.status_code == 200:
+                    return False
+                payload = await run_in_thread(self.blob_store.get, blob_hash)
+                if payload is None:
+                    raise FileNotFoundError(f"Blob '{blob_hash}' is not available.")
+                response = await client.put(f"/{blob_hash}", content=payload)
+                response.raise_for_status()
+                return True
+
+            return await self._for_each(dict.fromkeys(manifest), upload_chunk)
+
+    async def fetch_missing(self, manifest: List[str]) -> int:
+        """Download the chunks of a manifest which are not available locally.
+
+        Returns:
+            int: The number of downloaded chunks
+        """
+        missing = self.blob_store.missing(manifest)
+        if not missing:
+            return 0
+
+        async with httpx.AsyncClient(base_url=self.base_url, timeout=self.timeout) as client:
+
+            async def fetch_chunk(blob_hash: str) -> bool:
+                response = await client.get(f"/{blob_hash}")
+                response.raise_for_status()
+                await run_in_thread(self.blob_store.put, blob_hash, response.content)
+                return True
+
+            return await self._for_each(missing, fetch_chunk)
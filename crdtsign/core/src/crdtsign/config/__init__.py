@@ -1,4 +1,4 @@
-"""Configuration handler for data retention policy."""
+"""Configuration handler for data retention policy, storage, executor and sync server settings."""
 import os
 
 import yaml
@@ -6,3 +6,26 @@ import yaml
 dirname = os.path.dirname(__file__)
 with open(os.path.join(dirname, "data_retention.yaml"), "r") as f:
     data_retention_config = yaml.load(f, Loader=yaml.FullLoader)
+
+with open(os.path.join(dirname, "storage.yaml"), "r") as f:
+    storage_config = yaml.load(f, Loader=yaml.FullLoader)
+
+with open(os.path.join(dirname, "executor.yaml"), "r") as f:
+    executor_config = yaml.load(f, Loader=yaml.FullLoader)
+
+with open(os.path.join(dirname, "server.yaml"), "r") as f:
+    server_config = yaml.load(f, Loader=yaml.FullLoader)
+
+
+def reload_data_retention_config() -> bool:
+    """Re-read the data retention policy from disk, returns True if it has changed."""
+    with open(os.path.join(dirname, "data_retention.yaml"), "r") as f:
+        new_config = yaml.load(f, Loader=yaml.FullLoader)
+
+    if new_config == data_retention_config:
+        return False
+
+    # Update in place, so that every module holding a reference sees the new policy
+    data_retention_config.clear()
+    data_retention_config.update(new_config)
+    return True
@@ -0,0 +1,202 @@
+"""In-memory indexes over the file signatures stored in the CRDT."""
+
+import uuid
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+
+# Fields holding the (possibly large) content of the signed file
+CONTENT_FIELDS = ("file_content", "file_manifest")
+
+
+def strip_content(entry) -> dict:
+    """Return a copy of a signature entry without the fields holding the file content.
+
+    The entry can be a plain dictionary or a nested map, whose content fields are never decoded.
+    """
+    return {key: entry[key] for key in entry.keys() if key not in CONTENT_FIELDS}
+
+
+def get_expiration_timestamp(entry: dict) -> Optional[float]:
+    """Return the POSIX timestamp at which a signature expires, None if it never does.
+
+    The expiration date set by the data retention policy takes precedence over the
+    one assigned by the signer. Naive dates are interpreted in local time. A malformed
+    date, e.g. received from a peer, is logged and the signature treated as never expiring.
+    """
+    exp_date = entry.get("data_retention_new_exp_date") or entry.get("expiration_date")
+    if not exp_date:
+        return None
+    try:
+        return datetime.fromisoformat(exp_date).timestamp()
+    except (TypeError, ValueError) as e:
+        logger.error(f"Invalid expiration date of signature '{entry.get('id')}': {e}")
+        return None
+
+
+class SignatureIndex:
+    """Metadata of every signature, keyed by file ID and kept in sync with the `files` map.
+
+    Besides the lookup by file ID, secondary indexes map each signer and each file hash
+    to the matching IDs, and keep the signatures ordered by expiration date. The indexes
+    are updated incrementally from the map's change events, for both local and remote
+    changes, so that lookups never need to copy or scan the whole document.
+    """
+
+    def __init__(self):
+        """Initialize an empty SignatureIndex."""
+        self._metadata: Dict[str, dict] = {}
+        self._by_user: Dict[str, Set[str]] = {}
+        self._by_hash: Dict[str, Set[str]] = {}
+        self._by_expiration: List[Tuple[float, str]] = []  # Sorted (timestamp, file ID) pairs
+
+    def __len__(self) -> int:
+        """Number of indexed signatures."""
+        return len(self._metadata)
+
+    def __contains__(self, file_id: str) -> bool:
+        """Check whether a signature with the given ID is indexed."""
+        return file_id in self._metadata
+
+    def on_map_change(self, events) -> None:
+        """Apply the deep change events of the `files` map to the index."""
+        for event in events:
+            if event.path:
+                # Fields of an entry changed: re-index it from the nested map
+                self.put(event.path[0], event.target)
+                continue
+            for file_id, change in event.keys.items():
+                if change["action"] == "delete":
+                    self.remove(file_id)
+                else:
+                    self.put(file_id, change["newValue"])
+
+    def put(self, file_id: str, entry) -> None:
+        """Index (or re-index) a signature entry."""
+        self.remove(file_id)
+
+        metadata = strip_content(entry)
+        self._metadata[file_id] = metadata
+        if "user_id" in metadata:
+            self._by_user.setdefault(metadata["user_id"], set()).add(file_id)
+        if "hash" in metadata:
+            self._by_hash.setdefault(metadata["hash"], set()).add(file_id)
+        expiration = get_expiration_timestamp(metadata)
+        if expiration is not None:
+            insort(self._by_expiration, (expiration, file_id))
+
+    def remove(self, file_id: str) -> None:
+        """Remove a signature from the index."""
+        metadata = self._metadata.pop(file_id, None)
+        if metadata is None:
+            return
+
+        for secondary, key in ((self._by_user, metadata.get("user_id")), (self._by_hash, metadata.get("hash"))):
+            ids = secondary.get(key)
+            if ids is not None:
+                ids.discard(file_id)
+                if not ids:
+                    del secondary[key]
+
+        expiration = get_expiration_timestamp(metadata)
+        if expiration is not None:
+            position = bisect_left(self._by_expiration, (expiration, file_id))
+            if position < len(self._by_expiration) and self._by_expiration[position] == (expiration, file_id):
+                del self._by_expiration[position]
+
+    def get(self, file_id: str) -> Optional[dict]:
+        """Return a copy of the metadata of a signature, None if it does not exist."""
+        metadata = self._metadata.get(file_id)
+        return dict(metadata) if metadata is not None else None
+
+    def get_many(self, file_ids) -> List[dict]:
+        """Return a copy of the metadata of the given signatures, skipping unknown IDs."""
+        return [dict(self._metadata[file_id]) for file_id in file_ids if file_id in self._metadata]
+
+    def all(self) -> List[dict]:
+        """Return a copy of the metadata of every signature."""
+        return [dict(metadata) for metadata in self._metadata.values()]
+
+    def ids_by_user(self, user_id: str) -> Set[str]:
+        """Return the IDs of the signatures made by the given user."""
+        return set(self._by_user.get(user_id, ()))
+
+    def ids_by_hash(self, file_hash: str) -> Set[str]:
+        """Return the IDs of the signatures of the file with the given hash."""
+        return set(self._by_hash.get(file_hash, ()))
+
+    def ids_expiring_before(self, timestamp: float) -> List[str]:
+        """Return the IDs of the signatures expiring strictly before the given timestamp, soonest first."""
+        end = bisect_left(self._by_expiration, (timestamp, ""))
+        return [file_id for _, file_id in self._by_expiration[:end]]
+
+
+class ChangeFeed:
+    """Sequence of the changes of the `files` map, to find the entries changed since a client's token.
+
+    Each batch of change events (one per transaction) gets the next sequence number, and
+    the last sequence number at which each file ID changed is kept in change order, so
+    that the IDs changed since a token are found without scanning the unchanged ones.
+    Tokens are `<epoch>:<sequence number>`, the epoch being drawn for each feed, so that
+    the tokens handed out by another process (e.g. before a restart) are never trusted.
+
+    The IDs of the removed entries are only kept for the last `max_removed` removals: the
+    older ones are forgotten, and the tokens handed out before them are not accepted anymore.
+    """
+
+    def __init__(self, max_removed: int = 10000):
+        """Initialize an empty ChangeFeed.
+
+        Args:
+            max_removed: Number of removed entries whose ID is kept
+        """
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self.min_seq = 0  # Oldest sequence number from which the changes are all known
+        self.max_removed = max_removed
+        self._changed: OrderedDict = OrderedDict()  # File ID -> sequence number of its last change
+        self._removed: OrderedDict = OrderedDict()  # File ID -> sequence number of its removal
+
+    @property
+    def token(self) -> str:
+        """Token identifying the current state of the feed."""
+        return f"{self.epoch}:{self.seq}"
+
+    def on_map_change(self, events) -> None:
+        """Record the IDs of the entries added, changed or removed by a transaction."""
+        self.seq += 1
+        for event in events:
+            for file_id in event.path[:1] or event.keys:
+                self._changed[file_id] = self.seq
+                self._changed.move_to_end(file_id)
+                if not event.path and event.keys[file_id]["action"] == "delete":
+                    self._removed[file_id] = self.seq
+                    self._removed.move_to_end(file_id)
+                else:
+                    self._removed.pop(file_id, None)
+
+        # Forget the oldest removals, along with the tokens handed out before them
+        while len(self._removed) > self.max_removed:
+            file_id, removed_seq = self._removed.popitem(last=False)
+            del self._changed[file_id]
+            self.min_seq = max(self.min_seq, removed_seq)
+
+    def parse_token(self, token: Optional[str]) -> Optional[int]:
+        """Return the sequence number of a token handed out by this feed, None if it cannot be used."""
+        epoch, _, seq = (token or "").partition(":")
+        if epoch != self.epoch or not seq.isdigit() or not self.min_seq <= int(seq) <= self.seq:
+            return None
+        return int(seq)
+
+    def changed_since(self, seq: int) -> List[str]:
+        """Return the IDs of the entries changed after the given sequence number, in change order."""
+        file_ids = []
+        for file_id, changed_seq in reversed(self._changed.items()):
+            if changed_seq <= seq:
+                break
+            file_ids.append(file_id)
+        file_ids.reverse()
+        return file_ids
@@ -1,6 +1,7 @@
 """Main entry point for the CLI."""
 
 import hashlib
+import json
 from datetime import datetime
 from pathlib import Path
 
@@ -11,13 +12,16 @@ from crdtsign.api import run_app
 from crdtsign.server import run_server
 from crdtsign.sign import (
     is_verified_signature,
+    iter_file_chunks,
     load_keypair,
     load_public_key,
     new_keypair,
-    sign,
+    sign_stream,
 )
-from crdtsign.storage import FileSignatureStorage
+from crdtsign.storage import FileSignatureStorage, UserStorage
 from crdtsign.user import User
+from crdtsign.utils.executor import shutdown_executors
+from crdtsign.validation import validate_signatures
 
 
 @click.group()
@@ -80,30 +84,28 @@ def sign_command(file: Path, verify: bool, table: bool):
             click.echo(f"Private key: {private_key.private_bytes_raw().hex()}")
             click.echo(f"Public key: {public_key.public_bytes_raw().hex()}")
 
-        # Sign the file with the private key
-        signature = sign(file, private_key)
+        # Hash, sign and serialize the file with the private key in a single pass
+        with open(file, "rb") as f:
+            file_hash, signature, serialized_file = sign_stream(
+                iter_file_chunks(f), private_key, serialize_chunk=sign_storage.serialize_chunk
+            )
         sig_date = datetime.now()
         click.echo(click.style("\nFile was successfully signed.", fg="green"))
         click.echo(f"Signature: {signature.hex()}")
 
-        with open(file, "rb") as f:
-            file_content = f.read()
-
-        # Hash the file content
-        digest = hashlib.sha256(file_content).digest()
-
         user = User()
 
         # Add the signed file metadata to the file signature storage
         sign_storage.add_file_signature(
             file_name=file.name,
-            file_hash=digest.hex(),
+            file_hash=file_hash,
             signature=signature.hex(),
             user_id=user.user_id,
             username=user.username,  # Include username in the signature
             signed_on=datetime.strptime(str(sig_date), "%Y-%m-%d %H:%M:%S.%f"),
             expiration_date=None,
             persist=True,
+            serialized_file=serialized_file,
         )
 
     else:
@@ -128,6 +130,40 @@ def sign_command(file: Path, verify: bool, table: bool):
     return
 
 
+@cli.command("validate")
+@click.argument("file_ids", nargs=-1)
+def validate_command(file_ids):
+    """Validate stored signatures, by ID or all of them if no ID is given.
+
+    The signatures are verified in parallel across processes, and the result of each
+    one is printed as a JSON line (NDJSON) as soon as it is available, followed by a
+    summary.
+    """
+    sign_storage = FileSignatureStorage("cli", "0.0.0.0", 8765, from_file=Path(".storage/signatures.bin").exists())
+    user_storage = UserStorage("cli", "0.0.0.0", 8765, from_file=Path(".storage/users.bin").exists())
+
+    if file_ids:
+        signatures = [sig for sig in map(sign_storage.get_signature, file_ids) if sig is not None]
+        for file_id in set(file_ids) - {sig["id"] for sig in signatures}:
+            click.echo(json.dumps({"id": file_id, "is_valid": False, "error": "Signature not found"}))
+    else:
+        signatures = sign_storage.get_signatures_metadata()
+
+    async def _validate():
+        counts = {"valid": 0, "invalid": 0}
+        async for result in validate_signatures(signatures, user_storage.get_user_public_key):
+            counts["valid" if result["is_valid"] else "invalid"] += 1
+            click.echo(json.dumps(result))
+        return counts
+
+    try:
+        counts = anyio.run(_validate)
+    finally:
+        shutdown_executors()
+
+    click.echo(f"{counts['valid']} valid, {counts['invalid']} invalid signatures.", err=True)
+
+
 # SERVER COMMAND
 # async def _run_server(host: str, port: int) -> None:
 #     """Run the sync server."""
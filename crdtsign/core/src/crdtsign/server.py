@@ -1,22 +1,66 @@
 """Sync server implementation."""
+import time
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
+from typing import List, Optional, Tuple
 
+import anyio
 from hypercorn import Config
 from hypercorn.asyncio import serve
 from loguru import logger
-from pycrdt import create_update_message
-from pycrdt.store import FileYStore
+from pycrdt import create_update_message, merge_updates
+from pycrdt.store import YDocNotFound
 from pycrdt.websocket import ASGIServer, WebsocketServer, YRoom
 
+from crdtsign.blobs import BlobStore
+from crdtsign.config import server_config
+from crdtsign.ystore import BatchFileYStore, BatchSQLiteYStore, StoreWriter, squash_updates
+
+MAX_BLOB_SIZE = 16 * 1024 * 1024  # 16MB
 
 class ServerRoom(YRoom):
-    """Implementation of the YRoom that logs updates to a persistent YStore."""
+    """Implementation of the YRoom that logs updates to a persistent YStore.
+
+    Updates arriving in a burst are coalesced: once an update is received, the ones
+    received within `coalesce_window` seconds are merged with it, and the merged update
+    is broadcast once to each client and written once to the YStore. With a store writer,
+    updates are handed over to it instead of being written by a new task each.
+    """
+
+    def __init__(
+        self,
+        *args,
+        coalesce_window: float = 0.0,
+        max_coalesced_updates: int = 256,
+        store_writer: Optional[StoreWriter] = None,
+        **kwargs,
+    ):
+        """Initialize the ServerRoom instance.
 
-    def __init__(self, *args, **kwargs):
-        """Initialize the ServerRoom instance."""
+        Args:
+            *args: Positional arguments of the YRoom
+            coalesce_window: Time in seconds during which updates are merged, 0 to disable coalescing
+            max_coalesced_updates: Maximum number of updates merged into a single one
+            store_writer: Writer batching the updates written to the YStore
+            **kwargs: Keyword arguments of the YRoom
+        """
         super().__init__(*args, **kwargs)
         self._update_count = 0
+        self.coalesce_window = coalesce_window
+        self.max_coalesced_updates = max_coalesced_updates
+        self.store_writer = store_writer
+
+    async def _receive_burst(self, first_update: bytes) -> List[bytes]:
+        """Collect the updates received within the coalescing window following the first one."""
+        updates = [first_update]
+        with anyio.move_on_after(self.coalesce_window):
+            while len(updates) < self.max_coalesced_updates:
+                try:
+                    updates.append(await self._update_receive_stream.receive())
+                except anyio.EndOfStream:
+                    break
+        return updates
 
     async def _broadcast_updates(self):
         """Broadcast updates with logging."""
@@ -30,6 +74,13 @@ class ServerRoom(YRoom):
                 if self._task_group.cancel_scope.cancel_called:
                     return
 
+                coalesced = 1
+                if self.coalesce_window > 0:
+                    updates = await self._receive_burst(update)
+                    coalesced = len(updates)
+                    if coalesced > 1:
+                        update = merge_updates(*updates)
+
                 if self.clients:
                     # broadcast update to all clients
                     message = create_update_message(update)
@@ -45,13 +96,17 @@ class ServerRoom(YRoom):
                         update_size = len(update)
                         update_time = datetime.now().isoformat()
 
-                        self._task_group.start_soon(self.ystore.write, update)
+                        if self.store_writer is not None:
+                            await self.store_writer.write(update)
+                        else:
+                            self._task_group.start_soon(self.ystore.write, update)
 
                         self.log.info(
                             "\n"
                             f"[YStore Update #{self._update_count}]\n"
                             f"Update Time: {update_time}\n"
                             f"Update Size: {update_size} bytes\n"
+                            f"Coalesced updates: {coalesced}\n"
                             f"Room: {getattr(self, '_room_name', 'unknown')}\n"
                             f"Active clients: {len(self.clients)}\n"
                             "\n"
@@ -62,51 +117,304 @@ class ServerRoom(YRoom):
 
 
 class SyncServer(WebsocketServer):
-    """Sync server implementation."""
+    """Sync server implementation.
+
+    A room's document is loaded from its store when the room is created. A background job
+    squashes the store of each room into a single update once its history grows past
+    `store_squash_max_updates` updates or `store_squash_max_bytes` bytes, so that neither
+    loading a room nor syncing a new client replays the whole history.
+
+    Rooms without clients are not deleted as soon as their last client leaves, but evicted
+    once idle for `room_idle_timeout` seconds, or least recently used first while the rooms
+    exceed `room_memory_budget` bytes. An evicted room is loaded again from its store by the
+    next `get_room()`.
+    """
 
     def __init__(self, store_directory: str, **kwargs):
         """Initialize the SyncServer instance."""
+        kwargs.setdefault("auto_clean_rooms", False)  # Rooms are evicted instead
         super().__init__(**kwargs)
         self._store_directory = Path(store_directory)
         self._store_directory.mkdir(exist_ok=True)
         self._ystores = {}      # Keep track of one room per store
+        self._store_writers = {}  # One batching writer per room
         self._update_count = 0
+        self._background_started = False
+        self._room_locks = {}  # Serialize the creation and eviction of each room
+        self._last_access = OrderedDict()  # Room name -> last access time, least recent first
+        self.blob_store = BlobStore(self._store_directory / "blobs")
+
+    def _create_store(self, name: str):
+        """Create the store of a room, with the backend selected in the server configuration.
+
+        The `file` backend appends the updates of each room to `<name>_store.bin`, the
+        `sqlite` backend stores the updates of every room in `rooms.db`.
+        """
+        backend = server_config["store_backend"]
+        if backend == "sqlite":
+            return BatchSQLiteYStore(name, db_path=str(self._store_directory / "rooms.db"))
+        if backend != "file":
+            self.log.error(f"Unknown store backend '{backend}', falling back to 'file'.")
+        return BatchFileYStore(f"{str(self._store_directory)}/{name}_store.bin")
+
+    async def _load_room(self, room: YRoom, store_writer: StoreWriter) -> None:
+        """Apply the stored history of a room to its document, merged on a worker thread."""
+        updates = []
+        try:
+            async for update, _, _ in room.ystore.read():
+                updates.append(update)
+        except YDocNotFound:
+            pass
+        if updates:
+            room.ydoc.apply_update(await anyio.to_thread.run_sync(squash_updates, updates))
+        store_writer.history_updates = len(updates)
+        store_writer.history_bytes = sum(len(update) for update in updates)
+
+    async def squash_room(self, name: str) -> Optional[Tuple[int, int]]:
+        """Squash the stored history of a room into a single update.
+
+        Returns:
+            Optional[Tuple[int, int]]: Size in bytes of the history before and after squashing,
+                None if the store of the room cannot be squashed
+        """
+        store_writer = self._store_writers[name]
+        if not hasattr(store_writer.ystore, "squash"):
+            return None
+        updates, size = store_writer.history_updates, store_writer.history_bytes
+        before, after = await store_writer.ystore.squash()
+        # Keep counting the updates written while squashing
+        store_writer.history_updates += 1 - updates
+        store_writer.history_bytes += after - size
+        self.log.info(f"Squashed store of room '{name}': {updates} updates, {before} -> {after} bytes")
+        return before, after
+
+    async def _squash_stores(self) -> None:
+        """Squash the stores of the rooms whose history grew past the configured limits, periodically."""
+        while True:
+            await anyio.sleep(server_config["store_squash_check_interval"])
+            for name, store_writer in list(self._store_writers.items()):
+                if store_writer.history_updates > 1 and (
+                    store_writer.history_updates >= server_config["store_squash_max_updates"]
+                    or store_writer.history_bytes >= server_config["store_squash_max_bytes"]
+                ):
+                    try:
+                        await self.squash_room(name)
+                    except Exception as e:
+                        self.log.error(f"Error squashing store for room {name}: {e}")
+
+    def memory_usage(self) -> int:
+        """Estimate the memory held by the documents of the rooms, from the size of their stored history."""
+        return sum(store_writer.history_bytes for store_writer in self._store_writers.values())
+
+    async def evict_room(self, name: str, last_access: Optional[float] = None) -> bool:
+        """Delete a room without clients, flushing and closing its store.
+
+        Args:
+            name: Name of the room
+            last_access: Only evict the room if it was not accessed since this time
+
+        Returns:
+            bool: Whether the room was evicted
+        """
+        lock = self._room_locks.setdefault(name, anyio.Lock())
+        async with lock:
+            room = self.rooms.get(name)
+            if room is None or room.clients:
+                return False
+            if last_access is not None and self._last_access.get(name, last_access) > last_access:
+                return False
+            await self.delete_room(name=name)
+            # The lock is only dropped while held and without waiters: a room opened meanwhile
+            # waits for this lock, which then has to remain the only lock of the room
+            if lock.statistics().tasks_waiting == 0:
+                self._room_locks.pop(name, None)
+        self.log.info(f"Evicted room '{name}'")
+        return True
+
+    async def _evict_rooms(self) -> None:
+        """Evict the rooms idle for too long, or least recently used while over the memory budget, periodically."""
+        while True:
+            check_interval = server_config["room_eviction_check_interval"]
+            await anyio.sleep(check_interval)
+            now = time.monotonic()
+            for name, room in self.rooms.items():
+                if room.clients:
+                    self._last_access[name] = now
+                    self._last_access.move_to_end(name)
+
+            idle_timeout = server_config["room_idle_timeout"]
+            memory_budget = server_config["room_memory_budget"]
+            memory_usage = self.memory_usage()
+            for name, last_access in list(self._last_access.items()):
+                if name not in self.rooms:
+                    self._last_access.pop(name, None)
+                    continue
+                idle_time = now - last_access
+                over_budget = memory_budget and memory_usage > memory_budget and idle_time >= check_interval
+                if not (idle_timeout and idle_time >= idle_timeout) and not over_budget:
+                    continue
+                store_writer = self._store_writers.get(name)
+                size = store_writer.history_bytes if store_writer is not None else 0
+                try:
+                    if await self.evict_room(name, last_access):
+                        memory_usage -= size
+                except Exception as e:
+                    self.log.error(f"Error evicting room {name}: {e}")
 
     async def get_room(self, name: str) -> YRoom:
-        """Get a YRoom instance or create a new one."""
-        if name not in self.rooms.keys():
-            room_store_path = f"{str(self._store_directory)}/{name}_store.bin"
-            room_store = FileYStore(str(room_store_path))
-
-            self._ystores[name] = room_store
-
-            room  = ServerRoom(
-                ready=self.rooms_ready,
-                ystore=room_store,
-                log=self.log
-            )
-
-            room._room_name = name
-            self.rooms[name] = room
-            self.log.info(f"Created new room '{name}'")
-        room = self.rooms[name]
-        await self.start_room(room)
+        """Get a YRoom instance or create a new one, loading it from its store."""
+        if not self._background_started:
+            self._background_started = True
+            self._task_group.start_soon(self._squash_stores)
+            self._task_group.start_soon(self._evict_rooms)
+        async with self._room_locks.setdefault(name, anyio.Lock()):
+            if name not in self.rooms.keys():
+                room_store = self._create_store(name)
+                store_writer = StoreWriter(
+                    room_store,
+                    max_batch_size=server_config["store_batch_max_updates"],
+                    max_batch_delay=server_config["store_batch_max_delay"],
+                    max_queue_size=server_config["store_queue_size"],
+                    fsync=server_config["store_fsync"],
+                    fsync_interval=server_config["store_fsync_interval"],
+                )
+                await self._task_group.start(store_writer.run)
+
+                self._ystores[name] = room_store
+                self._store_writers[name] = store_writer
+
+                room  = ServerRoom(
+                    ready=self.rooms_ready,
+                    ystore=room_store,
+                    log=self.log,
+                    coalesce_window=server_config["broadcast_coalesce_window"],
+                    max_coalesced_updates=server_config["broadcast_max_coalesced_updates"],
+                    store_writer=store_writer,
+                )
+
+                room._room_name = name
+                await self._task_group.start(room_store.start)
+                await self._load_room(room, store_writer)
+                self.rooms[name] = room
+                self.log.info(f"Created new room '{name}'")
+            room = self.rooms[name]
+            self._last_access[name] = time.monotonic()
+            self._last_access.move_to_end(name)
+            # Started under the lock: a room opened concurrently must not be started twice
+            await self.start_room(room)
         return room
 
-    async def __aexit__(self, exc_type, exc_val, exc_tb):
-        """Clean up all rooms on exit."""
-        for room_name, ystore in self._ystores.items():
+    async def _close_store(self, name: str) -> None:
+        """Write the updates of a room waiting to be stored, and close its store."""
+        store_writer = self._store_writers.pop(name, None)
+        if store_writer is not None:
+            try:
+                await store_writer.aclose()
+            except Exception as e:
+                self.log.error(f"Error flushing store writer for room {name}: {e}")
+        ystore = self._ystores.pop(name, None)
+        if ystore is not None:
             try:
                 await ystore.stop()
-                self.log.info(f"Closed store for room: {room_name}")
+                self.log.info(f"Closed store for room: {name}")
             except Exception as e:
-                self.log.error(f"Error closing store for room {room_name}: {e}")
+                self.log.error(f"Error closing store for room {name}: {e}")
+
+    async def delete_room(self, *, name: Optional[str] = None, room: Optional[YRoom] = None) -> None:
+        """Delete a room, and close its store once the updates waiting to be stored are written."""
+        if name is None:
+            name = self.get_room_name(room)
+        await super().delete_room(name=name)
+        self._last_access.pop(name, None)
+        await self._close_store(name)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        """Clean up all rooms on exit, once the updates waiting to be stored are written."""
+        for room_name in list(self._store_writers):
+            await self._close_store(room_name)
         await super().__aexit__(exc_type, exc_val, exc_tb)
 
+class SyncServerApp(ASGIServer):
+    """ASGI application serving the sync rooms over websocket and the blob store over HTTP.
+
+    Chunks are exchanged with `GET`, `HEAD` and `PUT` requests on `/blobs/<sha256>`.
+    """
+
+    def __init__(self, sync_server: SyncServer, **kwargs):
+        """Initialize the SyncServerApp instance."""
+        super().__init__(sync_server, **kwargs)
+        self._blob_store = sync_server.blob_store
+
+    async def __call__(self, scope, receive, send):
+        """Dispatch HTTP requests to the blob store and everything else to the websocket server."""
+        if scope["type"] == "http":
+            await self._serve_blob(scope, receive, send)
+        else:
+            await super().__call__(scope, receive, send)
+
+    @staticmethod
+    async def _respond(send, status: int, body: bytes = b"", content_length: Optional[int] = None):
+        """Send a complete HTTP response."""
+        length = len(body) if content_length is None else content_length
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [
+                    (b"content-type", b"application/octet-stream"),
+                    (b"content-length", str(length).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+    async def _serve_blob(self, scope, receive, send):
+        """Handle a single HTTP request for a blob."""
+        prefix, _, blob_hash = scope["path"].strip("/").partition("/")
+        if prefix != "blobs" or not BlobStore.is_valid_hash(blob_hash):
+            await self._respond(send, 404)
+            return
+
+        method = scope["method"]
+        if method in ("GET", "HEAD"):
+            # Disk I/O, decompression and hashing run off the event loop serving the rooms
+            payload = await anyio.to_thread.run_sync(self._blob_store.get, blob_hash)
+            if payload is None:
+                await self._respond(send, 404)
+            elif method == "HEAD":
+                await self._respond(send, 200, content_length=len(payload))
+            else:
+                await self._respond(send, 200, payload)
+        elif method == "PUT":
+            payload = bytearray()
+            while True:
+                message = await receive()
+                payload += message.get("body", b"")
+                if len(payload) > MAX_BLOB_SIZE:
+                    await self._respond(send, 413)
+                    return
+                if not message.get("more_body", False):
+                    break
+            try:
+                await anyio.to_thread.run_sync(self._blob_store.put, blob_hash, bytes(payload))
+            except ValueError as e:
+                self.log.warning(f"Rejected blob upload: {e}")
+                await self._respond(send, 400)
+                return
+            await self._respond(send, 201)
+        else:
+            await self._respond(send, 405)
+
+    @property
+    def log(self):
+        """Logger of the underlying websocket server."""
+        return self._websocket_server.log
+
+
 async def run_server(host: str, port: int, store_directory: str = "./.storage/sync_stores"):
     """Run the sync server asynchronously."""
     sync_server = SyncServer(store_directory=store_directory, log=logger)
-    app = ASGIServer(sync_server)
+    app = SyncServerApp(sync_server)
     config = Config()
     config.bind = [f"{host}:{port}"]
     async with sync_server:
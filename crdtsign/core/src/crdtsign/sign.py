@@ -3,6 +3,7 @@
 import hashlib
 import os
 from pathlib import Path
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 
 from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives.asymmetric.ed25519 import (
@@ -10,12 +11,14 @@ from cryptography.hazmat.primitives.asymmetric.ed25519 import (
     Ed25519PublicKey,
 )
 
+from crdtsign.utils.executor import map_ordered, run_in_thread
+from crdtsign.utils.file_utils import CHUNK_SIZE, SerializedChunk, compress_chunk, iter_file_chunks  # noqa: F401
+
 
 def get_file_hash(file_path: os.PathLike) -> str:
-    """Returns the file's hash in SHA256."""
+    """Returns the file's hash in SHA256, reading the file in chunks instead of loading it in memory."""
     with open(file_path, "rb") as f:
-        file_content = f.read()
-    return hashlib.sha256(file_content).digest().hex()
+        return hashlib.file_digest(f, "sha256").hexdigest()
 
 
 def sign(file_path: Path, private_key: Ed25519PrivateKey) -> bytes:
@@ -43,6 +46,89 @@ def sign(file_path: Path, private_key: Ed25519PrivateKey) -> bytes:
     return signature
 
 
+def sign_stream(
+    chunks: Iterable[bytes],
+    private_key: Ed25519PrivateKey,
+    to_file: Optional[os.PathLike] = None,
+    chunk_size: int = CHUNK_SIZE,
+    serialize_chunk: Callable[[bytes], SerializedChunk] = compress_chunk,
+) -> Tuple[str, bytes, List[SerializedChunk]]:
+    """Hash, sign and serialize a file in a single pass over its content.
+
+    Args:
+        chunks: Iterable yielding the file content as consecutive byte chunks of any size
+        private_key: Ed25519 private key used for signing
+        to_file: Optional path where a copy of the streamed content is written
+        chunk_size: Size of the chunks produced for the serialized copy of the file
+        serialize_chunk: Function turning each chunk into its serialized form, compresses
+                         it by default (see `FileSignatureStorage.serialize_chunk()`)
+
+    Returns:
+        tuple[str, bytes, list[SerializedChunk]]: The SHA-256 hash of the file (hex), its signature and
+        its serialized chunks, the latter being identical to the output of `serialize_file()`
+        with the default `serialize_chunk`
+
+    Note:
+        Chunks are serialized in parallel on the codec pool while the content is streamed, with
+        only a bounded number of them (see `map_ordered()`) held in memory at any time
+    """
+    hasher = hashlib.sha256()
+
+    def rechunk(out) -> Iterator[bytes]:
+        """Copy and hash the streamed content, yielding it in chunks of `chunk_size` bytes."""
+        buffer = bytearray()
+        for chunk in chunks:
+            if not chunk:
+                continue
+            if out is not None:
+                out.write(chunk)
+            hasher.update(chunk)
+            buffer += chunk
+
+            # Serialize as soon as a full chunk is available
+            while len(buffer) >= chunk_size:
+                yield bytes(buffer[:chunk_size])
+                del buffer[:chunk_size]
+        if buffer:
+            yield bytes(buffer)
+
+    out = open(to_file, "wb") if to_file is not None else None
+    try:
+        serialized_file = list(map_ordered(serialize_chunk, rechunk(out)))
+    finally:
+        if out is not None:
+            out.close()
+
+    digest = hasher.digest()
+    signature = private_key.sign(digest)
+
+    return digest.hex(), signature, serialized_file
+
+
+async def get_file_hash_async(file_path: os.PathLike) -> str:
+    """Run `get_file_hash()` on the thread pool, without blocking the event loop."""
+    return await run_in_thread(get_file_hash, file_path)
+
+
+async def sign_async(file_path: Path, private_key: Ed25519PrivateKey) -> bytes:
+    """Run `sign()` on the thread pool, without blocking the event loop."""
+    return await run_in_thread(sign, file_path, private_key)
+
+
+async def sign_stream_async(
+    chunks: Iterable[bytes],
+    private_key: Ed25519PrivateKey,
+    to_file: Optional[os.PathLike] = None,
+    chunk_size: int = CHUNK_SIZE,
+    serialize_chunk: Callable[[bytes], SerializedChunk] = compress_chunk,
+) -> Tuple[str, bytes, List[SerializedChunk]]:
+    """Run `sign_stream()` on the thread pool, without blocking the event loop.
+
+    The chunks are consumed from the worker thread, so they must not be produced by the event loop.
+    """
+    return await run_in_thread(sign_stream, chunks, private_key, to_file, chunk_size, serialize_chunk)
+
+
 def is_verified_signature(file_hash: bytes, signature: bytes, public_key: Ed25519PublicKey) -> bool:
     """Verify the signature of a file with the signer's public key and the file's SHA-256 hash.
 
@@ -25,6 +25,11 @@ document.addEventListener("DOMContentLoaded", function () {
   // Load signatures on page load
   loadSignatures();
 
+  // Handle the buttons of every row, including the rows added later on
+  document
+    .getElementById("signatures-table")
+    .addEventListener("click", handleSignatureAction);
+
   // Set up form submissions
   document
     .getElementById("sign-form")
@@ -69,96 +74,83 @@ document.addEventListener("DOMContentLoaded", function () {
 const state = {
   isDeleting: false,
   currentDeleteId: null,
+  changesToken: null, // Token of the signature list currently displayed
+  signatureRows: new Map(), // Signature ID -> table row
 };
 
-// Load signatures from the API
+// Load the signatures changed since the last load from the API, and update the table
 async function loadSignatures() {
   try {
-    const response = await fetch("/api/signatures");
+    const query = state.changesToken
+      ? `?since=${encodeURIComponent(state.changesToken)}`
+      : "";
+    const response = await fetch(`/api/signatures/changes${query}`);
     const data = await response.json();
-    formatSignaturesTable(data.signatures);
-
-    // Remove existing event listeners by cloning and replacing the table
-    const tableBody = document.getElementById("signatures-table");
-    const newTableBody = tableBody.cloneNode(true);
-    tableBody.parentNode.replaceChild(newTableBody, tableBody);
-
-    // Add event listeners to the details, validate and delete buttons
-    document.querySelectorAll(".view-details").forEach((btn) => {
-      btn.addEventListener("click", () => {
-        const sigId = btn.getAttribute("data-id");
-        // Fetch the signature details from the API
-        fetch(`/api/signatures/${sigId}`)
-          .then((response) => {
-            if (!response.ok) {
-              throw new Error(
-                `HTTP ${response.status}: ${response.statusText}`,
-              );
-            }
-            return response.json();
-          })
-          .then((data) => {
-            if (data.signature) {
-              showSignatureDetails(data.signature);
-            } else {
-              alert("Error: File not found");
-            }
-          })
-          .catch((error) => {
-            console.error("Error fetching signature details:", error);
-            alert(`Error fetching signature details: ${error.message}`);
-          });
-      });
-    });
-
-    document.querySelectorAll(".validate-btn").forEach((btn) => {
-      btn.addEventListener("click", () =>
-        validateSignature(btn.getAttribute("data-id")),
-      );
-    });
-
-    document.querySelectorAll(".delete-btn").forEach((btn) => {
-      btn.addEventListener("click", () =>
-        showDeleteConfirmation(btn.getAttribute("data-id")),
-      );
-    });
+    applySignatureChanges(data);
+    state.changesToken = data.token;
   } catch (error) {
     console.error("Error loading signatures:", error);
   }
 }
 
-// Format the signatures table
-function formatSignaturesTable(signatures) {
+// Apply a delta of the signature list to the table, only touching the changed rows
+function applySignatureChanges(changes) {
   const tableBody = document.getElementById("signatures-table");
-  tableBody.innerHTML = "";
 
-  if (signatures.length === 0) {
+  if (changes.reset) {
+    tableBody.innerHTML = "";
+    state.signatureRows.clear();
+  }
+
+  changes.removed.forEach((id) => {
+    state.signatureRows.get(id)?.remove();
+    state.signatureRows.delete(id);
+  });
+
+  changes.changed.forEach((sig) => {
+    const row = createSignatureRow(sig);
+    const existing = state.signatureRows.get(sig.id);
+    if (existing) {
+      existing.replaceWith(row);
+    } else {
+      tableBody.appendChild(row);
+    }
+    state.signatureRows.set(sig.id, row);
+  });
+
+  // Show a placeholder row while the table is empty
+  const placeholder = tableBody.querySelector(".no-signatures");
+  if (state.signatureRows.size === 0 && !placeholder) {
     tableBody.innerHTML = `
-            <tr>
+            <tr class="no-signatures">
                 <td colspan="5" class="px-6 py-4 text-center text-gray-500">No signed files found</td>
             </tr>
         `;
-    return;
+  } else if (state.signatureRows.size > 0 && placeholder) {
+    placeholder.remove();
   }
+}
 
-  signatures.forEach((sig) => {
-    const row = document.createElement("tr");
+// Create the table row of a signature
+function createSignatureRow(sig) {
+  const row = document.createElement("tr");
+  row.dataset.id = sig.id;
 
-    // Format the date
-    const signedDate = new Date(sig.signed_on);
-    const formattedDate = signedDate.toLocaleString();
+  // Format the date
+  const signedDate = new Date(sig.signed_on);
+  const formattedDate = signedDate.toLocaleString();
 
-    // Format expiration date if it exists
-    let expirationText = "No expiration";
-    if (sig.expiration_date) {
-      const expirationDate = new Date(sig.expiration_date);
-      expirationText = expirationDate.toLocaleString();
-    }
+  // Format expiration date if it exists
+  let expirationText = "No expiration";
+  if (sig.expiration_date) {
+    const expirationDate = new Date(sig.expiration_date);
+    expirationText = expirationDate.toLocaleString();
+  }
 
-    // Use username if available, otherwise fall back to user_id
-    const displayName = sig.username || sig.user_id;
+  // Use username if available, otherwise fall back to user_id
+  const displayName = sig.username || sig.user_id;
 
-    row.innerHTML = `
+  row.innerHTML = `
             <td class="px-6 py-4 whitespace-nowrap text-sm font-medium text-gray-900">${sig.name}</td>
             <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${displayName}</td>
             <td class="px-6 py-4 whitespace-nowrap text-sm text-gray-500">${formattedDate}</td>
@@ -170,8 +162,46 @@ function formatSignaturesTable(signatures) {
             </td>
         `;
 
-    tableBody.appendChild(row);
-  });
+  return row;
+}
+
+// Handle the details, validate and delete buttons of the signatures table
+function handleSignatureAction(event) {
+  const button = event.target.closest("button[data-id]");
+  if (!button) {
+    return;
+  }
+  const sigId = button.getAttribute("data-id");
+
+  if (button.classList.contains("view-details")) {
+    viewSignatureDetails(sigId);
+  } else if (button.classList.contains("validate-btn")) {
+    validateSignature(sigId);
+  } else if (button.classList.contains("delete-btn")) {
+    showDeleteConfirmation(sigId);
+  }
+}
+
+// Fetch the signature details from the API and show them
+function viewSignatureDetails(sigId) {
+  fetch(`/api/signatures/${sigId}`)
+    .then((response) => {
+      if (!response.ok) {
+        throw new Error(`HTTP ${response.status}: ${response.statusText}`);
+      }
+      return response.json();
+    })
+    .then((data) => {
+      if (data.signature) {
+        showSignatureDetails(data.signature);
+      } else {
+        alert("Error: File not found");
+      }
+    })
+    .catch((error) => {
+      console.error("Error fetching signature details:", error);
+      alert(`Error fetching signature details: ${error.message}`);
+    });
 }
 
 // Handle sign form submission
@@ -238,6 +268,30 @@ function showSignResult(message, isSuccess) {
   }
 }
 
+// Files up to this size are hashed by WebCrypto in a single call, larger ones in slices
+const WEBCRYPTO_MAX_SIZE = 256 * 1024 * 1024; // 256MB
+const HASH_SLICE_SIZE = 4 * 1024 * 1024; // 4MB
+
+// Compute the hex-encoded SHA-256 digest of a file, reporting progress as a fraction
+async function hashFile(file, onProgress = () => {}) {
+  if (window.crypto?.subtle && file.size <= WEBCRYPTO_MAX_SIZE) {
+    const digest = await crypto.subtle.digest("SHA-256", await file.arrayBuffer());
+    onProgress(1);
+    return Array.from(new Uint8Array(digest), (byte) =>
+      byte.toString(16).padStart(2, "0"),
+    ).join("");
+  }
+
+  // Only one slice of the file is held in memory at a time
+  const hasher = new Sha256();
+  for (let offset = 0; offset < file.size; offset += HASH_SLICE_SIZE) {
+    const slice = file.slice(offset, offset + HASH_SLICE_SIZE);
+    hasher.update(new Uint8Array(await slice.arrayBuffer()));
+    onProgress(Math.min(offset + HASH_SLICE_SIZE, file.size) / file.size);
+  }
+  return hasher.hexDigest();
+}
+
 // Handle verify form submission
 async function handleVerifySubmit(event) {
   event.preventDefault();
@@ -262,15 +316,20 @@ async function handleVerifySubmit(event) {
     return;
   }
 
-  const formData = new FormData();
-  formData.append("file", fileInput.files[0]);
-  formData.append("signature", signatureInput.value.trim());
-  formData.append("public_key", publicKeyInput.value.trim());
-
   try {
-    const response = await fetch("/api/verify", {
+    // Only the digest of the file is sent to the server
+    const hash = await hashFile(fileInput.files[0], (progress) =>
+      showVerifyResult(`Hashing file... ${Math.floor(progress * 100)}%`, true),
+    );
+
+    const response = await fetch("/api/verify/digest", {
       method: "POST",
-      body: formData,
+      headers: { "Content-Type": "application/json" },
+      body: JSON.stringify({
+        hash: hash,
+        signature: signatureInput.value.trim(),
+        public_key: publicKeyInput.value.trim(),
+      }),
     });
 
     const data = await response.json();
@@ -1,11 +1,13 @@
 """Functions to deal with storage of signatures and user keys."""
 
 import asyncio
+import hashlib
+import json
 import logging
 import os
 from datetime import datetime
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import shortuuid
 from httpx_ws import aconnect_ws
@@ -15,9 +17,21 @@ from pycrdt.websocket.websocket import HttpxWebsocket
 from rich.console import Console
 from rich.table import Table
 
-from crdtsign.config import data_retention_config
-from crdtsign.utils.data_retention import check_data_retention
-from crdtsign.utils.file_utils import deserialize_file, serialize_file
+from crdtsign.blobs import BlobStore, BlobTransferClient
+from crdtsign.config import storage_config
+from crdtsign.index import ChangeFeed, SignatureIndex
+from crdtsign.utils.data_retention import RetentionScheduler, check_data_retention
+from crdtsign.utils.executor import run_in_thread
+from crdtsign.utils.file_utils import (
+    CONTENT_FORMAT_LZ4_HEX,
+    CONTENT_FORMATS,
+    SerializedChunk,
+    deserialize_file_async,
+    encode_chunk,
+    serialize_file,
+)
+from crdtsign.utils.materialization import FileMaterializer
+from crdtsign.utils.persistence import SaveScheduler, UpdateLog
 
 
 class FileSignatureStorage:
@@ -52,10 +66,63 @@ class FileSignatureStorage:
         self._provider_task = None
         self._change_callbacks = []  # Add callback methods on map change event (for testing)
 
+        # Metadata of every signature, kept up to date from the change events of the map and its entries
+        self.index = SignatureIndex()
+        self.files_map.observe_deep(self.index.on_map_change)
+
+        # IDs of the entries changed by each transaction, to serve deltas of the signature list
+        self.changes = ChangeFeed()
+        self.files_map.observe_deep(self.changes.on_map_change)
+
+        # Serialized metadata of every signature, served until the map or one of its entries changes
+        self._listing: Optional[Tuple[str, bytes]] = None
+        self.files_map.observe_deep(self._invalidate_listing)
+
+        # File contents are either embedded in the CRDT or exchanged as content-addressed blobs
+        self.file_transfer = storage_config["file_transfer"]
+        self.content_format = CONTENT_FORMATS[storage_config["chunk_encoding"]]
+        self.blob_store = BlobStore()
+        self._blob_client = BlobTransferClient(
+            self.blob_store, self.host, self.port, max_concurrency=storage_config["blob_transfer_concurrency"]
+        )
+        # Hashes of the chunks not uploaded to the sync server yet, kept on file across restarts
+        self._pending_uploads_path = Path(".storage/pending_uploads.json")
+        self._pending_uploads: Set[str] = self._load_pending_uploads()
+        self._uploading: Set[str] = set()
+        self._upload_lock = asyncio.Lock()
+        self._upload_task: Optional[asyncio.Task] = None
+
+        # Documents are either rewritten in full on save or persisted as an append-only update log
+        self.persistence = storage_config["persistence"]
+        self._update_log = UpdateLog(".storage/signatures.bin", storage_config["log_compaction_threshold"])
+        self._pending_updates = []
+        self._loading = False
+
+        # Saves triggered by document changes are coalesced into a single write
+        self.save_scheduler = SaveScheduler(
+            self.save_signatures_to_file,
+            debounce=storage_config["save_debounce"],
+            max_latency=storage_config["save_max_latency"],
+        )
+
+        # The data retention policy is applied as the signatures change and when their retention date comes due
+        self.retention = RetentionScheduler(self, storage_config["retention_policy_check_interval"])
+        self.files_map.observe_deep(self.retention.on_map_change)
+
+        # The files of new or changed signatures are written to .storage/uploads in the background
+        self.materializer = FileMaterializer(self, storage_config["materialization_workers"])
+        self.files_map.observe_deep(self.materializer.on_map_change)
+
         # Load state from file if requested
         if from_file:
             self.load_signatures_from_file()
 
+        if self.persistence == "append":
+            self.doc.observe(self._on_doc_update)
+
+        if from_file:
+            self.migrate_legacy_entries()
+
     async def _create_ws_provider(
         self,
         host,
@@ -127,11 +194,15 @@ class FileSignatureStorage:
             # Update our document reference to the connected one
             self.doc = doc
             self.files_map = doc.get("files", type=Map)
-            self.files_map.observe(self._on_map_change)
+            self.files_map.observe_deep(self._on_map_change)
             self._connected = True
             self._ws_provider = True  # Just mark as connected
 
             logger.info(f"[{self.room_name}] Client {self.client_id} successfully connected.")
+
+            # Upload the chunks of the files signed while disconnected
+            if self.file_transfer == "blobs" and (self._upload_task is None or self._upload_task.done()):
+                self._upload_task = asyncio.get_running_loop().create_task(self.upload_pending_chunks())
         except Exception as e:
             logger.error(f"[{self.room_name}] Failed to connect client {self.client_id}: {e}")
             self._connected = False
@@ -142,6 +213,12 @@ class FileSignatureStorage:
         """Disconnect from the sync server and cleanup resources."""
         import asyncio
 
+        self.retention.stop()
+        self.materializer.stop()
+
+        # Write any change still waiting to be saved
+        self.save_scheduler.flush()
+
         if self._ws_provider and self._connected:
             try:
                 await self._cleanup_provider_resources()
@@ -160,45 +237,148 @@ class FileSignatureStorage:
         
         Args:
             callback: A function to call when changes occur.
-                     Will be called with the event parameter.
+                     Will be called with the list of change events of the map and its entries.
         """
         self._change_callbacks.append(callback)
 
-    def _on_map_change(self, event):
-        """Handle changes to the shared map."""
+    def _on_map_change(self, events):
+        """Handle changes to the shared map and to its entries."""
         logger.info(
             f"[{self.room_name}] Client {self.client_id} detected change."
         )
-        asyncio.create_task(self._deferred_save_signatures())
+        # With append-only persistence, saves are already requested for every transaction
+        if self.persistence != "append":
+            self.save_scheduler.request()
         
         # Invoke all registered callbacks
         for callback in self._change_callbacks:
             try:
                 if asyncio.iscoroutinefunction(callback):
-                    asyncio.create_task(callback(event))
+                    asyncio.create_task(callback(events))
                 else:
-                    callback(event)
+                    callback(events)
             except Exception as e:
                 logger.error(f"Error in change callback: {e}")
 
-    async def _deferred_save_signatures(self):
-        """Deferred save operation to run outside observer callback context."""
-        # Small delay to ensure we're outside the transaction context
-        await asyncio.sleep(0)
-        self.save_signatures_to_file()
+    def _on_doc_update(self, event):
+        """Queue the update of each transaction for the update log."""
+        if not self._loading:
+            self._pending_updates.append(event.update)
+            self.save_scheduler.request()
+
+    def _load_pending_uploads(self) -> Set[str]:
+        """Load the hashes of the chunks which were not uploaded to the sync server before the last shutdown."""
+        try:
+            with open(self._pending_uploads_path) as f:
+                return set(json.load(f))
+        except FileNotFoundError:
+            return set()
+        except (OSError, ValueError) as e:
+            logger.error(f"Could not load the chunks pending upload: {e}")
+            return set()
+
+    def _save_pending_uploads(self) -> None:
+        """Write the hashes of the chunks not uploaded to the sync server yet."""
+        os.makedirs(self._pending_uploads_path.parent, exist_ok=True)
+        tmp_path = self._pending_uploads_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(sorted(self._pending_uploads), f)
+        os.replace(tmp_path, self._pending_uploads_path)
+
+    async def _upload(self, chunks: List[str]) -> bool:
+        """Upload chunks to the sync server, and remove them from the pending chunks once they are there."""
+        self._uploading.update(chunks)
+        try:
+            uploaded = await self._blob_client.upload(chunks)
+        except Exception as e:
+            logger.error(f"Could not upload {len(chunks)} chunks to the sync server: {e}")
+            return False
+        finally:
+            self._uploading.difference_update(chunks)
+        self._pending_uploads.difference_update(chunks)
+        self._save_pending_uploads()
+        logger.info(f"Uploaded {uploaded} chunks to the sync server.")
+        return True
+
+    async def upload_chunks(self, manifest: List[str]) -> bool:
+        """Upload the chunks of a new file, keeping them pending until the next connection if that fails.
+
+        Only the given chunks are uploaded: the chunks left pending by earlier failures are
+        uploaded in the background, see `upload_pending_chunks()`.
+
+        Returns:
+            bool: True if the chunks are all on the sync server
+        """
+        chunks = list(dict.fromkeys(manifest))
+        self._pending_uploads.update(chunks)
+        self._save_pending_uploads()
+        if not self._connected:
+            return False
+        return await self._upload(chunks)
+
+    async def upload_pending_chunks(self) -> bool:
+        """Upload the chunks left pending while disconnected, or by a failed upload.
+
+        Only one upload of the pending chunks runs at a time, and it skips the chunks of the
+        files being signed, which are uploaded by `upload_chunks()`.
+
+        Returns:
+            bool: True if the pending chunks are all on the sync server
+        """
+        async with self._upload_lock:
+            pending = [chunk for chunk in self._pending_uploads if chunk not in self._uploading]
+            if not pending:
+                return True
+            return await self._upload(pending)
 
-    async def handle_files_deserialization(self):
-        """Handle batch deserialization for files embedded in the CRDT."""
-        for file in self.get_signatures():
-            if "file_content" in file:
-                logger.info("Found embedded file. Deserialization in progress...")
-                target_file_path = Path(".storage/uploads") / file["user_id"]
-                os.makedirs(target_file_path, exist_ok=True)
-                deserialize_file(file["file_content"], target_file_path / file["name"], file["hash"])
+    async def handle_files_deserialization(self) -> Dict[str, int]:
+        """Materialize every file missing from .storage/uploads right away, see `FileMaterializer`."""
+        return await self.materializer.materialize_all()
 
-            del self.files_map[file["id"]]["file_content"]
+    async def materialize_file(self, file: dict, to_file: os.PathLike) -> bool:
+        """Write the file of a signature from its embedded chunks or from its chunk manifest.
+
+        Args:
+            file: The signature, including the fields holding the file content
+            to_file: Path of the written file
+
+        Returns:
+            bool: True if the file was written and matches the signed hash, False otherwise
+        """
+        if "file_content" in file:
+            return await deserialize_file_async(
+                file["file_content"], to_file, file["hash"], file.get("content_format", CONTENT_FORMAT_LZ4_HEX)
+            )
+
+        if "file_manifest" in file:
+            try:
+                fetched = await self._blob_client.fetch_missing(file["file_manifest"])
+            except Exception as e:
+                logger.error(f"Could not fetch the chunks of file '{file['name']}': {e}")
+                return False
+            if fetched:
+                logger.info(f"Fetched {fetched} missing chunks of file '{file['name']}'.")
+            return await run_in_thread(self.blob_store.write_file, file["file_manifest"], to_file, file["hash"])
 
-        self.save_signatures_to_file()
+        logger.warning(f"Signature of file '{file['name']}' holds no file content.")
+        return False
+
+    def serialize_chunk(self, chunk: bytes) -> SerializedChunk:
+        """Serialize a chunk of file content in the form expected by `add_file_signature()`.
+
+        Returns the compressed chunk, encoded as configured by `chunk_encoding`, when files
+        are embedded in the CRDT, or the hash of the chunk (after storing it in the blob
+        store) otherwise.
+        """
+        if self.file_transfer == "blobs":
+            return self.blob_store.put_chunk(chunk)
+        return encode_chunk(chunk, self.content_format)
+
+    def serialize_file(self, file_path: os.PathLike) -> List[SerializedChunk]:
+        """Serialize a whole file in the form expected by `add_file_signature()`."""
+        if self.file_transfer == "blobs":
+            return self.blob_store.add_file(file_path)
+        return serialize_file(file_path, content_format=self.content_format)
 
     async def add_file_signature(
         self,
@@ -211,6 +391,7 @@ class FileSignatureStorage:
         expiration_date: Optional[datetime] = None,
         persist: Optional[bool] = False,
         serialized_file_path: Optional[os.PathLike] = None,
+        serialized_file: Optional[List[SerializedChunk]] = None,
     ) -> None:
         """Add a file signature to the storage.
 
@@ -225,7 +406,78 @@ class FileSignatureStorage:
             persist: True if the update should trigger a save of the state on file, False otherwise
             serialized_file_path: override the path where to pick up the file to
                                   serialize, keep the default one if None
+            serialized_file: already serialized file chunks (e.g. from `sign_stream()` with
+                             `serialize_chunk()`), the file is not read again from disk if provided
         """
+        await self.add_file_signatures(
+            [
+                {
+                    "file_name": file_name,
+                    "file_hash": file_hash,
+                    "signature": signature,
+                    "username": username,
+                    "user_id": user_id,
+                    "signed_on": signed_on,
+                    "expiration_date": expiration_date,
+                    "serialized_file_path": serialized_file_path,
+                    "serialized_file": serialized_file,
+                }
+            ],
+            persist=persist,
+        )
+
+    async def add_file_signatures(self, signatures: List[Dict[str, Any]], persist: Optional[bool] = False) -> List[str]:
+        """Add several file signatures to the storage at once.
+
+        All the signatures are inserted in a single transaction, so that they result in a
+        single sync update and a single write of the persisted state.
+
+        Args:
+            signatures: Keyword arguments of `add_file_signature()` for each signature
+                        (except `persist`)
+            persist: True if the update should trigger a save of the state on file, False otherwise
+
+        Returns:
+            List[str]: The IDs of the new signatures, in the same order
+        """
+        files = []
+        for signature in signatures:
+            if signature.get("serialized_file") is None:
+                # The file has to be read and compressed, which is done off the event loop
+                files.append(await run_in_thread(self._create_signature_entry, **signature))
+            else:
+                files.append(self._create_signature_entry(**signature))
+
+        # Upload the chunks before the manifests are broadcast, so that peers can fetch them right away
+        if self.file_transfer == "blobs" and files:
+            await self.upload_chunks([chunk_hash for file in files for chunk_hash in file["file_manifest"]])
+
+        # Add the files to the files map, as nested maps so that their fields can be updated individually
+        with self.doc.transaction():
+            for file in files:
+                self.files_map[file["id"]] = Map(file)
+
+        # Saving file chunks on the file owner's storage is redundant
+        # del self.files_map[file["id"]]["file_content"]
+
+        if persist:
+            self.save_scheduler.flush(force=True)
+
+        return [file["id"] for file in files]
+
+    def _create_signature_entry(
+        self,
+        file_name: str,
+        file_hash: str,
+        signature: str,
+        username: str,
+        user_id: str,
+        signed_on: datetime,
+        expiration_date: Optional[datetime] = None,
+        serialized_file_path: Optional[os.PathLike] = None,
+        serialized_file: Optional[List[SerializedChunk]] = None,
+    ) -> dict:
+        """Create the entry of a file signature, see `add_file_signature()` for the arguments."""
         # Use provided username or fall back to user_id if not provided
         display_name = username if username else user_id
 
@@ -241,9 +493,18 @@ class FileSignatureStorage:
             "user_id": user_id,
             "username": display_name,
             "signed_on": str(signed_on.isoformat()),
-            "file_content": serialize_file(path_for_file_to_serialize),
         }
 
+        if serialized_file is None:
+            serialized_file = self.serialize_file(path_for_file_to_serialize)
+
+        # Either embed the chunks or only reference them by their hash
+        if self.file_transfer == "blobs":
+            file["file_manifest"] = serialized_file
+        else:
+            file["file_content"] = serialized_file
+            file["content_format"] = self.content_format
+
         # Add expiration date if provided
         if expiration_date:
             file["expiration_date"] = str(expiration_date.isoformat())
@@ -257,15 +518,7 @@ class FileSignatureStorage:
             file["flag_data_retention"] = True
             file["data_retention_new_exp_date"] = data_retention_new_exp_date
 
-        # Add the file to the files map
-        with self.doc.transaction():
-            self.files_map[file["id"]] = file
-
-        # Saving file chunks on the file owner's storage is redundant
-        # del self.files_map[file["id"]]["file_content"]
-
-        if persist:
-            self.save_signatures_to_file()
+        return file
 
     async def remove_file_signature(self, file_id: str, persist: Optional[bool] = False) -> None:
         """Remove a file signature from the storage.
@@ -281,7 +534,7 @@ class FileSignatureStorage:
                 del self.files_map[file_id]
 
         if persist:
-            self.save_signatures_to_file()
+            self.save_scheduler.flush(force=True)
 
     def get_signatures(self) -> List[dict]:
         """Retrieve all file signatures stored in the document.
@@ -298,6 +551,110 @@ class FileSignatureStorage:
 
         return signatures
 
+    def has_signature(self, file_id: str) -> bool:
+        """Check whether a file signature with the given ID exists."""
+        return file_id in self.index
+
+    def get_signature(self, file_id: str, include_content: bool = False) -> Optional[dict]:
+        """Retrieve a single file signature by its ID, without copying the other entries.
+
+        Args:
+            file_id: ID of the file signature to retrieve
+            include_content: If True, also return the fields holding the file content
+                             (embedded chunks or chunk manifest)
+
+        Returns:
+            dict: The signature information, or None if no signature has the given ID
+        """
+        if not include_content:
+            return self.index.get(file_id)
+
+        file = self.files_map.get(file_id)
+        return dict(file) if file is not None else None
+
+    def get_signatures_metadata(self) -> List[dict]:
+        """Retrieve all file signatures without the fields holding the file content."""
+        return self.index.all()
+
+    def _invalidate_listing(self, events) -> None:
+        """Drop the cached serialization of the signatures, once the map or its entries changed."""
+        self._listing = None
+
+    def get_signatures_listing(self) -> Tuple[str, bytes]:
+        """Retrieve the JSON-serialized metadata of every signature, along with its ETag.
+
+        The serialization is cached until the next change of the `files` map, and its ETag
+        is derived from the state vector of the document, so that it only changes along
+        with the document and is the same for identical documents.
+
+        Returns:
+            Tuple[str, bytes]: The ETag and the JSON body `{"signatures": [...]}`
+        """
+        if self._listing is None:
+            etag = hashlib.sha256(self.doc.get_state()).hexdigest()[:32]
+            body = json.dumps({"signatures": self.get_signatures_metadata()}).encode()
+            self._listing = (etag, body)
+        return self._listing
+
+    def get_signature_changes(self, since: Optional[str] = None) -> Dict[str, Any]:
+        """Retrieve the signatures added, changed or removed since a token of `changes`.
+
+        Without a token, or with a token which cannot be used (e.g. handed out before a
+        restart, or too old for the removals since then to be known), the metadata of every
+        signature is returned along with `reset` set, so that the client starts over from
+        the full list.
+
+        Args:
+            since: Token returned by a previous call
+
+        Returns:
+            dict: The new `token`, `reset`, the metadata of the `changed` signatures and the IDs of the `removed` ones
+        """
+        seq = self.changes.parse_token(since)
+        if seq is None:
+            return {
+                "token": self.changes.token,
+                "reset": True,
+                "changed": self.get_signatures_metadata(),
+                "removed": [],
+            }
+
+        changed = []
+        removed = []
+        for file_id in self.changes.changed_since(seq):
+            metadata = self.index.get(file_id)
+            if metadata is None:
+                removed.append(file_id)
+            else:
+                changed.append(metadata)
+        return {"token": self.changes.token, "reset": False, "changed": changed, "removed": removed}
+
+    def get_signatures_by_user(self, user_id: str) -> List[dict]:
+        """Retrieve the file signatures made by a user, without the file content.
+
+        Args:
+            user_id: ID of the signer
+        """
+        return self.index.get_many(self.index.ids_by_user(user_id))
+
+    def get_signatures_by_hash(self, file_hash: str) -> List[dict]:
+        """Retrieve the file signatures of a file (i.e. who signed it), without the file content.
+
+        Args:
+            file_hash: SHA-256 hash of the signed file
+        """
+        return self.index.get_many(self.index.ids_by_hash(file_hash))
+
+    def get_signatures_expiring_before(self, date: datetime) -> List[dict]:
+        """Retrieve the file signatures expiring before a date, soonest first, without the file content.
+
+        The expiration date set by the data retention policy takes precedence over the
+        one assigned by the signer.
+
+        Args:
+            date: Upper bound (excluded) of the expiration dates, naive dates are interpreted in local time
+        """
+        return self.index.get_many(self.index.ids_expiring_before(date.timestamp()))
 
     def save_signatures_to_file(self) -> None:
         """Save the file signatures to a persistent storage file.
@@ -305,7 +662,16 @@ class FileSignatureStorage:
         Serializes the current state of the CRDT document containing all signatures
         and writes it to the default storage location (.storage/signatures.bin).
         Creates the storage directory if it doesn't exist.
+
+        With append-only persistence, only the updates since the last save are appended
+        to the log, which is compacted into the snapshot once it has grown large enough.
         """
+        if self.persistence == "append":
+            updates, self._pending_updates = self._pending_updates, []
+            self._update_log.append_many(updates)
+            self._update_log.maybe_compact(self.doc)
+            return
+
         # Get the CRDT document state as bytes
         doc_updates = self.doc.get_update()
 
@@ -325,7 +691,20 @@ class FileSignatureStorage:
         (.storage/signatures.bin) and applies it to the current document instance.
         If the storage file doesn't exist, logs an error message but continues execution.
 
+        With append-only persistence, the updates logged since the last snapshot are
+        applied as well.
         """
+        if self.persistence == "append":
+            if not self._update_log.exists():
+                logging.error("\nCould not load state from .storage/signatures.bin.\n")
+                return
+            self._loading = True
+            try:
+                self._update_log.load(self.doc)
+            finally:
+                self._loading = False
+            return
+
         try:
             with open(".storage/signatures.bin", "rb") as f:
                 doc_updates = f.read()
@@ -362,47 +741,57 @@ class FileSignatureStorage:
 
         Console().print(table)
 
-    async def data_retention_routine(self):
-        """Check which files have already expired according to the data retention policy."""
-        signatures = self.get_signatures()
+    def apply_signature_changes(self, changes: Dict[str, Dict[str, Any]]) -> None:
+        """Apply field changes to several file signatures in a single transaction.
 
-        if int(data_retention_config["data_retention_period"]) == 0:
-            # Data retention is disabled
-            # Delete all residual data
-            for sig in signatures:
-                file_id = sig["id"]
-                if "flag_data_retention" in sig:
-                    del sig["flag_data_retention"]
-                    del sig["data_retention_new_exp_date"]
-                    with self.doc.transaction():
-                        self.files_map[file_id] = sig
-            self.save_signatures_to_file()
-            return
-        else:
-            # recompute a new expiration date (when data retention is re-enabled)
-            for sig in signatures:
-                file_id = sig["id"]
-                flag, new_exp_date = check_data_retention(sig)
-                if flag:
-                    sig["flag_data_retention"] = flag
-                    sig["data_retention_new_exp_date"] = new_exp_date
-                    with self.doc.transaction():
-                        self.files_map[file_id] = sig
+        Only the changed fields are encoded in the resulting update, entries still stored
+        as plain dictionaries are migrated to nested maps first.
 
-        for sig in signatures:
-            if "data_retention_new_exp_date" in sig:
-                if datetime.now().replace(tzinfo=datetime.now().astimezone().tzinfo) > datetime.fromisoformat(
-                    sig["data_retention_new_exp_date"]
-                ).replace(tzinfo=datetime.now().astimezone().tzinfo):
-                    logger.warning(f"File {sig['name']} marked as expired due to data retention policy.")
-                    file_id = sig["id"]
-                    sig["expiration_date"] = sig["data_retention_new_exp_date"]
-                    del sig["data_retention_new_exp_date"]
-                    if "flag_data_retention" in sig:
-                        del sig["flag_data_retention"]
-                    with self.doc.transaction():
-                        self.files_map[file_id] = sig
-        self.save_signatures_to_file()
+        Args:
+            changes: New value of each changed field, keyed by file ID; fields set to None are removed
+        """
+        with self.doc.transaction():
+            for file_id, fields in changes.items():
+                entry = self.files_map.get(file_id)
+                if entry is None:
+                    continue
+                if not isinstance(entry, Map):
+                    file = {key: value for key, value in entry.items() if key not in fields}
+                    file.update({key: value for key, value in fields.items() if value is not None})
+                    self.files_map[file_id] = Map(file)
+                    continue
+                for key, value in fields.items():
+                    if value is not None:
+                        entry[key] = value
+                    elif key in entry:
+                        del entry[key]
+
+    def migrate_legacy_entries(self) -> int:
+        """Convert the signatures stored as plain dictionaries into nested maps.
+
+        Entries written by earlier versions are stored as a single value, so that
+        any change re-encodes the whole entry, file content included.
+
+        Returns:
+            int: The number of migrated signatures
+        """
+        legacy = [file_id for file_id, entry in self.files_map.items() if not isinstance(entry, Map)]
+        if not legacy:
+            return 0
+
+        with self.doc.transaction():
+            for file_id in legacy:
+                self.files_map[file_id] = Map(dict(self.files_map[file_id]))
+        self.save_scheduler.request()
+
+        logger.info(f"Migrated {len(legacy)} signatures to nested maps.")
+        return len(legacy)
+
+    async def data_retention_routine(self):
+        """Check all the files against the data retention policy and apply the resulting changes right away."""
+        self.retention.recompute_all()
+        self.retention.apply_due()
+        self.save_scheduler.flush(force=True)
 
 
 class UserStorage:
@@ -436,10 +825,26 @@ class UserStorage:
         self._ws_provider = None
         self._provider_task = None
 
+        # Documents are either rewritten in full on save or persisted as an append-only update log
+        self.persistence = storage_config["persistence"]
+        self._update_log = UpdateLog(".storage/users.bin", storage_config["log_compaction_threshold"])
+        self._pending_updates = []
+        self._loading = False
+
+        # Saves triggered by document changes are coalesced into a single write
+        self.save_scheduler = SaveScheduler(
+            self.save_users_to_file,
+            debounce=storage_config["save_debounce"],
+            max_latency=storage_config["save_max_latency"],
+        )
+
         # Load from file if requested
         if from_file:
             self.load_users_from_file()
 
+        if self.persistence == "append":
+            self.doc.observe(self._on_doc_update)
+
     async def _create_ws_provider(
         self,
         host,
@@ -526,6 +931,9 @@ class UserStorage:
         """Disconnect from the sync server and cleanup resources."""
         import asyncio
 
+        # Write any change still waiting to be saved
+        self.save_scheduler.flush()
+
         if self._ws_provider and self._connected:
             try:
                 await self._cleanup_provider_resources()
@@ -544,13 +952,15 @@ class UserStorage:
         logger.info(
             f"[{self.room_name}] Client {self.client_id} detected change."
         )
-        asyncio.create_task(self._deferred_save_users())
+        # With append-only persistence, saves are already requested for every transaction
+        if self.persistence != "append":
+            self.save_scheduler.request()
 
-    async def _deferred_save_users(self):
-        """Deferred save operation to run outside observer callback context."""
-        # Small delay to ensure we're outside the transaction context
-        await asyncio.sleep(0)
-        self.save_users_to_file()
+    def _on_doc_update(self, event):
+        """Queue the update of each transaction for the update log."""
+        if not self._loading:
+            self._pending_updates.append(event.update)
+            self.save_scheduler.request()
 
     def add_user(
         self,
@@ -586,7 +996,7 @@ class UserStorage:
             self.users_map[user["id"]] = user
 
         if persist:
-            self.save_users_to_file()
+            self.save_scheduler.flush(force=True)
 
     def save_users_to_file(self) -> None:
         """Save the user data to a persistent storage file.
@@ -595,7 +1005,15 @@ class UserStorage:
         data and writes it to the default storage location (.storage/users.bin).
         Creates the storage directory if it doesn't exist.
 
+        With append-only persistence, only the updates since the last save are appended
+        to the log, which is compacted into the snapshot once it has grown large enough.
         """
+        if self.persistence == "append":
+            updates, self._pending_updates = self._pending_updates, []
+            self._update_log.append_many(updates)
+            self._update_log.maybe_compact(self.doc)
+            return
+
         # Get the CRDT document state as bytes
         doc_updates = self.doc.get_update()
 
@@ -615,7 +1033,20 @@ class UserStorage:
         (.storage/users.bin) and applies it to the current document instance.
         If the storage file doesn't exist, logs an error message but continues execution.
 
+        With append-only persistence, the updates logged since the last snapshot are
+        applied as well.
         """
+        if self.persistence == "append":
+            if not self._update_log.exists():
+                logging.error("\nCould not load state from.storage/users.bin.\n")
+                return
+            self._loading = True
+            try:
+                self._update_log.load(self.doc)
+            finally:
+                self._loading = False
+            return
+
         try:
             with open(".storage/users.bin", "rb") as f:
                 doc_updates = f.read()
@@ -647,8 +1078,11 @@ class UserStorage:
 
         Args:
             user_id: ID of the user to retrieve the public key for
+
+        Returns:
+            str: The hex-encoded public key, or None if the user is unknown
         """
-        user = self.users_map[user_id]
+        user = self.users_map.get(user_id)
 
         if user:
             return user["public_key"]
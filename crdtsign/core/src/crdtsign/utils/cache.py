@@ -0,0 +1,57 @@
+"""Bounded in-memory caches."""
+
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+
+
+class LRUCache:
+    """Mapping holding at most `maxsize` items, evicting the least recently used one first."""
+
+    def __init__(self, maxsize: int = 1024):
+        """Initialize an empty LRUCache.
+
+        Args:
+            maxsize: Maximum number of cached items
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._items: OrderedDict = OrderedDict()
+
+    def __len__(self) -> int:
+        """Number of cached items."""
+        return len(self._items)
+
+    def __contains__(self, key: Hashable) -> bool:
+        """Check whether a key is cached, without updating its recency."""
+        return key in self._items
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Number of cached items, hits and misses so far."""
+        return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value of a key, marking it as the most recently used."""
+        try:
+            self._items.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return self._items[key]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache a value, evicting the least recently used item if the cache is full."""
+        self._items[key] = value
+        self._items.move_to_end(key)
+        if len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        """Remove a key from the cache and return its value."""
+        return self._items.pop(key, default)
+
+    def clear(self) -> None:
+        """Remove every item from the cache."""
+        self._items.clear()
@@ -1,10 +1,15 @@
 """Utilities for managing the data retention policy."""
+import asyncio
+import heapq
+import time
 from datetime import datetime, timedelta
-from typing import Dict, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
 
 import arrow
+from loguru import logger
 
-from crdtsign.config import data_retention_config
+from crdtsign.config import data_retention_config, reload_data_retention_config
+from crdtsign.index import strip_content
 
 
 def check_data_retention(file: Dict[str, str or bytes]) -> Tuple[bool, Optional[str]]:
@@ -27,3 +32,180 @@ def get_time_until_expiration(date_str: str) -> str:
     date_formatted = arrow.get(datetime.fromisoformat(date_str))
 
     return date_formatted.humanize(arrow.now(), only_distance=False)
+
+
+def get_retention_changes(file: dict, now: float) -> Dict[str, Optional[object]]:
+    """Compute the changes the data retention policy requires on a file signature.
+
+    Args:
+        file: The signature entry
+        now: Current POSIX timestamp
+
+    Returns:
+        dict: New value of each field to change, None for the fields to remove (empty if no change is needed)
+    """
+    if int(data_retention_config["data_retention_period"]) == 0:
+        # Data retention is disabled: delete all residual data
+        if "flag_data_retention" in file or "data_retention_new_exp_date" in file:
+            return {"flag_data_retention": None, "data_retention_new_exp_date": None}
+        return {}
+
+    changes = {}
+    new_exp_date = file.get("data_retention_new_exp_date")
+
+    # Recompute the expiration date assigned by the policy (e.g. when data retention is re-enabled)
+    flag, policy_exp_date = check_data_retention(file)
+    if flag and (not file.get("flag_data_retention") or new_exp_date != policy_exp_date):
+        changes["flag_data_retention"] = True
+        changes["data_retention_new_exp_date"] = policy_exp_date
+        new_exp_date = policy_exp_date
+
+    # The file has expired according to the data retention policy
+    if new_exp_date and datetime.fromisoformat(new_exp_date).timestamp() <= now:
+        changes["expiration_date"] = new_exp_date
+        changes["data_retention_new_exp_date"] = None
+        changes["flag_data_retention"] = None
+
+    return changes
+
+
+class RetentionScheduler:
+    """Apply the data retention policy to the file signatures when something actually changes.
+
+    Signatures with a retention expiration date are kept in a min-heap, so that the
+    scheduler only wakes up when the next one comes due. New or changed entries are
+    checked against the policy as their change events arrive, and a full recomputation
+    only happens at startup and when the `data_retention_period` policy changes.
+    All the changes due at the same time are applied in a single transaction.
+    """
+
+    def __init__(self, storage, policy_check_interval: float = 60.0):
+        """Initialize a new RetentionScheduler instance.
+
+        Args:
+            storage: The FileSignatureStorage the policy is applied to
+            policy_check_interval: Interval in seconds at which the policy file is checked for changes
+        """
+        self._storage = storage
+        self.policy_check_interval = policy_check_interval
+        self._due: List[Tuple[float, str]] = []  # Min-heap of (expiration timestamp, file ID)
+        self._pending: Set[str] = set()  # Entries to check against the policy right away
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_policy_check = 0.0
+
+    def on_map_change(self, events) -> None:
+        """Schedule the entries added to the `files` map, or whose fields changed."""
+        now = time.time()
+        earliest = self._due[0][0] if self._due else None
+
+        for event in events:
+            if event.path:
+                self._schedule(event.path[0], strip_content(event.target), now)
+                continue
+            for file_id, change in event.keys.items():
+                if change["action"] == "delete":
+                    continue  # Stale heap items are skipped when they come due
+                self._schedule(file_id, strip_content(change["newValue"]), now)
+
+        if self._pending or (self._due and self._due[0][0] != earliest):
+            self._wake()
+
+    def _schedule(self, file_id: str, file: dict, now: float) -> None:
+        """Schedule a single entry for its next retention change.
+
+        An entry with a malformed date, e.g. received from a peer, is logged and left unscheduled:
+        this runs in the map's change callback, which must not raise.
+        """
+        try:
+            if get_retention_changes(file, now):
+                self._pending.add(file_id)
+            elif file.get("data_retention_new_exp_date"):
+                due = datetime.fromisoformat(file["data_retention_new_exp_date"]).timestamp()
+                heapq.heappush(self._due, (due, file_id))
+        except (TypeError, ValueError) as e:
+            logger.error(f"Invalid dates in signature '{file_id}', not applying the data retention policy: {e}")
+
+    def _wake(self) -> None:
+        """Wake the scheduler task up, if it is running."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def recompute_all(self) -> None:
+        """Schedule every signature for a check against the current policy."""
+        self._due = []
+        self._pending = {sig["id"] for sig in self._storage.get_signatures_metadata()}
+        self._wake()
+
+    def apply_due(self) -> int:
+        """Apply, in a single transaction, the retention changes of all the entries that are due.
+
+        Returns:
+            int: The number of changed signatures
+        """
+        now = time.time()
+        due, self._pending = self._pending, set()
+        while self._due and self._due[0][0] <= now:
+            due.add(heapq.heappop(self._due)[1])
+
+        updates = {}
+        for file_id in due:
+            file = self._storage.get_signature(file_id)
+            if file is None:
+                continue
+            try:
+                changes = get_retention_changes(file, now)
+            except (TypeError, ValueError) as e:
+                logger.error(f"Invalid dates in signature '{file_id}', not applying the data retention policy: {e}")
+                continue
+            if changes:
+                updates[file_id] = changes
+                if "expiration_date" in changes:
+                    logger.warning(f"File {file['name']} marked as expired due to data retention policy.")
+            elif file.get("data_retention_new_exp_date"):
+                self._schedule(file_id, file, now)
+
+        if updates:
+            self._storage.apply_signature_changes(updates)
+        return len(updates)
+
+    def start(self) -> None:
+        """Start the background scheduler task on the running event loop."""
+        if self._task is None or self._task.done():
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self) -> None:
+        """Stop the background scheduler task."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._wakeup = None
+
+    async def _run(self) -> None:
+        """Sleep until the next retention change is due, or until new entries need to be checked."""
+        self._last_policy_check = time.time()
+        self.recompute_all()
+        while True:
+            now = time.time()
+            if now - self._last_policy_check >= self.policy_check_interval:
+                self._last_policy_check = now
+                if reload_data_retention_config():
+                    logger.info("Data retention policy changed, recomputing all the retention dates.")
+                    self.recompute_all()
+
+            try:
+                self.apply_due()
+            except Exception as e:
+                logger.error(f"Error while applying the data retention policy: {e}")
+
+            timeout = self._last_policy_check + self.policy_check_interval - time.time()
+            if self._due:
+                timeout = min(timeout, self._due[0][0] - time.time())
+            self._wakeup.clear()
+            if self._pending:
+                continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+            except asyncio.TimeoutError:
+                pass
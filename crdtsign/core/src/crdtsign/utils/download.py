@@ -0,0 +1,57 @@
+"""Serving of the materialized files over HTTP."""
+
+import os
+from typing import Optional
+
+from quart.wrappers.response import FileBody
+
+from crdtsign.utils.executor import run_in_thread
+
+DOWNLOAD_BUFFER_SIZE = 1048576  # 1MB
+
+
+class FileRangeBody(FileBody):
+    """Response body streaming a file, or the requested range of it, in large positional reads.
+
+    Quart's `FileBody` reads 8KB at a time and asks for the file position before each
+    read, both through aiofiles, so that a multi-GB file costs hundreds of thousands of
+    thread round trips. Each read here is a single `os.pread()` of `buffer_size` bytes on
+    the thread pool, from the offset tracked by the body itself. The range set by
+    `make_conditional()` (see `Response.make_conditional()`) is inherited from `FileBody`.
+    """
+
+    buffer_size = DOWNLOAD_BUFFER_SIZE
+
+    def __init__(self, file_path: os.PathLike, *, buffer_size: Optional[int] = None) -> None:
+        """Initialize a new FileRangeBody instance.
+
+        Raises:
+            FileNotFoundError: If the file does not exist
+        """
+        super().__init__(file_path, buffer_size=buffer_size)
+        self._fd: Optional[int] = None
+        self._position = 0
+
+    async def __aenter__(self) -> "FileRangeBody":
+        """Open the file, positioned at the beginning of the range."""
+        self._fd = os.open(self.file_path, os.O_RDONLY)
+        self._position = self.begin
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb) -> None:
+        """Close the file."""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    async def __anext__(self) -> bytes:
+        """Read the next block of the range."""
+        if self._position >= self.end:
+            raise StopAsyncIteration()
+        chunk = await run_in_thread(
+            os.pread, self._fd, min(self.buffer_size, self.end - self._position), self._position
+        )
+        if not chunk:
+            raise StopAsyncIteration()
+        self._position += len(chunk)
+        return chunk
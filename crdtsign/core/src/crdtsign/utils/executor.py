@@ -0,0 +1,110 @@
+"""Executors running CPU-bound and blocking work off the event loop."""
+
+import asyncio
+import functools
+import multiprocessing
+import os
+from collections import deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+from crdtsign.config import executor_config
+
+_thread_pool: Optional[ThreadPoolExecutor] = None
+_process_pool: Optional[ProcessPoolExecutor] = None
+_codec_pool: Optional[ThreadPoolExecutor] = None
+
+
+def get_thread_pool() -> ThreadPoolExecutor:
+    """Return the thread pool for work releasing the GIL (hashing, compression, file I/O)."""
+    global _thread_pool
+    if _thread_pool is None:
+        _thread_pool = ThreadPoolExecutor(
+            max_workers=executor_config["thread_workers"], thread_name_prefix="crdtsign-worker"
+        )
+    return _thread_pool
+
+
+def get_process_pool() -> Executor:
+    """Return the process pool for CPU-bound work holding the GIL.
+
+    Falls back to the thread pool when the process pool is disabled (`process_workers: 0`).
+    """
+    global _process_pool
+    if executor_config["process_workers"] == 0:
+        return get_thread_pool()
+    if _process_pool is None:
+        # Forking a process running an event loop and the sync provider threads is unsafe
+        _process_pool = ProcessPoolExecutor(
+            max_workers=executor_config["process_workers"], mp_context=multiprocessing.get_context("spawn")
+        )
+    return _process_pool
+
+
+def get_codec_workers() -> int:
+    """Return the number of threads processing the chunks of a file in parallel."""
+    return executor_config["codec_workers"] or os.cpu_count() or 1
+
+
+def get_codec_pool() -> ThreadPoolExecutor:
+    """Return the thread pool for chunk-level work (compression, decompression, hashing).
+
+    Its tasks never wait for other tasks, so it can be used from the threads of the other pools.
+    """
+    global _codec_pool
+    if _codec_pool is None:
+        _codec_pool = ThreadPoolExecutor(max_workers=get_codec_workers(), thread_name_prefix="crdtsign-codec")
+    return _codec_pool
+
+
+def map_ordered(func: Callable[[Any], Any], items: Iterable[Any], window: Optional[int] = None) -> Iterator[Any]:
+    """Apply a function to each item on the codec pool, yielding the results in order.
+
+    At most `window` items are processed or waiting to be consumed at any time, so that
+    memory stays bounded however large the input is. Exceptions raised by the function
+    are raised again when the corresponding result is reached.
+
+    Args:
+        func: Function to apply, which must not block on other tasks of the codec pool
+        items: Items to process, consumed lazily from the calling thread
+        window: Maximum number of pending items, twice the number of codec threads by default
+    """
+    executor = get_codec_pool()
+    window = window or 2 * get_codec_workers()
+    pending = deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(func, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def shutdown_executors() -> None:
+    """Shut down the executors that were started, cancelling the work not started yet."""
+    global _thread_pool, _process_pool, _codec_pool
+    for executor in (_process_pool, _thread_pool, _codec_pool):
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    _thread_pool = None
+    _process_pool = None
+    _codec_pool = None
+
+
+async def run_in_thread(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a function on the thread pool and wait for its result without blocking the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(get_thread_pool(), functools.partial(func, *args, **kwargs))
+
+
+async def run_in_process(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """Run a function on the process pool and wait for its result without blocking the event loop.
+
+    The function and its arguments must be picklable.
+    """
+    return await asyncio.get_running_loop().run_in_executor(
+        get_process_pool(), functools.partial(func, *args, **kwargs)
+    )
@@ -1,28 +1,220 @@
 """Methods related to file management."""
 
+import base64
 import hashlib
 import os
-from typing import List, Optional
+import zlib
+from typing import Iterator, List, Optional, Union
 
 import lz4.frame
 from loguru import logger
 
+from crdtsign.config import storage_config
+from crdtsign.utils.executor import map_ordered, run_in_thread
+
 CHUNK_SIZE = 65536  # 64KB
 
+# Codecs of the compressed chunks, recorded in the first byte of each chunk payload
+CODEC_NONE = 0
+CODEC_LZ4 = 1
+CODEC_ZLIB = 2
+CODECS = {"none": CODEC_NONE, "lz4": CODEC_LZ4, "zlib": CODEC_ZLIB}
+
+# Chunks written by earlier versions are bare lz4 frames, without codec byte
+LZ4_FRAME_MAGIC = b"\x04\x22\x4d\x18"
+
+# Size of the sample compressed to estimate whether compressing a chunk is worth it
+ADAPTIVE_SAMPLE_SIZE = 4096
+
+# Layouts of the serialized chunks, recorded in the `content_format` field of embedded files.
+# The payloads of the layouts written by earlier versions are bare lz4 frames
+CONTENT_FORMAT_LZ4_HEX = 1  # lz4 frames as hex strings (files without `content_format`)
+CONTENT_FORMAT_LZ4_BASE85 = 2  # lz4 frames as base85 strings
+CONTENT_FORMAT_LZ4_BINARY = 3  # lz4 frames as raw bytes
+# The payloads of the current layouts start with the byte of their codec, see `ChunkCodec`
+CONTENT_FORMAT_HEX = 4  # chunk payloads as hex strings
+CONTENT_FORMAT_BASE85 = 5  # chunk payloads as base85 strings
+CONTENT_FORMAT_BINARY = 6  # chunk payloads as raw bytes
+CONTENT_FORMATS = {"hex": CONTENT_FORMAT_HEX, "base85": CONTENT_FORMAT_BASE85, "binary": CONTENT_FORMAT_BINARY}
+
+# Content format -> (encoding of the payloads, as a legacy format, and whether they start with a codec byte)
+_LAYOUTS = {
+    CONTENT_FORMAT_LZ4_HEX: (CONTENT_FORMAT_LZ4_HEX, False),
+    CONTENT_FORMAT_LZ4_BASE85: (CONTENT_FORMAT_LZ4_BASE85, False),
+    CONTENT_FORMAT_LZ4_BINARY: (CONTENT_FORMAT_LZ4_BINARY, False),
+    CONTENT_FORMAT_HEX: (CONTENT_FORMAT_LZ4_HEX, True),
+    CONTENT_FORMAT_BASE85: (CONTENT_FORMAT_LZ4_BASE85, True),
+    CONTENT_FORMAT_BINARY: (CONTENT_FORMAT_LZ4_BINARY, True),
+}
+
+SerializedChunk = Union[str, bytes]
+
+
+class ChunkCodec:
+    """Compression of file chunks, with the codec of each chunk recorded in its payload.
+
+    Payloads start with a byte identifying the codec used for the rest of the payload,
+    so that chunks compressed with any codec (or stored raw) can be read back whatever the
+    current configuration. In adaptive mode, a sample taken from the middle of each chunk
+    is compressed first, and the chunk is stored raw if the sample does not shrink by at
+    least `min_savings`: already compressed content (PDF, ZIP, JPEG...) is then never
+    compressed in full, and costs no decompression when read.
+    """
+
+    def __init__(self, codec: str = "lz4", level: int = 0, adaptive: bool = True, min_savings: float = 0.1):
+        """Initialize a new ChunkCodec instance.
+
+        Args:
+            codec: Name of the codec, one of `CODECS`
+            level: Compression level, 0 for the default level of the codec
+            adaptive: Whether to store chunks raw when compression does not pay off
+            min_savings: Minimum fraction of the size saved by compression for a chunk to be stored compressed
+        """
+        if codec not in CODECS:
+            raise ValueError(f"Unsupported codec '{codec}'.")
+        self.codec = CODECS[codec]
+        self.level = level
+        self.adaptive = adaptive
+        self.min_savings = min_savings
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ChunkCodec":
+        """Create the codec described by the `compression_*` settings of storage.yaml."""
+        return cls(
+            codec=config["compression_codec"],
+            level=config["compression_level"],
+            adaptive=config["adaptive_compression"],
+            min_savings=config["compression_min_savings"],
+        )
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.codec == CODEC_LZ4:
+            return lz4.frame.compress(data, compression_level=self.level)
+        return zlib.compress(data, self.level or -1)
+
+    def _pays_off(self, original_size: int, compressed_size: int) -> bool:
+        return compressed_size <= original_size * (1 - self.min_savings)
+
+    def compress(self, chunk: bytes) -> bytes:
+        """Compress a chunk into a payload starting with the byte of the codec used."""
+        if self.codec == CODEC_NONE:
+            return bytes([CODEC_NONE]) + chunk
+
+        if self.adaptive and len(chunk) > 2 * ADAPTIVE_SAMPLE_SIZE:
+            start = (len(chunk) - ADAPTIVE_SAMPLE_SIZE) // 2
+            sample = chunk[start : start + ADAPTIVE_SAMPLE_SIZE]
+            if not self._pays_off(len(sample), len(self._compress(sample))):
+                return bytes([CODEC_NONE]) + chunk
+
+        compressed = self._compress(chunk)
+        if self.adaptive and not self._pays_off(len(chunk), len(compressed)):
+            return bytes([CODEC_NONE]) + chunk
+        return bytes([self.codec]) + compressed
+
+    @staticmethod
+    def decompress(payload: bytes, legacy: Optional[bool] = None) -> bytes:
+        """Restore a chunk from its payload, whichever codec it was compressed with.
+
+        Args:
+            payload: The payload of the chunk
+            legacy: Whether the payload is a bare lz4 frame written by an earlier version, or
+                    starts with a codec byte. When unknown, e.g. for stored blobs, which record
+                    no layout, it is detected from the lz4 magic number, which starts with no
+                    codec byte.
+
+        Raises:
+            ValueError: If the payload is corrupted or uses an unknown codec
+        """
+        payload = memoryview(payload)
+        if legacy is None:
+            legacy = payload[:4] == LZ4_FRAME_MAGIC
+        if legacy:
+            codec, body = CODEC_LZ4, payload
+        elif len(payload) > 0:
+            codec, body = payload[0], payload[1:]
+        else:
+            raise ValueError("Empty chunk payload.")
+
+        try:
+            if codec == CODEC_NONE:
+                return bytes(body)
+            if codec == CODEC_LZ4:
+                return lz4.frame.decompress(body)
+            if codec == CODEC_ZLIB:
+                return zlib.decompress(body)
+        except (RuntimeError, zlib.error) as e:
+            raise ValueError(f"Corrupted chunk payload: {e}") from e
+        raise ValueError(f"Unsupported chunk codec {codec}.")
+
+
+default_codec = ChunkCodec.from_config(storage_config)
 
-def serialize_file(file_path: os.PathLike, chunk_size: Optional[int] = CHUNK_SIZE) -> List[str]:
-    """Serialize the file by splitting it compressed chunks."""
-    serialized_file = []
 
+def encode_chunk(
+    chunk: bytes, content_format: int = CONTENT_FORMAT_LZ4_HEX, codec: Optional[ChunkCodec] = None
+) -> SerializedChunk:
+    """Compress a single file chunk into its serialized form, according to the given layout.
+
+    The chunk is compressed with the given codec, or the one configured in storage.yaml, or
+    into a bare lz4 frame for the layouts of earlier versions.
+    """
+    if content_format not in _LAYOUTS:
+        raise ValueError(f"Unsupported content format {content_format}.")
+    encoding, has_codec_byte = _LAYOUTS[content_format]
+    compressed = (codec or default_codec).compress(chunk) if has_codec_byte else lz4.frame.compress(chunk)
+    if encoding == CONTENT_FORMAT_LZ4_BINARY:
+        return compressed
+    if encoding == CONTENT_FORMAT_LZ4_BASE85:
+        return base64.b85encode(compressed).decode("ascii")
+    return compressed.hex()
+
+
+def decode_chunk(serialized_chunk: SerializedChunk, content_format: int = CONTENT_FORMAT_LZ4_HEX) -> bytes:
+    """Restore a single file chunk from its serialized form, according to the given layout."""
+    content_format = int(content_format)
+    if content_format not in _LAYOUTS:
+        raise ValueError(f"Unsupported content format {content_format}.")
+    encoding, has_codec_byte = _LAYOUTS[content_format]
+    if encoding == CONTENT_FORMAT_LZ4_BINARY:
+        payload = bytes(serialized_chunk)
+    elif encoding == CONTENT_FORMAT_LZ4_BASE85:
+        payload = base64.b85decode(serialized_chunk)
+    else:
+        payload = bytes.fromhex(serialized_chunk)
+    return ChunkCodec.decompress(payload, legacy=not has_codec_byte)
+
+
+def compress_chunk(chunk: bytes) -> str:
+    """Compress a single file chunk into its serialized (hex-encoded lz4 frame) form."""
+    return encode_chunk(chunk, CONTENT_FORMAT_LZ4_HEX)
+
+
+def decompress_chunk(serialized_chunk: str) -> bytes:
+    """Restore a single file chunk from its serialized (hex-encoded lz4 frame) form."""
+    return decode_chunk(serialized_chunk, CONTENT_FORMAT_LZ4_HEX)
+
+
+def iter_file_chunks(file, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Read a binary file-like object lazily, one chunk at a time."""
+    while True:
+        chunk = file.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+def serialize_file(
+    file_path: os.PathLike, chunk_size: Optional[int] = CHUNK_SIZE, content_format: int = CONTENT_FORMAT_LZ4_HEX
+) -> List[SerializedChunk]:
+    """Serialize the file by splitting it compressed chunks.
+
+    The chunks are compressed in parallel on the codec pool while the file is being read.
+    """
     try:
         with open(file_path, "rb") as f:
-            while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
-                    break
-
-                chunk = lz4.frame.compress(chunk)
-                serialized_file.append(chunk.hex())
+            serialized_file = list(
+                map_ordered(lambda chunk: encode_chunk(chunk, content_format), iter_file_chunks(f, chunk_size))
+            )
 
         logger.info("File serialization complete.")
         return serialized_file
@@ -35,33 +227,51 @@ def serialize_file(file_path: os.PathLike, chunk_size: Optional[int] = CHUNK_SIZ
 
 
 def deserialize_file(
-    input_file: List[str],
+    input_file: List[SerializedChunk],
     to_file: os.PathLike,
     check_hash: Optional[str] = None,
-    block_size: Optional[int] = CHUNK_SIZE,
-):
-    """Reconstruct the original file starting from a serialized copy."""
+    content_format: int = CONTENT_FORMAT_LZ4_HEX,
+) -> bool:
+    """Reconstruct the original file starting from a serialized copy.
+
+    The chunks are decompressed in parallel on the codec pool, then written in order
+    and hashed as they are written, so that verifying the file needs no second read.
+    `content_format` is the layout recorded with the file, hex-encoded chunks if missing.
+
+    Returns:
+        bool: True if the file was written (and matches `check_hash`, when given), False otherwise
+    """
+    hasher = hashlib.sha256()
     try:
         with open(to_file, "wb") as f:
-            for chunk in input_file:
-                f.write(lz4.frame.decompress(bytes.fromhex(chunk)))
+            for chunk in map_ordered(lambda serialized: decode_chunk(serialized, content_format), input_file):
+                hasher.update(chunk)
+                f.write(chunk)
         logger.info(f"File successfully deserialized as '{to_file}'.")
+    except Exception as e:
+        logger.error(f"Error occured while deserializing file: {e}")
+        return False
 
-        if check_hash:
-            logger.info("Starting file integrity verification...")
-            hasher = hashlib.new("sha256")
+    if check_hash:
+        if hasher.hexdigest() != check_hash:
+            logger.warning("Deserialized file is NOT VALID.")
+            return False
+        logger.info("Deserialized file is VALID.")
+    return True
 
-            with open(to_file, "rb") as f:
-                while True:
-                    block = f.read(block_size)
-                    if not block:
-                        break
-                    hasher.update(block)
 
-            if hasher.hexdigest() == check_hash:
-                logger.info("Deserialized file is VALID.")
-            else:
-                logger.warning("Deserialized file is NOT VALID.")
+async def serialize_file_async(
+    file_path: os.PathLike, chunk_size: Optional[int] = CHUNK_SIZE, content_format: int = CONTENT_FORMAT_LZ4_HEX
+) -> List[SerializedChunk]:
+    """Run `serialize_file()` on the thread pool, without blocking the event loop."""
+    return await run_in_thread(serialize_file, file_path, chunk_size, content_format)
 
-    except Exception as e:
-        logger.error(f"Error occured while deserializing file: {e}")
+
+async def deserialize_file_async(
+    input_file: List[SerializedChunk],
+    to_file: os.PathLike,
+    check_hash: Optional[str] = None,
+    content_format: int = CONTENT_FORMAT_LZ4_HEX,
+) -> bool:
+    """Run `deserialize_file()` on the thread pool, without blocking the event loop."""
+    return await run_in_thread(deserialize_file, input_file, to_file, check_hash, content_format)
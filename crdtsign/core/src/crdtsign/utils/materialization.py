@@ -0,0 +1,245 @@
+"""Background materialization of the signed files received from other peers."""
+
+import asyncio
+import os
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from werkzeug.security import safe_join
+
+from crdtsign.sign import get_file_hash_async
+
+# Fields of a signature entry determining the content or the location of its file on disk
+MATERIALIZED_FIELDS = ("name", "hash", "user_id", "file_content", "file_manifest", "content_format")
+
+# Delay in seconds before a failed file is materialized again, doubled after each failure
+RETRY_INITIAL_DELAY = 1.0
+RETRY_MAX_DELAY = 300.0
+
+
+class FileMaterializer:
+    """Write the files of the signatures to `<root>/<user ID>/<file name>` as they arrive.
+
+    Entries added to the `files` map, or whose content or location changed, are queued as
+    their change events arrive, and written by a bounded number of worker tasks, whose
+    decompression and hashing run on the executors. Files already on disk with the
+    expected hash are skipped; the hash of each file is cached along with its size and
+    modification time, so that unchanged files are only hashed once. Files which could not
+    be materialized, e.g. because their chunks are not on the sync server yet, are queued
+    again after a delay doubling with each failure.
+    """
+
+    def __init__(self, storage, workers: int = 2, root: os.PathLike = ".storage/uploads"):
+        """Initialize a new FileMaterializer instance.
+
+        Args:
+            storage: The FileSignatureStorage whose files are materialized
+            workers: Maximum number of files materialized concurrently
+            root: Directory where the files are written
+        """
+        self._storage = storage
+        self.workers = workers
+        self.root = Path(root)
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._pending: Set[str] = set()  # Queued file IDs
+        self._in_progress: Set[str] = set()
+        self._requeue: Set[str] = set()  # File IDs changed while being materialized
+        self._hashes: Dict[Path, Tuple[Tuple[int, int], str]] = {}  # Path -> ((size, mtime), hash)
+        self._hashing: Dict[Tuple[Path, Tuple[int, int]], asyncio.Future] = {}  # (path, (size, mtime)) -> hash
+        self._failures: Dict[str, int] = {}  # File ID -> consecutive failures
+        self._retries: Dict[str, asyncio.TimerHandle] = {}  # File ID -> scheduled retry
+        self.materialized = 0
+        self.skipped = 0
+        self.failed = 0
+
+    @property
+    def progress(self) -> Dict[str, int]:
+        """Number of files waiting, being materialized or retried, and materialized, skipped or failed so far."""
+        return {
+            "pending": len(self._pending),
+            "in_progress": len(self._in_progress),
+            "retrying": len(self._retries),
+            "materialized": self.materialized,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+    def path_for(self, file: dict) -> Path:
+        """Return the path where the file of a signature is materialized.
+
+        Raises:
+            ValueError: If the user ID or file name would escape the materialization directory
+        """
+        path = safe_join(str(self.root), file["user_id"], file["name"])
+        if path is None:
+            raise ValueError(f"Unsafe path for file '{file['name']}' of user '{file['user_id']}'.")
+        return Path(path)
+
+    def on_map_change(self, events) -> None:
+        """Queue the entries added to the `files` map, or whose content or location changed."""
+        for event in events:
+            if event.path:
+                if any(key in MATERIALIZED_FIELDS for key in event.keys):
+                    self.schedule(event.path[0])
+                continue
+            for file_id, change in event.keys.items():
+                if change["action"] == "delete":
+                    self._pending.discard(file_id)  # Skipped if already queued
+                else:
+                    self.schedule(file_id)
+
+    def schedule(self, file_id: str) -> None:
+        """Queue a file for materialization, unless it is already waiting."""
+        if file_id in self._in_progress:
+            self._requeue.add(file_id)
+            return
+        if file_id in self._pending:
+            return
+        self._pending.add(file_id)
+        if self._queue is not None:
+            self._queue.put_nowait(file_id)
+
+    def schedule_all(self) -> None:
+        """Queue every signature, e.g. to check the files on disk at startup."""
+        for sig in self._storage.get_signatures_metadata():
+            self.schedule(sig["id"])
+
+    async def is_on_disk(self, path: Path, file_hash: str) -> bool:
+        """Check whether a file exists with the given hash, hashing it only if it changed.
+
+        The hash is cached along with the size and modification time of the file, and
+        concurrent checks of the same file (e.g. parallel downloads) share a single hashing.
+        """
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return False
+        key = (stat.st_size, stat.st_mtime_ns)
+        cached = self._hashes.get(path)
+        if cached is None or cached[0] != key:
+            hashing = self._hashing.get((path, key))
+            if hashing is None:
+                hashing = asyncio.ensure_future(get_file_hash_async(path))
+                self._hashing[(path, key)] = hashing
+                hashing.add_done_callback(lambda _: self._hashing.pop((path, key), None))
+            try:
+                cached = (key, await asyncio.shield(hashing))
+            except FileNotFoundError:
+                return False
+            self._hashes[path] = cached
+        return cached[1] == file_hash
+
+    async def materialize(self, file_id: str) -> Optional[bool]:
+        """Write the file of a signature to disk, if it is not already there.
+
+        Returns:
+            bool: True if the file was written, False if it failed, None if it was skipped
+        """
+        file = self._storage.get_signature(file_id)
+        if file is None:
+            return None
+
+        path = self.path_for(file)
+        if await self.is_on_disk(path, file["hash"]):
+            self.skipped += 1
+            return None
+
+        file = self._storage.get_signature(file_id, include_content=True)
+        if file is None:
+            return None
+        os.makedirs(path.parent, exist_ok=True)
+        if await self._storage.materialize_file(file, path):
+            stat = path.stat()
+            self._hashes[path] = ((stat.st_size, stat.st_mtime_ns), file["hash"])
+            self.materialized += 1
+            logger.info(f"Materialized file '{file['name']}' ({len(self._pending)} remaining).")
+            return True
+
+        self.failed += 1
+        return False
+
+    def _schedule_retry(self, file_id: str) -> None:
+        """Queue a failed file again once its backoff delay has elapsed, if the workers are running."""
+        failures = self._failures.get(file_id, 0) + 1
+        self._failures[file_id] = failures
+        if self._queue is None:
+            return  # Queued again by the next start()
+
+        previous = self._retries.pop(file_id, None)
+        if previous is not None:
+            previous.cancel()
+        delay = min(RETRY_INITIAL_DELAY * 2 ** (failures - 1), RETRY_MAX_DELAY)
+        logger.info(f"Retrying to materialize file '{file_id}' in {delay:.0f}s.")
+        self._retries[file_id] = asyncio.get_running_loop().call_later(delay, self._retry, file_id)
+
+    def _retry(self, file_id: str) -> None:
+        """Queue a file whose backoff delay has elapsed."""
+        self._retries.pop(file_id, None)
+        self.schedule(file_id)
+
+    async def _materialize_safely(self, file_id: str) -> None:
+        """Materialize a file, logging any error, and queue it again if it changed meanwhile or failed."""
+        self._in_progress.add(file_id)
+        result = False
+        try:
+            result = await self.materialize(file_id)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error while materializing file '{file_id}': {e}")
+        finally:
+            self._in_progress.discard(file_id)
+        if file_id in self._requeue:
+            self._requeue.discard(file_id)
+            self.schedule(file_id)
+        elif result is False:
+            self._schedule_retry(file_id)
+        if result is not False:
+            self._failures.pop(file_id, None)
+
+    async def materialize_all(self) -> Dict[str, int]:
+        """Materialize every file right away, with at most `workers` files at a time.
+
+        Returns:
+            Dict[str, int]: The progress counters once done
+        """
+        semaphore = asyncio.Semaphore(self.workers)
+
+        async def bounded(file_id):
+            async with semaphore:
+                await self._materialize_safely(file_id)
+
+        await asyncio.gather(*(bounded(sig["id"]) for sig in self._storage.get_signatures_metadata()))
+        return self.progress
+
+    def start(self) -> None:
+        """Start the worker tasks on the running event loop, and queue every signature."""
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue()
+        for file_id in self._pending:
+            self._queue.put_nowait(file_id)
+        self.schedule_all()
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._run()) for _ in range(self.workers)]
+
+    def stop(self) -> None:
+        """Stop the worker tasks, the queued and failed files are materialized again on the next start."""
+        for task in self._tasks:
+            task.cancel()
+        for handle in self._retries.values():
+            handle.cancel()
+        self._tasks = []
+        self._retries = {}
+        self._queue = None
+
+    async def _run(self) -> None:
+        """Materialize the queued files one at a time."""
+        queue = self._queue
+        while True:
+            file_id = await queue.get()
+            if file_id not in self._pending:
+                continue  # Deleted while waiting
+            self._pending.discard(file_id)
+            await self._materialize_safely(file_id)
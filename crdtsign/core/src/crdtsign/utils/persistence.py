@@ -0,0 +1,242 @@
+"""Append-only persistence of CRDT document updates."""
+
+import asyncio
+import os
+import struct
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from loguru import logger
+from pycrdt import Doc
+
+RECORD_HEADER = struct.Struct("<I")  # Length of the update that follows
+
+
+class UpdateLog:
+    """Persist a CRDT document as a snapshot plus an append-only log of incremental updates.
+
+    Every transaction only appends its own update to the log, instead of rewriting the
+    whole document state. Once the log grows past `compaction_threshold` bytes, it is
+    folded into a new snapshot in the background.
+
+    Compaction first rotates the log, so that updates written while the new snapshot is
+    being saved go to a fresh log. Since applying the same update twice has no effect,
+    a compaction interrupted at any point leaves a state that still loads correctly, and
+    the rotated log it leaves behind is folded into the snapshot on the next load. A
+    record left partially written at the end of the log is truncated away before anything
+    is appended after it.
+    """
+
+    def __init__(self, snapshot_path: os.PathLike, compaction_threshold: int = 4 * 1024 * 1024):
+        """Initialize a new UpdateLog instance.
+
+        Args:
+            snapshot_path: Path of the snapshot file, the log is kept next to it with a `.log` suffix
+            compaction_threshold: Size of the log in bytes above which it is compacted into the snapshot
+        """
+        self.snapshot_path = Path(snapshot_path)
+        self.log_path = self.snapshot_path.with_suffix(".log")
+        self.compacting_path = self.snapshot_path.with_suffix(".log.compacting")
+        self.compaction_threshold = compaction_threshold
+        self._compaction_task: Optional[asyncio.Task] = None
+        self._log_checked = False  # Whether a truncated trailing record was removed from the log
+
+    def exists(self) -> bool:
+        """Check whether any persisted state is available."""
+        return any(p.exists() for p in (self.snapshot_path, self.compacting_path, self.log_path))
+
+    @staticmethod
+    def _read_records(path: Path) -> List[bytes]:
+        """Read the updates stored in a log file, truncating the file after its last complete record."""
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return []
+
+        records = []
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            (length,) = RECORD_HEADER.unpack_from(data, offset)
+            start = offset + RECORD_HEADER.size
+            if start + length > len(data):
+                break
+            records.append(data[start : start + length])
+            offset = start + length
+
+        if offset != len(data):
+            # Records appended after a truncated one would be unreadable
+            logger.warning(f"Removing truncated record at the end of '{path}'.")
+            os.truncate(path, offset)
+        return records
+
+    def load(self, doc: Doc) -> None:
+        """Apply the snapshot and all the logged updates to the given document.
+
+        A log left behind by an interrupted compaction is folded into a new snapshot.
+        """
+        if self.snapshot_path.exists():
+            with open(self.snapshot_path, "rb") as f:
+                doc.apply_update(f.read())
+
+        for path in (self.compacting_path, self.log_path):
+            for update in self._read_records(path):
+                doc.apply_update(update)
+        self._log_checked = True
+
+        if self.compacting_path.exists():
+            logger.info(f"Folding the log of an interrupted compaction into '{self.snapshot_path}'.")
+            self.write_snapshot(doc)
+
+    def log_size(self) -> int:
+        """Return the size in bytes of the log not yet compacted."""
+        return self.log_path.stat().st_size if self.log_path.exists() else 0
+
+    def append(self, update: bytes) -> None:
+        """Append an incremental update to the log."""
+        self.append_many([update])
+
+    def append_many(self, updates: Iterable[bytes]) -> None:
+        """Append several incremental updates to the log in a single write."""
+        records = b"".join(RECORD_HEADER.pack(len(update)) + update for update in updates)
+        if not records:
+            return
+
+        os.makedirs(self.log_path.parent, exist_ok=True)
+        if not self._log_checked:
+            self._read_records(self.log_path)
+            self._log_checked = True
+
+        # Make sure a snapshot exists, so that the persisted state can be detected and loaded
+        if not self.snapshot_path.exists():
+            self._write_snapshot(Doc().get_update())
+
+        with open(self.log_path, "ab") as f:
+            f.write(records)
+
+    def _write_snapshot(self, doc_update: bytes) -> None:
+        """Atomically replace the snapshot with the given document state."""
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(doc_update)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+    def write_snapshot(self, doc: Doc) -> None:
+        """Save the full state of the document as the snapshot and discard the log."""
+        os.makedirs(self.snapshot_path.parent, exist_ok=True)
+        self._write_snapshot(doc.get_update())
+        for path in (self.compacting_path, self.log_path):
+            path.unlink(missing_ok=True)
+
+    async def compact(self, doc: Doc) -> None:
+        """Fold the current log into a new snapshot, without blocking the event loop on disk I/O."""
+        if not self.log_path.exists():
+            return
+        # A rotated log left behind by an interrupted compaction is about to be replaced
+        for update in self._read_records(self.compacting_path):
+            doc.apply_update(update)
+
+        # The document state taken now contains every update written to the log so far
+        os.replace(self.log_path, self.compacting_path)
+        doc_update = doc.get_update()
+
+        await asyncio.to_thread(self._write_snapshot, doc_update)
+        self.compacting_path.unlink(missing_ok=True)
+        logger.info(f"Compacted update log into '{self.snapshot_path}' ({len(doc_update)} bytes).")
+
+    def maybe_compact(self, doc: Doc) -> None:
+        """Start a background compaction if the log has grown past the threshold."""
+        if self.log_size() < self.compaction_threshold:
+            return
+        if self._compaction_task is not None and not self._compaction_task.done():
+            return
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (e.g. CLI usage): compact synchronously
+            self.write_snapshot(doc)
+            return
+        self._compaction_task = loop.create_task(self.compact(doc))
+
+
+class SaveScheduler:
+    """Coalesce bursts of save requests into a single write.
+
+    A save happens once no new request has been made for `debounce` seconds, and at the
+    latest `max_latency` seconds after the first request that has not been saved yet.
+    """
+
+    def __init__(self, save: Callable[[], None], debounce: float = 0.2, max_latency: float = 2.0):
+        """Initialize a new SaveScheduler instance.
+
+        Args:
+            save: Function performing the actual (durable) write
+            debounce: Quiet period in seconds after the last request before saving
+            max_latency: Maximum delay in seconds between a request and the corresponding save
+        """
+        self._save = save
+        self.debounce = debounce
+        self.max_latency = max_latency
+        self.pending_writes = 0  # Save requests not yet written
+        self.flushed_writes = 0  # Actual writes performed
+        self._first_request: Optional[float] = None
+        self._last_request: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        """Number of pending save requests and of writes performed so far."""
+        return {"pending_writes": self.pending_writes, "flushed_writes": self.flushed_writes}
+
+    def request(self) -> None:
+        """Request a save, which is delayed so that it can be merged with the following requests.
+
+        Without a running event loop, the request stays pending until the next `flush()`.
+        """
+        self.pending_writes += 1
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+
+        now = loop.time()
+        if self._first_request is None:
+            self._first_request = now
+        self._last_request = now
+
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._wait_and_flush())
+
+    async def _wait_and_flush(self) -> None:
+        """Wait until the debounce period or the maximum latency has elapsed, then save."""
+        loop = asyncio.get_running_loop()
+        while self._first_request is not None:
+            deadline = min(self._last_request + self.debounce, self._first_request + self.max_latency)
+            delay = deadline - loop.time()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+        self._task = None
+        self.flush()
+
+    def flush(self, force: bool = False) -> None:
+        """Perform the pending save right away, if any.
+
+        Args:
+            force: Save even if no request is pending
+        """
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        self._task = None
+        self._first_request = None
+        self._last_request = None
+
+        if self.pending_writes == 0 and not force:
+            return
+        self.pending_writes = 0
+        self._save()
+        self.flushed_writes += 1
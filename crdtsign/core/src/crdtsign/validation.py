@@ -0,0 +1,237 @@
+"""Validation of many file signatures at once, with the Ed25519 checks spread across processes."""
+
+import asyncio
+from concurrent.futures import Executor
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Dict, Iterable, List, Optional, Tuple
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+from loguru import logger
+
+from crdtsign.sign import is_verified_signature, load_public_key
+from crdtsign.utils.cache import LRUCache
+from crdtsign.utils.executor import get_process_pool, get_thread_pool
+
+# Number of signatures verified by a worker process per task, to amortize the inter-process overhead
+VERIFY_BATCH_SIZE = 256
+
+# Fields of a signature entry on which the outcome of its verification depends
+VERIFIED_FIELDS = ("hash", "signature", "user_id")
+
+
+def verify_signatures(items: List[Tuple[str, str, str]]) -> List[bool]:
+    """Verify a batch of signatures, meant to run in a worker process.
+
+    Args:
+        items: (file hash, signature, public key) triplets, all hex-encoded
+
+    Returns:
+        List[bool]: Whether each signature is valid, in the same order
+    """
+    results = []
+    for file_hash, signature, public_key in items:
+        try:
+            results.append(
+                is_verified_signature(
+                    bytes.fromhex(file_hash), bytes.fromhex(signature), load_public_key(bytes.fromhex(public_key))
+                )
+            )
+        except ValueError:
+            # Malformed hash, signature or key
+            results.append(False)
+    return results
+
+
+def is_signature_expired(sig: dict, now: Optional[datetime] = None) -> bool:
+    """Check whether a signature has passed its expiration date.
+
+    Both dates are compared as wall-clock times, as done by `/api/validate/<file_id>`.
+    """
+    if "expiration_date" not in sig:
+        return False
+    now = datetime.now() if now is None else now
+    expiration_date = datetime.fromisoformat(sig["expiration_date"])
+    return now.replace(tzinfo=timezone.utc) > expiration_date.replace(tzinfo=timezone.utc)
+
+
+class VerificationCache:
+    """Cache of parsed public keys and of signature verification outcomes.
+
+    Public keys are cached by user ID and dropped when the user changes in the `users`
+    map. Outcomes are cached by (hash, signature, public key), so that a changed key or
+    entry can never hit a stale outcome, and dropped when their signature changes or is
+    removed from the `files` map. Register `on_users_change()` and `on_files_change()`
+    as observers of these maps (the latter with `observe_deep()`).
+    """
+
+    def __init__(
+        self,
+        get_public_key: Callable[[str], Optional[str]],
+        max_public_keys: int = 1024,
+        max_results: int = 65536,
+    ):
+        """Initialize an empty VerificationCache.
+
+        Args:
+            get_public_key: Function returning the hex-encoded public key of a user ID, None if unknown
+            max_public_keys: Maximum number of cached public keys
+            max_results: Maximum number of cached verification outcomes
+        """
+        self._get_public_key = get_public_key
+        self.public_keys = LRUCache(max_public_keys)  # User ID -> (hex-encoded key, parsed key)
+        self.results = LRUCache(max_results)  # (hash, signature, public key) -> outcome
+        self._result_keys: Dict[str, Tuple[str, str, str]] = {}  # File ID -> key of its cached outcome
+
+    def get_public_key(self, user_id: str) -> Optional[Tuple[str, Ed25519PublicKey]]:
+        """Return the hex-encoded and parsed public key of a user, None if unknown or invalid."""
+        cached = self.public_keys.get(user_id)
+        if cached is None:
+            public_key_hex = self._get_public_key(user_id)
+            if public_key_hex is None:
+                return None
+            try:
+                cached = (public_key_hex, load_public_key(bytes.fromhex(public_key_hex)))
+            except ValueError:
+                logger.warning(f"Invalid public key for user {user_id}.")
+                return None
+            self.public_keys.put(user_id, cached)
+        return cached
+
+    def get_result(self, sig: dict, public_key_hex: str) -> Optional[bool]:
+        """Return the cached verification outcome of a signature, None if not cached."""
+        return self.results.get((sig["hash"], sig["signature"], public_key_hex))
+
+    def put_result(self, sig: dict, public_key_hex: str, is_valid: bool) -> None:
+        """Cache the verification outcome of a signature."""
+        key = (sig["hash"], sig["signature"], public_key_hex)
+        self.results.put(key, is_valid)
+        self._result_keys[sig["id"]] = key
+
+    def verify(self, sig: dict) -> Optional[bool]:
+        """Verify a signature, reusing the cached key and outcome if available.
+
+        Returns:
+            bool: Whether the signature is authentic, or None if the signer's public key is unknown
+        """
+        public_key = self.get_public_key(sig["user_id"])
+        if public_key is None:
+            return None
+        public_key_hex, parsed_key = public_key
+
+        is_valid = self.get_result(sig, public_key_hex)
+        if is_valid is None:
+            try:
+                is_valid = is_verified_signature(
+                    bytes.fromhex(sig["hash"]), bytes.fromhex(sig["signature"]), parsed_key
+                )
+            except ValueError:
+                is_valid = False
+            self.put_result(sig, public_key_hex, is_valid)
+        return is_valid
+
+    def invalidate_signature(self, file_id: str) -> None:
+        """Drop the cached verification outcome of a signature."""
+        key = self._result_keys.pop(file_id, None)
+        if key is not None:
+            self.results.pop(key)
+
+    def on_files_change(self, events) -> None:
+        """Drop the outcomes of the signatures removed, replaced or re-signed in the `files` map."""
+        for event in events:
+            if event.path:
+                if any(key in VERIFIED_FIELDS for key in event.keys):
+                    self.invalidate_signature(event.path[0])
+                continue
+            for file_id in event.keys:
+                self.invalidate_signature(file_id)
+
+    def on_users_change(self, event) -> None:
+        """Drop the cached public keys of the users changed in the `users` map."""
+        for user_id in event.keys:
+            self.public_keys.pop(user_id)
+
+
+async def validate_signatures(
+    signatures: Iterable[dict],
+    get_public_key: Callable[[str], Optional[str]],
+    executor: Optional[Executor] = None,
+    batch_size: int = VERIFY_BATCH_SIZE,
+    cache: Optional[VerificationCache] = None,
+) -> AsyncIterator[dict]:
+    """Validate signatures by checking both authenticity and expiration status.
+
+    The Ed25519 checks run in batches on the process pool, and the results of each
+    batch are yielded as soon as it completes, so not necessarily in input order.
+    A single batch is verified in a thread instead, as it would not be worth
+    starting worker processes for it.
+
+    Args:
+        signatures: Signature metadata, as returned by `FileSignatureStorage.get_signature()`
+        get_public_key: Function returning the hex-encoded public key of a user ID, None if unknown
+        executor: Executor running the verification batches, the shared process pool by default
+        batch_size: Number of signatures per verification batch
+        cache: Cache whose outcomes are reused, and completed with the outcomes of the verified signatures
+
+    Yields:
+        dict: The ID, name and signer of each signature with its `is_valid` and `is_expired` status
+    """
+    loop = asyncio.get_running_loop()
+    now = datetime.now()
+
+    batches = []
+    batch = []
+    for sig in signatures:
+        result = {
+            "id": sig["id"],
+            "name": sig.get("name"),
+            "user_id": sig.get("user_id"),
+            "is_expired": is_signature_expired(sig, now),
+        }
+        public_key = get_public_key(sig["user_id"])
+        if public_key is None:
+            result.update(is_valid=False, error="Public key not found")
+            yield result
+            continue
+
+        if cache is not None:
+            is_valid = cache.get_result(sig, public_key)
+            if is_valid is not None:
+                result["is_valid"] = is_valid and not result["is_expired"]
+                yield result
+                continue
+
+        batch.append((result, sig, (sig["hash"], sig["signature"], public_key)))
+        if len(batch) == batch_size:
+            batches.append(batch)
+            batch = []
+    if batch:
+        batches.append(batch)
+
+    if not batches:
+        return
+    if executor is None:
+        executor = get_process_pool() if len(batches) > 1 else get_thread_pool()
+
+    async def verify_batch(batch):
+        try:
+            outcomes = await loop.run_in_executor(executor, verify_signatures, [item for _, _, item in batch])
+        except Exception as e:
+            logger.error(f"Error while verifying a batch of {len(batch)} signatures: {e}")
+            outcomes = None
+        return batch, outcomes
+
+    tasks = [asyncio.ensure_future(verify_batch(batch)) for batch in batches]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            batch, outcomes = await next_done
+            for i, (result, sig, (_, _, public_key)) in enumerate(batch):
+                if outcomes is None:
+                    result.update(is_valid=False, error="Verification failed")
+                else:
+                    result["is_valid"] = outcomes[i] and not result["is_expired"]
+                    if cache is not None:
+                        cache.put_result(sig, public_key, outcomes[i])
+                yield result
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,413 @@
+"""Persistence of the sync rooms' updates."""
+
+import math
+import os
+import struct
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import List, Tuple
+
+import anyio
+from anyio.abc import TaskStatus
+from loguru import logger
+from pycrdt import Decoder, Doc, write_var_uint
+from pycrdt.store import FileYStore, SQLiteYStore
+from sqlite_anyio import connect, exception_logger
+
+# When the written updates are flushed to the disk: after every batch, at most once per
+# interval (and when the writer is closed), or whenever the operating system decides
+FSYNC_ALWAYS = "always"
+FSYNC_INTERVAL = "interval"
+FSYNC_NEVER = "never"
+FSYNC_POLICIES = (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER)
+
+
+def squash_updates(updates: List[bytes]) -> bytes:
+    """Merge a history of updates into a single update holding the resulting document state."""
+    doc = Doc()
+    for update in updates:
+        doc.apply_update(update)
+    return doc.get_update()
+
+
+def _replace_file(path: str, content: bytes) -> None:
+    """Replace the content of a file atomically, syncing the new content to the disk first."""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+class BatchFileYStore(FileYStore):
+    """FileYStore appending a batch of updates with a single version check, open and write.
+
+    The records are laid out exactly as by `FileYStore.write()`, so that the file can be
+    read back with `FileYStore.read()`.
+    """
+
+    @staticmethod
+    def _encode_records(updates: List[bytes], metadata: bytes, timestamp: float) -> bytes:
+        """Encode updates as the (update, metadata, timestamp) records of the store file."""
+        packed_timestamp = struct.pack("<d", timestamp)
+        tail = write_var_uint(len(metadata)) + metadata + write_var_uint(len(packed_timestamp)) + packed_timestamp
+        return b"".join(write_var_uint(len(update)) + update + tail for update in updates)
+
+    async def write_batch(self, updates: List[bytes], fsync: bool = False) -> None:
+        """Store a batch of updates.
+
+        Args:
+            updates: The updates to store, in order
+            fsync: Whether to flush the file to the disk once written
+        """
+        records = self._encode_records(updates, await self.get_metadata(), time.time())
+
+        async with self.lock:
+            await anyio.Path(Path(self.path).parent).mkdir(parents=True, exist_ok=True)
+            await self.check_version()
+            async with await anyio.open_file(self.path, "ab") as f:
+                await f.write(records)
+                if fsync:
+                    await f.flush()
+                    await anyio.to_thread.run_sync(os.fsync, f.wrapped.fileno())
+
+    async def squash(self) -> Tuple[int, int]:
+        """Replace the history of the document by a single update holding its state.
+
+        The lock is only held to read the history, and to write the new file: the updates
+        are merged on a worker thread meanwhile, and the records appended while merging are
+        kept after the merged one.
+
+        Returns:
+            Tuple[int, int]: Size in bytes of the history before and after squashing
+        """
+        async with self.lock:
+            if not await anyio.Path(self.path).exists():
+                return 0, 0
+            offset = await self.check_version()
+            async with await anyio.open_file(self.path, "rb") as f:
+                await f.seek(offset)
+                data = await f.read()
+
+        messages = list(Decoder(data).read_messages())
+        if len(messages) <= 3:
+            return len(data), len(data)
+        updates = messages[::3]
+        timestamp = struct.unpack("<d", messages[-1])[0]
+        squashed = await anyio.to_thread.run_sync(squash_updates, updates)
+        records = self._encode_records([squashed], await self.get_metadata(), timestamp)
+
+        async with self.lock:
+            async with await anyio.open_file(self.path, "rb") as f:
+                await f.seek(offset + len(data))
+                appended = await f.read()
+            header = f"VERSION:{self.version}\n".encode()
+            await anyio.to_thread.run_sync(_replace_file, self.path, header + records + appended)
+        return len(data), len(records)
+
+
+class BatchSQLiteYStore(SQLiteYStore):
+    """SQLiteYStore in WAL mode, inserting a batch of updates in a single transaction.
+
+    The rooms share one database, in which each update is a row of the `yupdates` table
+    keyed by the room's path and timestamp, with the schema of `SQLiteYStore`. With the
+    write-ahead log, a commit appends to the log without rewriting the database pages,
+    and the history of a room is read while other rooms are written. No checkpoint of the
+    document is computed on write: the history is compacted by `squash()` instead.
+    """
+
+    checkpoint_interval = None
+
+    def __init__(self, path: str, db_path: str, **kwargs):
+        """Initialize a new BatchSQLiteYStore instance.
+
+        Args:
+            path: Path of the document in the database, i.e. the room name
+            db_path: Path of the database file
+            **kwargs: Keyword arguments of the SQLiteYStore
+        """
+        super().__init__(path, **kwargs)
+        self.db_path = db_path
+
+    async def _init_db(self):
+        """Open the database in WAL mode, creating its tables if needed."""
+        await anyio.Path(Path(self.db_path).parent).mkdir(parents=True, exist_ok=True)
+        async with self.lock:
+            self._db = await connect(self.db_path, exception_handler=exception_logger, log=self.log)
+            async with self._transaction() as cursor:
+                await cursor.execute("PRAGMA journal_mode = WAL")
+                # Commits are durable once the log is synced, which checkpoints do
+                await cursor.execute("PRAGMA synchronous = NORMAL")
+                await cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS yupdates (path TEXT NOT NULL, yupdate BLOB, "
+                    "metadata BLOB, timestamp REAL NOT NULL)"
+                )
+                await cursor.execute(
+                    "CREATE INDEX IF NOT EXISTS idx_yupdates_path_timestamp ON yupdates (path, timestamp)"
+                )
+                await cursor.execute(
+                    "CREATE TABLE IF NOT EXISTS ycheckpoints (path TEXT NOT NULL, checkpoint BLOB NOT NULL, "
+                    "timestamp REAL NOT NULL, PRIMARY KEY(path))"
+                )
+                await cursor.execute(f"PRAGMA user_version = {self.version}")
+        self.db_initialized.set()
+
+    @asynccontextmanager
+    async def _transaction(self):
+        """Run statements in a transaction, committed on success, and rolled back and re-raised on error."""
+        cursor = await self._db.cursor()
+        try:
+            yield cursor
+            await self._db.commit()
+        except BaseException:
+            await self._db.rollback()
+            raise
+
+    async def write(self, data: bytes) -> None:
+        """Store an update.
+
+        Args:
+            data: The update to store
+        """
+        await self.write_batch([data])
+
+    async def write_batch(self, updates: List[bytes], fsync: bool = False) -> None:
+        """Store a batch of updates in a single transaction.
+
+        Args:
+            updates: The updates to store, in order
+            fsync: Whether to checkpoint the write-ahead log, syncing it to the disk
+        """
+        if self.db_initialized is None:
+            raise RuntimeError("YStore not started")
+        await self.db_initialized.wait()
+        metadata = await self.get_metadata()
+        timestamp = time.time()
+        rows = [
+            (self.path, self._compress(update) if self._compress else update, metadata, timestamp) for update in updates
+        ]
+
+        async with self.lock:
+            async with self._transaction() as cursor:
+                if rows:
+                    await cursor.executemany("INSERT INTO yupdates VALUES (?, ?, ?, ?)", rows)
+            if fsync:
+                await self._db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    async def squash(self) -> Tuple[int, int]:
+        """Replace the history of the document by a single update holding its state, in place.
+
+        The lock is only held to read the history, and to replace it in a transaction: the
+        updates are merged on a worker thread meanwhile, and the rows inserted while merging
+        are kept.
+
+        Returns:
+            Tuple[int, int]: Size in bytes of the history before and after squashing
+        """
+        if self.db_initialized is None:
+            raise RuntimeError("YStore not started")
+        await self.db_initialized.wait()
+        async with self.lock:
+            async with self._transaction() as cursor:
+                await cursor.execute(
+                    "SELECT rowid, yupdate, timestamp FROM yupdates WHERE path = ? ORDER BY timestamp, rowid",
+                    (self.path,),
+                )
+                rows = await cursor.fetchall()
+        size = sum(len(update) for _, update, _ in rows)
+        if len(rows) <= 1:
+            return size, size
+
+        updates = [self._decompress(update) if self._decompress else update for _, update, _ in rows]
+        squashed = await anyio.to_thread.run_sync(squash_updates, updates)
+        if self._compress:
+            squashed = self._compress(squashed)
+        last_rowid = max(rowid for rowid, _, _ in rows)
+
+        async with self.lock:
+            async with self._transaction() as cursor:
+                await cursor.execute("DELETE FROM yupdates WHERE path = ? AND rowid <= ?", (self.path, last_rowid))
+                await cursor.execute("DELETE FROM ycheckpoints WHERE path = ?", (self.path,))
+                await cursor.execute(
+                    "INSERT INTO yupdates VALUES (?, ?, ?, ?)",
+                    (self.path, squashed, await self.get_metadata(), rows[-1][2]),
+                )
+        return size, len(squashed)
+
+
+class StoreWriter:
+    """Single writer task group-committing the updates of a room to its YStore.
+
+    Updates are queued in a bounded stream, so that a room producing updates faster than
+    they can be stored waits for the writer instead of piling up pending writes. The
+    writer stores the updates received within `max_batch_delay` seconds of each other,
+    up to `max_batch_size` of them, as one batch. Stores without a `write_batch()` method
+    are written one update at a time, still from the single writer task.
+
+    A batch which cannot be written is retried with an exponential backoff, holding the
+    next updates back meanwhile, until it is written or, once the writer is being closed,
+    after `close_retries` more attempts. With the `interval` fsync policy, the last batch
+    written is flushed `fsync_interval` seconds later if no other batch flushes it first.
+    """
+
+    def __init__(
+        self,
+        ystore,
+        max_batch_size: int = 256,
+        max_batch_delay: float = 0.05,
+        max_queue_size: int = 1024,
+        fsync: str = FSYNC_INTERVAL,
+        fsync_interval: float = 1.0,
+        retry_delay: float = 0.1,
+        max_retry_delay: float = 5.0,
+        close_retries: int = 3,
+    ):
+        """Initialize a new StoreWriter instance.
+
+        Args:
+            ystore: The YStore the updates are written to
+            max_batch_size: Maximum number of updates written as a single batch
+            max_batch_delay: Time in seconds during which updates are gathered into a batch
+            max_queue_size: Maximum number of updates waiting to be written
+            fsync: One of `FSYNC_POLICIES`
+            fsync_interval: Minimum time in seconds between two flushes with the `interval` policy
+            retry_delay: Time in seconds before the first retry of a batch which could not be written
+            max_retry_delay: Maximum time in seconds between two retries of a batch
+            close_retries: Number of retries of a batch once the writer is being closed, before it is dropped
+
+        Raises:
+            ValueError: If the fsync policy is unknown
+        """
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unknown fsync policy '{fsync}', expected one of {', '.join(FSYNC_POLICIES)}.")
+        self.ystore = ystore
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.close_retries = close_retries
+        self._send, self._receive = anyio.create_memory_object_stream(max_buffer_size=max_queue_size)
+        self._running = False
+        self._closing = False
+        self._stopped = anyio.Event()
+        self._last_fsync = time.monotonic()
+        self._unsynced = False
+        self.batches = 0
+        self.updates = 0
+        self.history_updates = 0  # Updates in the store since it was last squashed
+        self.history_bytes = 0
+
+    async def write(self, update: bytes) -> None:
+        """Queue an update, waiting for room in the queue if it is full."""
+        await self._send.send(update)
+
+    async def _receive_batch(self, first_update: bytes) -> List[bytes]:
+        """Collect the updates received within the batching delay following the first one."""
+        batch = [first_update]
+        with anyio.move_on_after(self.max_batch_delay):
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(await self._receive.receive())
+                except anyio.EndOfStream:
+                    break
+        return batch
+
+    async def _write(self, batch: List[bytes], fsync: bool) -> None:
+        """Write a batch of updates to the YStore, retrying on failure.
+
+        Raises:
+            Exception: The last write error, if the writer is being closed and the retries are exhausted
+        """
+        write_batch = getattr(self.ystore, "write_batch", None)
+        written = 0  # Updates already written one at a time, not written again on retry
+        delay = self.retry_delay
+        retries = 0
+        while True:
+            try:
+                if write_batch is not None:
+                    await write_batch(batch, fsync=fsync)
+                else:
+                    for update in batch[written:]:
+                        await self.ystore.write(update)
+                        written += 1
+                return
+            except Exception as e:
+                if self._closing:
+                    retries += 1
+                    if retries > self.close_retries:
+                        raise
+                logger.error(f"Failed to write {len(batch) - written} updates to the YStore, retrying in {delay}s: {e}")
+                await anyio.sleep(delay)
+                delay = min(delay * 2, self.max_retry_delay)
+
+    async def _commit(self, batch: List[bytes], force_fsync: bool = False) -> None:
+        """Write a batch of updates, flushing them to the disk according to the fsync policy."""
+        fsync = self.fsync == FSYNC_ALWAYS or (
+            self.fsync == FSYNC_INTERVAL and (force_fsync or time.monotonic() - self._last_fsync >= self.fsync_interval)
+        )
+        try:
+            await self._write(batch, fsync)
+        except Exception as e:
+            logger.error(f"Dropping {len(batch)} updates which could not be written to the YStore: {e}")
+            return
+        if batch:
+            self.batches += 1
+            self.updates += len(batch)
+            self.history_updates += len(batch)
+            self.history_bytes += sum(len(update) for update in batch)
+        if fsync:
+            self._last_fsync = time.monotonic()
+        self._unsynced = self.fsync == FSYNC_INTERVAL and not fsync
+
+    async def _receive_next(self) -> bytes:
+        """Wait for the next queued update, flushing the written ones once their sync is due meanwhile.
+
+        Raises:
+            anyio.EndOfStream: If the writer is closed and all the queued updates were received
+        """
+        while True:
+            timeout = math.inf
+            if self._unsynced:
+                timeout = max(self._last_fsync + self.fsync_interval - time.monotonic(), 0)
+            with anyio.move_on_after(timeout):
+                return await self._receive.receive()
+            await self._commit([], force_fsync=True)
+
+    async def run(self, *, task_status: TaskStatus[None] = anyio.TASK_STATUS_IGNORED) -> None:
+        """Write the queued updates batch after batch, until the writer is closed."""
+        self._running = True
+        task_status.started()
+        try:
+            async with self._receive:
+                while True:
+                    try:
+                        update = await self._receive_next()
+                    except anyio.EndOfStream:
+                        break
+                    await self._commit(await self._receive_batch(update))
+            if self._unsynced:
+                await self._commit([], force_fsync=True)  # Flush the last batches written
+        finally:
+            self._running = False
+            self._stopped.set()
+
+    async def aclose(self) -> None:
+        """Stop accepting updates and wait for the queued ones to be written."""
+        self._closing = True
+        self._send.close()
+        if self._running:
+            await self._stopped.wait()
+            return
+
+        batch: List[bytes] = []
+        while True:
+            try:
+                batch.append(self._receive.receive_nowait())
+            except (anyio.WouldBlock, anyio.EndOfStream, anyio.ClosedResourceError):
+                break
+        if batch or self._unsynced:
+            await self._commit(batch, force_fsync=True)
@@ -0,0 +1,149 @@
+"""Unit tests for api.py."""
+
+import asyncio
+import hashlib
+import io
+import json
+
+import pytest
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.test import encode_multipart
+
+from crdtsign.sign import load_keypair, new_keypair
+from crdtsign.utils.executor import shutdown_executors
+
+
+@pytest.fixture(scope="module")
+def api(tmp_path_factory):
+    """Import the API with its storage in a temporary directory, as a registered user."""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(tmp_path_factory.mktemp("api"))
+        _, public_key = new_keypair(persist=True)
+        from crdtsign import api
+
+        api.user.set_username("user_a")
+        api.user_storage.add_user(
+            "user_a", api.user.user_id, public_key.public_bytes_raw().hex(), api.user.registration_date
+        )
+        try:
+            yield api
+        finally:
+            shutdown_executors()
+
+
+def upload(name: str, content: bytes) -> FileStorage:
+    """Create an uploaded file."""
+    return FileStorage(io.BytesIO(content), filename=name, content_type="application/octet-stream")
+
+
+async def post_files(api, path: str, files: list):
+    """Post files under the same `file` field in a multipart request."""
+    boundary, body = encode_multipart(MultiDict([("file", file) for file in files]))
+    headers = {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+    return await api.app.test_client().post(path, data=body, headers=headers)
+
+
+class TestBatchSigning:
+    """Tests for the batch signing endpoint."""
+
+    def test_mixed_batch(self, api):
+        """Test that a batch is signed file by file, reporting the files which cannot be signed."""
+
+        async def run():
+            files = [upload("a.pdf", b"content"), upload("../", b"other")]
+            response = await post_files(api, "/api/signatures/batch", files)
+            return response.status_code, await response.get_json()
+
+        status, data = asyncio.run(run())
+
+        assert status == 200
+        signed, invalid = data["files"]
+        assert signed["filename"] == "a.pdf" and "error" not in signed
+        assert api.file_storage.get_signature(signed["id"])["hash"] == hashlib.sha256(b"content").hexdigest()
+        assert invalid == {"filename": "../", "error": "Invalid file name"}
+        assert data["message"] == "1 of 2 files signed successfully"
+
+    def test_no_valid_file(self, api):
+        """Test that a batch without any file which can be signed is rejected."""
+
+        async def run():
+            response = await post_files(api, "/api/signatures/batch", [upload("../", b"content")])
+            return response.status_code, await response.get_json()
+
+        status, data = asyncio.run(run())
+
+        assert status == 400
+        assert data["files"] == [{"filename": "../", "error": "Invalid file name"}]
+
+
+class TestBatchValidation:
+    """Tests for the batch validation endpoint."""
+
+    def test_streamed_results(self, api):
+        """Test that one NDJSON line is streamed per requested signature, including the unknown ones."""
+
+        async def run():
+            response = await post_files(api, "/api/signatures/batch", [upload("b.pdf", b"b"), upload("c.pdf", b"c")])
+            file_ids = [file["id"] for file in (await response.get_json())["files"]]
+
+            headers = {"Content-Type": "application/json"}
+            async with api.app.test_client().request(
+                "/api/validate/batch", method="POST", headers=headers
+            ) as connection:
+                await connection.send(json.dumps({"ids": [*file_ids, "unknown"]}).encode())
+                await connection.send_complete()
+                lines = []
+                while data := await connection.receive():
+                    lines.extend(data.decode().splitlines())
+            return file_ids, connection.headers["Content-Type"], lines
+
+        file_ids, content_type, lines = asyncio.run(run())
+
+        assert content_type == "application/x-ndjson"
+        results = {result["id"]: result for result in map(json.loads, lines)}
+        assert len(lines) == len(results) == 3
+        assert all(results[file_id]["is_valid"] for file_id in file_ids)
+        assert results["unknown"] == {"id": "unknown", "is_valid": False, "error": "Signature not found"}
+
+
+class TestDigestVerification:
+    """Tests for the verification of a signature against a digest computed by the client."""
+
+    @pytest.fixture
+    def signed_digest(self, api):
+        """Return the payload verifying the signature of a digest, with the user's keypair."""
+        private_key, public_key = load_keypair()
+        digest = hashlib.sha256(b"content").digest()
+        return {
+            "hash": digest.hex(),
+            "signature": private_key.sign(digest).hex(),
+            "public_key": public_key.public_bytes_raw().hex(),
+        }
+
+    def verify(self, api, payload: dict):
+        """Post a payload to the digest verification endpoint."""
+
+        async def run():
+            response = await api.app.test_client().post("/api/verify/digest", json=payload)
+            return response.status_code, await response.get_json()
+
+        return asyncio.run(run())
+
+    def test_matching_digest(self, api, signed_digest):
+        """Test that the signature of a digest is valid."""
+        assert self.verify(api, signed_digest) == (200, {"is_valid": True, "message": "Signature is valid"})
+
+    def test_mismatching_digest(self, api, signed_digest):
+        """Test that the signature of another digest is invalid."""
+        payload = dict(signed_digest, hash=hashlib.sha256(b"other").hexdigest())
+
+        assert self.verify(api, payload) == (200, {"is_valid": False, "message": "Signature is invalid"})
+
+    @pytest.mark.parametrize(
+        "fields", [{"hash": "not-hex"}, {"hash": "00" * 16}, {"signature": "zz"}, {"public_key": "00"}, {"hash": ""}]
+    )
+    def test_malformed_payload(self, api, signed_digest, fields):
+        """Test that malformed digests, signatures and public keys, or missing fields, are rejected."""
+        status, data = self.verify(api, dict(signed_digest, **fields))
+
+        assert status == 400 and "error" in data
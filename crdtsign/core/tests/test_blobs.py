@@ -0,0 +1,71 @@
+"""Unit tests for blobs.py."""
+
+import hashlib
+import os
+
+import lz4.frame
+import pytest
+
+from crdtsign.blobs import BlobStore
+
+
+@pytest.fixture
+def blob_store(tmp_path):
+    """Create a blob store in a temporary directory."""
+    return BlobStore(tmp_path / "blobs")
+
+
+class TestBlobStore:
+    """Tests for the content-addressed chunk store."""
+
+    def test_put_chunk_is_content_addressed(self, blob_store):
+        """Test that chunks are stored under the hash of their content, once."""
+        blob_hash = blob_store.put_chunk(b"chunk content")
+
+        assert blob_hash == hashlib.sha256(b"chunk content").hexdigest()
+        assert blob_store.has(blob_hash)
+        assert blob_store.read_chunk(blob_hash) == b"chunk content"
+        assert blob_store.put_chunk(b"chunk content") == blob_hash
+
+    def test_file_roundtrip(self, blob_store, tmp_path):
+        """Test that a file can be rebuilt from its manifest."""
+        content = os.urandom(1000) * 3
+        source = tmp_path / "source.bin"
+        source.write_bytes(content)
+
+        manifest = blob_store.add_file(source, chunk_size=1000)
+        assert len(manifest) == 3
+        assert blob_store.missing(manifest) == []
+
+        target = tmp_path / "target.bin"
+        assert blob_store.write_file(manifest, target, hashlib.sha256(content).hexdigest())
+        assert target.read_bytes() == content
+
+    def test_put_rejects_mismatching_payload(self, blob_store):
+        """Test that payloads not matching their hash are rejected."""
+        blob_hash = hashlib.sha256(b"expected").hexdigest()
+
+        with pytest.raises(ValueError):
+            blob_store.put(blob_hash, lz4.frame.compress(b"tampered"))
+        assert not blob_store.has(blob_hash)
+        assert blob_store.missing([blob_hash, blob_hash]) == [blob_hash]
+
+    def test_legacy_payload(self, blob_store):
+        """Test that bare lz4 frames stored by earlier versions are still accepted and read."""
+        blob_hash = hashlib.sha256(b"legacy").hexdigest()
+
+        blob_store.put(blob_hash, lz4.frame.compress(b"legacy"))
+        assert blob_store.read_chunk(blob_hash) == b"legacy"
+
+    def test_incompressible_chunk_stored_raw(self, blob_store):
+        """Test that chunks which do not compress are stored as they are."""
+        chunk = os.urandom(10_000)
+
+        blob_hash = blob_store.put_chunk(chunk)
+        assert len(blob_store.get(blob_hash)) == len(chunk) + 1
+        assert blob_store.read_chunk(blob_hash) == chunk
+
+    def test_invalid_hash(self, blob_store):
+        """Test that malformed hashes cannot be used as paths."""
+        with pytest.raises(ValueError):
+            blob_store.path_for("../../etc/passwd")
@@ -0,0 +1,20 @@
+"""Unit tests for utils/cache.py."""
+
+from crdtsign.utils.cache import LRUCache
+
+
+class TestLRUCache:
+    """Tests for the bounded LRU cache."""
+
+    def test_eviction_order(self):
+        """Test that the least recently used item is evicted first."""
+        cache = LRUCache(maxsize=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        assert cache.get("a") == 1
+        cache.put("c", 3)
+
+        assert "b" not in cache
+        assert cache.get("a") == 1 and cache.get("c") == 3
+        assert cache.get("b") is None
+        assert cache.stats == {"size": 2, "hits": 3, "misses": 1}
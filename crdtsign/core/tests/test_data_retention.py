@@ -0,0 +1,156 @@
+"""Unit tests for utils/data_retention.py."""
+
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from pycrdt import Doc, Map
+
+from crdtsign.config import data_retention_config
+from crdtsign.utils.data_retention import RetentionScheduler, get_retention_changes
+
+
+class MapStorage:
+    """Minimal storage exposing the methods used by the retention scheduler."""
+
+    def __init__(self):
+        """Create a `files` map with a retention scheduler attached to it."""
+        self.doc = Doc()
+        self.files_map = self.doc.get("files", type=Map)
+        self.retention = RetentionScheduler(self, policy_check_interval=3600)
+        self.files_map.observe_deep(self.retention.on_map_change)
+        self.transactions = 0
+
+    def get_signature(self, file_id, include_content=False):
+        """Return a copy of a signature entry."""
+        file = self.files_map.get(file_id)
+        return dict(file) if file is not None else None
+
+    def get_signatures_metadata(self):
+        """Return a copy of every signature entry."""
+        return [dict(file) for file in self.files_map.values()]
+
+    def apply_signature_changes(self, changes):
+        """Apply the changes in a single transaction, counting the transactions."""
+        self.transactions += 1
+        with self.doc.transaction():
+            for file_id, fields in changes.items():
+                entry = self.files_map[file_id]
+                for key, value in fields.items():
+                    if value is not None:
+                        entry[key] = value
+                    elif key in entry:
+                        del entry[key]
+
+
+def make_entry(file_id: str, signed_days_ago: float, **fields) -> dict:
+    """Create a signature entry signed the given number of days ago."""
+    entry = {
+        "id": file_id,
+        "name": f"{file_id}.pdf",
+        "signed_on": str(datetime.now(timezone.utc) - timedelta(days=signed_days_ago)),
+    }
+    entry.update(fields)
+    return entry
+
+
+@pytest.fixture
+def retention_period():
+    """Set the data retention period for the duration of a test."""
+    original = dict(data_retention_config)
+
+    def set_period(days):
+        data_retention_config["data_retention_period"] = days
+
+    yield set_period
+    data_retention_config.clear()
+    data_retention_config.update(original)
+
+
+class TestRetentionChanges:
+    """Tests for the computation of the changes required by the policy."""
+
+    def test_new_expiration_date(self, retention_period):
+        """Test that files without an earlier expiration date are flagged."""
+        retention_period(4)
+        changes = get_retention_changes(make_entry("a", 1), datetime.now().timestamp())
+
+        assert changes["flag_data_retention"] is True
+        assert "expiration_date" not in changes
+
+    def test_expired(self, retention_period):
+        """Test that files past the retention period are marked as expired."""
+        retention_period(4)
+        changes = get_retention_changes(make_entry("a", 5), datetime.now().timestamp())
+
+        assert changes["flag_data_retention"] is None
+        assert changes["data_retention_new_exp_date"] is None
+        assert changes["expiration_date"]
+
+    def test_disabled_policy(self, retention_period):
+        """Test that residual data is removed when data retention is disabled."""
+        retention_period(0)
+        entry = make_entry("a", 1, flag_data_retention=True, data_retention_new_exp_date="2099-01-01")
+        now = datetime.now().timestamp()
+
+        assert get_retention_changes(entry, now) == {
+            "flag_data_retention": None,
+            "data_retention_new_exp_date": None,
+        }
+        assert get_retention_changes(make_entry("b", 1), now) == {}
+
+
+class TestRetentionScheduler:
+    """Tests for the event-driven retention scheduler."""
+
+    def test_changes_applied_in_one_transaction(self, retention_period):
+        """Test that the entries needing a change are updated together, and only once."""
+        retention_period(4)
+        storage = MapStorage()
+        storage.files_map["recent"] = Map(make_entry("recent", 1))
+        storage.files_map["old"] = Map(make_entry("old", 10))
+        storage.files_map["exempt"] = Map(make_entry("exempt", 1, expiration_date=str(datetime.now(timezone.utc))))
+
+        assert storage.retention.apply_due() == 2
+        assert storage.transactions == 1
+        assert storage.files_map["recent"]["flag_data_retention"] is True
+        assert "flag_data_retention" not in storage.files_map["old"]
+        assert "flag_data_retention" not in storage.files_map["exempt"]
+
+        assert storage.retention.apply_due() == 0
+        assert storage.transactions == 1
+
+    def test_wakes_up_when_due(self, retention_period):
+        """Test that the background task expires a file when its retention date comes."""
+        retention_period(1)
+        storage = MapStorage()
+        storage.files_map["a"] = Map(make_entry("a", 1 - 0.05 / 86400))
+
+        async def run_until_due():
+            storage.retention.start()
+            await asyncio.sleep(0.2)
+            storage.retention.stop()
+
+        asyncio.run(run_until_due())
+
+        file = storage.files_map["a"]
+        assert datetime.fromisoformat(file["expiration_date"]) <= datetime.now(timezone.utc)
+        assert "data_retention_new_exp_date" not in file
+
+    def test_malformed_dates(self, retention_period):
+        """Test that a remote entry with a malformed date is skipped without affecting the others."""
+        retention_period(4)
+        storage = MapStorage()
+        storage.files_map["valid"] = Map(make_entry("valid", 10))
+
+        remote = Doc()
+        remote_files = remote.get("files", type=Map)
+        remote.apply_update(storage.doc.get_update())
+        remote_files["invalid"] = Map(make_entry("invalid", 10, expiration_date="not-a-date"))
+        remote_files["unsigned"] = Map(make_entry("unsigned", 10, signed_on="not-a-date"))
+        storage.doc.apply_update(remote.get_update(storage.doc.get_state()))
+
+        assert storage.retention.apply_due() == 1
+        assert storage.files_map["valid"]["expiration_date"]
+        assert storage.files_map["invalid"]["expiration_date"] == "not-a-date"
+        assert storage.retention.apply_due() == 0
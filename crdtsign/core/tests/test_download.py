@@ -0,0 +1,80 @@
+"""Unit tests for utils/download.py."""
+
+import asyncio
+import os
+
+import pytest
+from quart import Quart, Response, request
+
+from crdtsign.utils.download import FileRangeBody
+
+
+@pytest.fixture
+def source(tmp_path):
+    """Create a file larger than the read buffer of the body."""
+    path = tmp_path / "source.bin"
+    path.write_bytes(os.urandom(3 * 1000 + 17))
+    return path
+
+
+@pytest.fixture
+def app(source):
+    """Create an application serving the source file with its content hash as ETag."""
+    app = Quart(__name__)
+
+    @app.route("/file")
+    async def serve():
+        body = FileRangeBody(source, buffer_size=1000)
+        response = Response(body, mimetype="application/octet-stream")
+        response.content_length = body.size
+        response.set_etag("content-hash")
+        return await response.make_conditional(request, accept_ranges=True, complete_length=body.size)
+
+    return app
+
+
+class TestFileRangeBody:
+    """Tests for the range-capable file response body."""
+
+    def test_full_file(self, app, source):
+        """Test that the whole file is streamed in blocks."""
+
+        async def run():
+            response = await app.test_client().get("/file")
+            return response.status_code, response.headers, await response.get_data()
+
+        status, headers, data = asyncio.run(run())
+        assert status == 200
+        assert data == source.read_bytes()
+        assert headers["ETag"] == '"content-hash"'
+
+    def test_range(self, app, source):
+        """Test that a partial transfer can be resumed from an offset."""
+
+        async def run():
+            client = app.test_client()
+            resumed = await client.get("/file", headers={"Range": "bytes=1500-", "If-Range": '"content-hash"'})
+            middle = await client.get("/file", headers={"Range": "bytes=10-19"})
+            stale = await client.get("/file", headers={"Range": "bytes=1500-", "If-Range": '"other-hash"'})
+            return [(r.status_code, r.headers, await r.get_data()) for r in (resumed, middle, stale)]
+
+        (status, headers, data), (middle_status, _, middle), (stale_status, _, stale) = asyncio.run(run())
+        content = source.read_bytes()
+        assert status == 206
+        assert data == content[1500:]
+        assert headers["Content-Range"] == f"bytes 1500-{len(content) - 1}/{len(content)}"
+        assert middle_status == 206 and middle == content[10:20]
+        assert stale_status == 200 and stale == content
+
+    def test_conditional_requests(self, app):
+        """Test that unchanged files are not sent again and that invalid ranges are rejected."""
+
+        async def run():
+            client = app.test_client()
+            cached = await client.get("/file", headers={"If-None-Match": '"content-hash"'})
+            unsatisfiable = await client.get("/file", headers={"Range": "bytes=100000-"})
+            return cached.status_code, await cached.get_data(), unsatisfiable.status_code
+
+        status, data, unsatisfiable_status = asyncio.run(run())
+        assert status == 304 and data == b""
+        assert unsatisfiable_status == 416
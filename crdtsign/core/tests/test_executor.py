@@ -0,0 +1,49 @@
+"""Unit tests for utils/executor.py."""
+
+import asyncio
+import threading
+
+from crdtsign.config import executor_config
+from crdtsign.sign import get_file_hash, get_file_hash_async
+from crdtsign.utils.executor import get_process_pool, get_thread_pool, run_in_thread, shutdown_executors
+
+
+class TestExecutors:
+    """Tests for the executor layer."""
+
+    def test_run_in_thread(self, tmp_path):
+        """Test that the work runs on a worker thread and that the loop keeps running meanwhile."""
+        path = tmp_path / "file.bin"
+        path.write_bytes(b"x" * 1_000_000)
+
+        async def run():
+            ticks = 0
+
+            async def tick():
+                nonlocal ticks
+                while True:
+                    ticks += 1
+                    await asyncio.sleep(0)
+
+            ticker = asyncio.create_task(tick())
+            thread_name = await run_in_thread(lambda: threading.current_thread().name)
+            digest = await get_file_hash_async(path)
+            ticker.cancel()
+            return thread_name, digest, ticks
+
+        try:
+            thread_name, digest, ticks = asyncio.run(run())
+        finally:
+            shutdown_executors()
+
+        assert thread_name.startswith("crdtsign-worker")
+        assert digest == get_file_hash(path)
+        assert ticks > 0
+
+    def test_process_pool_disabled(self, monkeypatch):
+        """Test that the thread pool is used when the process pool is disabled."""
+        monkeypatch.setitem(executor_config, "process_workers", 0)
+        try:
+            assert get_process_pool() is get_thread_pool()
+        finally:
+            shutdown_executors()
@@ -0,0 +1,156 @@
+"""Unit tests for utils/file_utils.py."""
+
+import base64
+import hashlib
+import os
+
+import lz4.frame
+import pytest
+
+from crdtsign.utils.file_utils import (
+    CHUNK_SIZE,
+    CODEC_LZ4,
+    CODEC_NONE,
+    CODEC_ZLIB,
+    CONTENT_FORMAT_BINARY,
+    CONTENT_FORMAT_LZ4_BASE85,
+    CONTENT_FORMAT_LZ4_BINARY,
+    CONTENT_FORMAT_LZ4_HEX,
+    CONTENT_FORMATS,
+    ChunkCodec,
+    compress_chunk,
+    decode_chunk,
+    deserialize_file,
+    encode_chunk,
+    serialize_file,
+)
+
+
+class TestParallelCodec:
+    """Tests for the parallel chunk compression and decompression."""
+
+    def test_roundtrip_in_order(self, tmp_path):
+        """Test that parallel serialization matches the sequential one and restores the file."""
+        content = b"".join(os.urandom(1024) * (i % 7 + 1) for i in range(200))
+        source = tmp_path / "source.bin"
+        source.write_bytes(content)
+
+        serialized = serialize_file(source)
+        expected = [compress_chunk(content[i : i + CHUNK_SIZE]) for i in range(0, len(content), CHUNK_SIZE)]
+        assert serialized == expected
+
+        target = tmp_path / "target.bin"
+        assert deserialize_file(serialized, target, hashlib.sha256(content).hexdigest())
+        assert target.read_bytes() == content
+
+    def test_hash_mismatch(self, tmp_path):
+        """Test that a file not matching the expected hash is reported as invalid."""
+        serialized = [compress_chunk(b"content")]
+
+        assert not deserialize_file(serialized, tmp_path / "target.bin", "00" * 32)
+        assert deserialize_file(serialized, tmp_path / "target.bin")
+
+
+def decode_payload(serialized_chunk, content_format: int) -> bytes:
+    """Return the payload of a serialized chunk in one of the layouts of earlier versions."""
+    if content_format == CONTENT_FORMAT_LZ4_BINARY:
+        return serialized_chunk
+    if content_format == CONTENT_FORMAT_LZ4_BASE85:
+        return base64.b85decode(serialized_chunk)
+    return bytes.fromhex(serialized_chunk)
+
+
+class TestContentFormats:
+    """Tests for the encodings of the serialized chunks."""
+
+    @pytest.mark.parametrize("content_format", sorted(CONTENT_FORMATS.values()))
+    def test_roundtrip(self, tmp_path, content_format):
+        """Test that a file is restored from each layout."""
+        content = os.urandom(100_000)
+        source = tmp_path / "source.bin"
+        source.write_bytes(content)
+
+        serialized = serialize_file(source, content_format=content_format)
+        target = tmp_path / "target.bin"
+
+        assert deserialize_file(serialized, target, hashlib.sha256(content).hexdigest(), content_format)
+
+    def test_binary_is_smaller(self):
+        """Test that the binary and base85 layouts are smaller than the hex one."""
+        chunk = os.urandom(CHUNK_SIZE)
+        sizes = {name: len(encode_chunk(chunk, content_format)) for name, content_format in CONTENT_FORMATS.items()}
+
+        assert sizes["binary"] * 2 <= sizes["hex"]
+        assert sizes["binary"] < sizes["base85"] < sizes["hex"]
+        assert isinstance(encode_chunk(chunk, CONTENT_FORMAT_BINARY), bytes)
+
+    def test_legacy_layout(self):
+        """Test that chunks without a recorded format are read as hex."""
+        chunk = os.urandom(1000)
+
+        assert decode_chunk(compress_chunk(chunk)) == chunk
+        assert decode_chunk(encode_chunk(chunk, CONTENT_FORMAT_BINARY), float(CONTENT_FORMAT_BINARY)) == chunk
+
+    @pytest.mark.parametrize(
+        "content_format", [CONTENT_FORMAT_LZ4_HEX, CONTENT_FORMAT_LZ4_BASE85, CONTENT_FORMAT_LZ4_BINARY]
+    )
+    def test_earlier_layouts(self, content_format):
+        """Test that the layouts of earlier versions hold bare lz4 frames, distinct from the current ones."""
+        chunk = b"compressible content " * 1000
+        serialized = encode_chunk(chunk, content_format)
+
+        assert decode_chunk(serialized, content_format) == chunk
+        assert lz4.frame.decompress(decode_payload(serialized, content_format)) == chunk
+        with pytest.raises(ValueError):
+            decode_chunk(serialized, content_format + 3)
+        with pytest.raises(ValueError):
+            decode_chunk(encode_chunk(chunk, content_format + 3), content_format)
+        with pytest.raises(ValueError):
+            decode_chunk(serialized, 7)
+
+
+class TestChunkCodec:
+    """Tests for the adaptive chunk compression."""
+
+    @pytest.mark.parametrize("codec", ["lz4", "zlib", "none"])
+    def test_roundtrip(self, codec):
+        """Test that chunks compressed with each codec are restored by any codec instance."""
+        chunk = b"compressible content " * 3000
+
+        payload = ChunkCodec(codec, level=1).compress(chunk)
+
+        assert ChunkCodec.decompress(payload) == chunk
+        assert (
+            decode_chunk(encode_chunk(chunk, CONTENT_FORMAT_BINARY, ChunkCodec(codec)), CONTENT_FORMAT_BINARY) == chunk
+        )
+
+    def test_codec_is_recorded(self):
+        """Test that the codec actually used is recorded in the first byte of the payload."""
+        compressible = b"a" * CHUNK_SIZE
+        incompressible = os.urandom(CHUNK_SIZE)
+
+        assert ChunkCodec("lz4").compress(compressible)[0] == CODEC_LZ4
+        assert ChunkCodec("zlib").compress(compressible)[0] == CODEC_ZLIB
+        assert ChunkCodec("lz4").compress(incompressible) == bytes([CODEC_NONE]) + incompressible
+        assert ChunkCodec("lz4", adaptive=False).compress(incompressible)[0] == CODEC_LZ4
+
+    def test_small_incompressible_chunk(self):
+        """Test that chunks too small to be sampled are stored raw when compression does not pay off."""
+        chunk = os.urandom(100)
+
+        assert ChunkCodec("lz4").compress(chunk) == bytes([CODEC_NONE]) + chunk
+
+    def test_legacy_payload(self):
+        """Test that bare lz4 frames written by earlier versions are still read."""
+        chunk = os.urandom(1000)
+
+        assert ChunkCodec.decompress(lz4.frame.compress(chunk)) == chunk
+        assert decode_chunk(lz4.frame.compress(chunk).hex()) == chunk
+
+    def test_invalid_payloads(self):
+        """Test that corrupted payloads and unknown codecs are rejected."""
+        for payload in (b"", bytes([CODEC_LZ4]) + b"garbage", bytes([0x7F]) + b"data"):
+            with pytest.raises(ValueError):
+                ChunkCodec.decompress(payload)
+        with pytest.raises(ValueError):
+            ChunkCodec("unknown")
@@ -0,0 +1,201 @@
+"""Unit tests for index.py."""
+
+from datetime import datetime
+
+import pytest
+from pycrdt import Doc, Map
+
+from crdtsign.index import ChangeFeed, SignatureIndex
+
+
+def make_entry(file_id: str, user_id: str = "user_a", **fields) -> dict:
+    """Create a signature entry as stored in the `files` map."""
+    entry = {
+        "id": file_id,
+        "name": f"{file_id}.pdf",
+        "hash": f"hash_{file_id}",
+        "signature": "00",
+        "user_id": user_id,
+        "username": user_id,
+        "signed_on": "2025-01-01T00:00:00+00:00",
+        "file_manifest": ["ab" * 32],
+    }
+    entry.update(fields)
+    return entry
+
+
+@pytest.fixture
+def indexed_map():
+    """Create a `files` map with an index attached to it."""
+    doc = Doc()
+    files_map = doc.get("files", type=Map)
+    index = SignatureIndex()
+    files_map.observe_deep(index.on_map_change)
+    return doc, files_map, index
+
+
+class TestSignatureIndex:
+    """Tests for the signature metadata index."""
+
+    def test_lookup_without_content(self, indexed_map):
+        """Test that entries are indexed by ID, without their content."""
+        _, files_map, index = indexed_map
+        files_map["a"] = make_entry("a")
+
+        metadata = index.get("a")
+        assert metadata["name"] == "a.pdf"
+        assert "file_manifest" not in metadata
+        assert "a" in index and len(index) == 1
+        assert index.get("missing") is None
+
+    def test_returned_metadata_is_a_copy(self, indexed_map):
+        """Test that callers cannot alter the index through returned values."""
+        _, files_map, index = indexed_map
+        files_map["a"] = make_entry("a")
+
+        index.get("a")["name"] = "changed"
+        assert index.get("a")["name"] == "a.pdf"
+
+    def test_updates_and_deletions(self, indexed_map):
+        """Test that updates and deletions are reflected in the index."""
+        _, files_map, index = indexed_map
+        files_map["a"] = make_entry("a")
+        files_map["b"] = make_entry("b")
+        files_map["a"] = make_entry("a", name="renamed.pdf")
+        del files_map["b"]
+
+        assert [m["name"] for m in index.all()] == ["renamed.pdf"]
+
+    def test_remote_changes(self, indexed_map):
+        """Test that updates received from another peer are indexed."""
+        doc, _, index = indexed_map
+        remote = Doc()
+        remote.get("files", type=Map)["r"] = make_entry("r")
+
+        doc.apply_update(remote.get_update())
+
+        assert index.get("r")["id"] == "r"
+
+    def test_secondary_indexes(self, indexed_map):
+        """Test the lookups by signer and by file hash."""
+        _, files_map, index = indexed_map
+        files_map["a"] = make_entry("a", user_id="user_a", hash="h1")
+        files_map["b"] = make_entry("b", user_id="user_b", hash="h1")
+        files_map["c"] = make_entry("c", user_id="user_a", hash="h2")
+        files_map["c"] = make_entry("c", user_id="user_b", hash="h2")
+
+        assert index.ids_by_user("user_a") == {"a"}
+        assert index.ids_by_user("user_b") == {"b", "c"}
+        assert index.ids_by_hash("h1") == {"a", "b"}
+
+        del files_map["b"]
+        assert index.ids_by_hash("h1") == {"a"}
+        assert index.ids_by_user("unknown") == set()
+
+    def test_expiration_order(self, indexed_map):
+        """Test that signatures are ordered by their effective expiration date."""
+        _, files_map, index = indexed_map
+        files_map["late"] = make_entry("late", expiration_date="2025-03-01T00:00:00+00:00")
+        files_map["never"] = make_entry("never")
+        files_map["early"] = make_entry("early", expiration_date="2025-02-01T00:00:00+00:00")
+        files_map["retained"] = make_entry(
+            "retained",
+            expiration_date="2026-01-01T00:00:00+00:00",
+            flag_data_retention=True,
+            data_retention_new_exp_date="2025-01-15T00:00:00+00:00",
+        )
+
+        before = datetime.fromisoformat("2025-02-15T00:00:00+00:00").timestamp()
+        assert index.ids_expiring_before(before) == ["retained", "early"]
+
+        del files_map["early"]
+        assert index.ids_expiring_before(before) == ["retained"]
+
+    def test_malformed_expiration_date(self, indexed_map):
+        """Test that a remote entry with a malformed date is indexed as never expiring."""
+        doc, _, index = indexed_map
+        remote = Doc()
+        remote_map = remote.get("files", type=Map)
+        remote_map["bad"] = make_entry("bad", expiration_date="not a date")
+        remote_map["bad_retention"] = make_entry("bad_retention", data_retention_new_exp_date="2025-13-45")
+        remote_map["early"] = make_entry("early", expiration_date="2025-02-01T00:00:00+00:00")
+
+        doc.apply_update(remote.get_update())
+
+        assert {index.get(file_id)["id"] for file_id in ("bad", "bad_retention", "early")} == {
+            "bad",
+            "bad_retention",
+            "early",
+        }
+        assert index.ids_expiring_before(datetime.max.timestamp()) == ["early"]
+
+    def test_nested_entries(self, indexed_map):
+        """Test that field-level changes of entries stored as nested maps are indexed."""
+        _, files_map, index = indexed_map
+        files_map["a"] = Map(make_entry("a", expiration_date="2025-03-01T00:00:00+00:00"))
+        assert "file_manifest" not in index.get("a")
+
+        files_map["a"]["user_id"] = "user_b"
+        files_map["a"]["data_retention_new_exp_date"] = "2025-01-15T00:00:00+00:00"
+
+        assert index.ids_by_user("user_b") == {"a"} and index.ids_by_user("user_a") == set()
+        before = datetime.fromisoformat("2025-02-01T00:00:00+00:00").timestamp()
+        assert index.ids_expiring_before(before) == ["a"]
+
+
+class TestChangeFeed:
+    """Tests for the sequence of changes of the `files` map."""
+
+    def test_changed_since(self):
+        """Test that only the entries changed after a token are returned, in change order."""
+        doc = Doc()
+        files_map = doc.get("files", type=Map)
+        feed = ChangeFeed()
+        files_map.observe_deep(feed.on_map_change)
+
+        files_map["a"] = Map(make_entry("a"))
+        files_map["b"] = Map(make_entry("b"))
+        token = feed.token
+        files_map["a"]["name"] = "renamed.pdf"
+        with doc.transaction():
+            files_map["c"] = Map(make_entry("c"))
+            del files_map["b"]
+
+        # Entries changed by the same transaction come in no particular order
+        changed = feed.changed_since(feed.parse_token(token))
+        assert changed[0] == "a" and set(changed[1:]) == {"b", "c"}
+        assert feed.changed_since(feed.parse_token(feed.token)) == []
+        assert len(feed.changed_since(0)) == 3
+
+    def test_removals_are_bounded(self):
+        """Test that only the last removals are kept, and that older tokens are answered with a reset."""
+        doc = Doc()
+        files_map = doc.get("files", type=Map)
+        feed = ChangeFeed(max_removed=2)
+        files_map.observe_deep(feed.on_map_change)
+
+        for file_id in "abcd":
+            files_map[file_id] = Map(make_entry(file_id))
+        old_token = feed.token
+        del files_map["a"]
+        token = feed.token
+        del files_map["b"]
+        del files_map["c"]
+
+        assert feed.parse_token(old_token) is None
+        assert feed.changed_since(feed.parse_token(token)) == ["b", "c"]
+        assert sorted(feed._changed) == ["b", "c", "d"]
+
+        files_map["b"] = Map(make_entry("b"))
+        del files_map["d"]
+        assert feed.changed_since(feed.parse_token(token)) == ["c", "b", "d"]
+
+    def test_foreign_tokens(self):
+        """Test that tokens of another feed, malformed or from the future are rejected."""
+        feed = ChangeFeed()
+
+        assert feed.parse_token(feed.token) == 0
+        assert feed.parse_token(ChangeFeed().token) is None
+        assert feed.parse_token(f"{feed.epoch}:5") is None
+        assert feed.parse_token(f"{feed.epoch}:x") is None
+        assert feed.parse_token(None) is None
@@ -0,0 +1,176 @@
+"""Unit tests for utils/materialization.py."""
+
+import asyncio
+import hashlib
+import os
+from pathlib import Path
+
+import pytest
+from pycrdt import Map
+
+from crdtsign.storage import FileSignatureStorage
+from crdtsign.utils import materialization
+from crdtsign.utils.file_utils import CONTENT_FORMAT_BINARY, encode_chunk
+
+
+def make_entry(file_id: str, content: bytes) -> dict:
+    """Create a signature entry embedding the given content."""
+    return {
+        "id": file_id,
+        "name": f"{file_id}.bin",
+        "hash": hashlib.sha256(content).hexdigest(),
+        "signature": "00" * 64,
+        "user_id": "user_a",
+        "username": "user_a",
+        "signed_on": "2025-01-01T00:00:00+00:00",
+        "file_content": [encode_chunk(content, CONTENT_FORMAT_BINARY)],
+        "content_format": CONTENT_FORMAT_BINARY,
+    }
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Create a file signature storage embedding file contents, in a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    storage = FileSignatureStorage("client", "localhost", 0)
+    monkeypatch.setattr(storage, "file_transfer", "embedded")
+    return storage
+
+
+@pytest.fixture
+def hashed_paths(monkeypatch):
+    """Record the paths of the files hashed by the materializer."""
+    hashed = []
+    original = materialization.get_file_hash_async
+
+    async def get_file_hash_async(path):
+        hashed.append(Path(path))
+        return await original(path)
+
+    monkeypatch.setattr(materialization, "get_file_hash_async", get_file_hash_async)
+    return hashed
+
+
+class TestFileMaterializer:
+    """Tests for the background materialization of received files."""
+
+    def test_skips_files_on_disk(self, storage, hashed_paths):
+        """Test that files already on disk are neither rewritten nor hashed again."""
+        storage.files_map["a"] = Map(make_entry("a", b"first"))
+        storage.files_map["b"] = Map(make_entry("b", b"second"))
+
+        progress = asyncio.run(storage.handle_files_deserialization())
+        assert progress["materialized"] == 2 and progress["failed"] == 0
+        assert Path(".storage/uploads/user_a/a.bin").read_bytes() == b"first"
+
+        progress = asyncio.run(storage.handle_files_deserialization())
+        assert progress["materialized"] == 2 and progress["skipped"] == 2
+        assert hashed_paths == []
+
+    def test_rewrites_altered_files(self, storage):
+        """Test that a file on disk not matching the signed hash is written again."""
+        storage.files_map["a"] = Map(make_entry("a", b"original"))
+        asyncio.run(storage.handle_files_deserialization())
+
+        path = Path(".storage/uploads/user_a/a.bin")
+        path.write_bytes(b"tampered")
+        asyncio.run(storage.handle_files_deserialization())
+
+        assert path.read_bytes() == b"original"
+        assert storage.materializer.materialized == 2
+
+    def test_background_worker(self, storage):
+        """Test that the files of new and changed entries are materialized as they arrive."""
+        content = os.urandom(100_000)
+
+        async def run():
+            storage.materializer.start()
+            storage.files_map["a"] = Map(make_entry("a", content))
+            while storage.materializer.progress["materialized"] < 1:
+                await asyncio.sleep(0.01)
+
+            storage.files_map["a"]["name"] = "renamed.bin"
+            storage.files_map["a"]["username"] = "ignored change"
+            while storage.materializer.progress["materialized"] < 2:
+                await asyncio.sleep(0.01)
+            storage.materializer.stop()
+
+        asyncio.run(asyncio.wait_for(run(), timeout=10))
+
+        assert Path(".storage/uploads/user_a/a.bin").read_bytes() == content
+        assert Path(".storage/uploads/user_a/renamed.bin").read_bytes() == content
+        assert storage.materializer.progress == {
+            "pending": 0,
+            "in_progress": 0,
+            "retrying": 0,
+            "materialized": 2,
+            "skipped": 0,
+            "failed": 0,
+        }
+
+    def test_failed_files_are_retried(self, storage, monkeypatch):
+        """Test that a file which could not be materialized is retried after a delay."""
+        monkeypatch.setattr(materialization, "RETRY_INITIAL_DELAY", 0.05)
+        original = storage.materialize_file
+        attempts = []
+
+        async def materialize_file(file, to_file):
+            attempts.append(file["id"])
+            if len(attempts) < 3:
+                return False  # E.g. chunks not on the sync server yet
+            return await original(file, to_file)
+
+        monkeypatch.setattr(storage, "materialize_file", materialize_file)
+
+        async def run():
+            storage.materializer.start()
+            storage.files_map["a"] = Map(make_entry("a", b"content"))
+            while storage.materializer.progress["materialized"] < 1:
+                await asyncio.sleep(0.01)
+            storage.materializer.stop()
+
+        asyncio.run(asyncio.wait_for(run(), timeout=10))
+
+        assert attempts == ["a", "a", "a"]
+        assert storage.materializer.progress["failed"] == 2
+        assert storage.materializer.progress["retrying"] == 0
+        assert Path(".storage/uploads/user_a/a.bin").read_bytes() == b"content"
+
+    def test_invalid_content(self, storage):
+        """Test that files not matching their signed hash are reported as failed."""
+        storage.files_map["a"] = Map(dict(make_entry("a", b"content"), hash="00" * 32))
+
+        progress = asyncio.run(storage.handle_files_deserialization())
+
+        assert progress["failed"] == 1 and progress["materialized"] == 0
+
+    def test_is_on_disk(self, storage, hashed_paths):
+        """Test that a file on disk only matches the hash of its own content, hashed once until it changes."""
+        path = Path(".storage/uploads/user_a/a.bin")
+        assert not asyncio.run(storage.materializer.is_on_disk(path, hashlib.sha256(b"first").hexdigest()))
+
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"first")
+        assert asyncio.run(storage.materializer.is_on_disk(path, hashlib.sha256(b"first").hexdigest()))
+        assert not asyncio.run(storage.materializer.is_on_disk(path, hashlib.sha256(b"other").hexdigest()))
+        assert hashed_paths == [path]
+
+    def test_concurrent_checks_hash_once(self, storage, hashed_paths):
+        """Test that concurrent checks of the same file, e.g. parallel downloads, share a single hashing."""
+        path = Path(".storage/uploads/user_a/a.bin")
+        path.parent.mkdir(parents=True)
+        path.write_bytes(b"content")
+        file_hash = hashlib.sha256(b"content").hexdigest()
+
+        async def check_all():
+            return await asyncio.gather(*(storage.materializer.is_on_disk(path, file_hash) for _ in range(4)))
+
+        assert asyncio.run(check_all()) == [True] * 4
+        assert hashed_paths == [path]
+
+    def test_unsafe_paths(self, storage):
+        """Test that file names cannot point outside of the materialization directory."""
+        with pytest.raises(ValueError):
+            storage.materializer.path_for({"user_id": "user_a", "name": "../../escaped.bin"})
+        with pytest.raises(ValueError):
+            storage.materializer.path_for({"user_id": "..", "name": "escaped.bin"})
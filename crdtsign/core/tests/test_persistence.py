@@ -0,0 +1,157 @@
+"""Unit tests for utils/persistence.py."""
+
+import asyncio
+
+import pytest
+from pycrdt import Doc, Map
+
+from crdtsign.utils.persistence import SaveScheduler, UpdateLog
+
+
+@pytest.fixture
+def update_log(tmp_path):
+    """Create an update log in a temporary directory."""
+    return UpdateLog(tmp_path / "signatures.bin", compaction_threshold=1)
+
+
+def logged_doc(update_log):
+    """Create a document whose updates are appended to the given log."""
+    doc = Doc()
+    doc.observe(lambda event: update_log.append(event.update))
+    return doc, doc.get("files", type=Map)
+
+
+def loaded_map(update_log):
+    """Load the persisted state into a new document."""
+    doc = Doc()
+    files_map = doc.get("files", type=Map)
+    update_log.load(doc)
+    return files_map
+
+
+class TestUpdateLog:
+    """Tests for the append-only update log."""
+
+    def test_append_and_load(self, update_log):
+        """Test that the logged updates rebuild the document."""
+        doc, files_map = logged_doc(update_log)
+        files_map["a"] = {"name": "a.pdf"}
+        files_map["b"] = {"name": "b.pdf"}
+        del files_map["a"]
+
+        assert update_log.exists()
+        assert update_log.log_size() > 0
+        assert loaded_map(update_log).to_py() == {"b": {"name": "b.pdf"}}
+
+    def test_compaction(self, update_log):
+        """Test that compaction folds the log into the snapshot and keeps later updates."""
+        doc, files_map = logged_doc(update_log)
+        files_map["a"] = {"name": "a.pdf"}
+
+        async def compact_then_write():
+            task = asyncio.create_task(update_log.compact(doc))
+            await asyncio.sleep(0)
+            files_map["b"] = {"name": "b.pdf"}
+            await task
+
+        asyncio.run(compact_then_write())
+
+        assert not update_log.compacting_path.exists()
+        assert loaded_map(update_log).to_py() == {"a": {"name": "a.pdf"}, "b": {"name": "b.pdf"}}
+
+    def test_truncated_record_is_ignored(self, update_log):
+        """Test that a partially written record does not prevent loading."""
+        doc, files_map = logged_doc(update_log)
+        files_map["a"] = {"name": "a.pdf"}
+        with open(update_log.log_path, "ab") as f:
+            f.write(b"\xff\x00\x00\x00partial")
+
+        assert loaded_map(update_log).to_py() == {"a": {"name": "a.pdf"}}
+
+    def test_append_after_truncated_record(self, update_log, tmp_path):
+        """Test that updates appended after a partially written record are not lost."""
+        doc, files_map = logged_doc(update_log)
+        files_map["a"] = {"name": "a.pdf"}
+        with open(update_log.log_path, "ab") as f:
+            f.write(b"\xff\x00\x00\x00partial")
+
+        reopened_log = UpdateLog(tmp_path / "signatures.bin", compaction_threshold=1)
+        doc, files_map = logged_doc(reopened_log)
+        reopened_log.load(doc)
+        files_map["b"] = {"name": "b.pdf"}
+        files_map["c"] = {"name": "c.pdf"}
+
+        assert loaded_map(reopened_log).to_py() == {
+            "a": {"name": "a.pdf"},
+            "b": {"name": "b.pdf"},
+            "c": {"name": "c.pdf"},
+        }
+
+    def test_interrupted_compaction(self, update_log):
+        """Test that the log left by an interrupted compaction is folded into the snapshot."""
+        doc, files_map = logged_doc(update_log)
+        files_map["a"] = {"name": "a.pdf"}
+        update_log.log_path.replace(update_log.compacting_path)  # Crash after rotating the log
+        files_map["b"] = {"name": "b.pdf"}
+
+        assert loaded_map(update_log).to_py() == {"a": {"name": "a.pdf"}, "b": {"name": "b.pdf"}}
+        assert not update_log.compacting_path.exists()
+
+        files_map["c"] = {"name": "c.pdf"}
+        update_log.log_path.replace(update_log.compacting_path)
+        files_map["d"] = {"name": "d.pdf"}
+        asyncio.run(update_log.compact(doc))
+
+        assert not update_log.log_path.exists()
+        assert not update_log.compacting_path.exists()
+        assert set(loaded_map(update_log).to_py()) == {"a", "b", "c", "d"}
+
+
+class TestSaveScheduler:
+    """Tests for the coalescing save scheduler."""
+
+    def test_burst_is_coalesced(self):
+        """Test that a burst of requests results in a single save."""
+        saves = []
+        scheduler = SaveScheduler(lambda: saves.append(1), debounce=0.01, max_latency=1.0)
+
+        async def burst():
+            for _ in range(500):
+                scheduler.request()
+            assert scheduler.pending_writes == 500
+            await asyncio.sleep(0.05)
+
+        asyncio.run(burst())
+
+        assert len(saves) == 1
+        assert scheduler.stats == {"pending_writes": 0, "flushed_writes": 1}
+
+    def test_max_latency(self):
+        """Test that continuous requests are still saved within the maximum latency."""
+        saves = []
+        scheduler = SaveScheduler(lambda: saves.append(1), debounce=0.05, max_latency=0.1)
+
+        async def continuous():
+            for _ in range(30):
+                scheduler.request()
+                await asyncio.sleep(0.01)
+
+        asyncio.run(continuous())
+
+        assert len(saves) >= 2
+
+    def test_flush(self):
+        """Test that pending requests are written on flush, and only once."""
+        saves = []
+        scheduler = SaveScheduler(lambda: saves.append(1), debounce=10, max_latency=10)
+
+        async def flush_pending():
+            scheduler.request()
+            scheduler.flush()
+            await asyncio.sleep(0)
+            scheduler.flush()
+
+        asyncio.run(flush_pending())
+
+        assert len(saves) == 1
+        assert scheduler.stats == {"pending_writes": 0, "flushed_writes": 1}
@@ -0,0 +1,516 @@
+"""Unit tests for server.py."""
+
+import functools
+import hashlib
+import os
+import sqlite3
+
+import anyio
+import httpx
+import pytest
+from loguru import logger
+from pycrdt import Doc, Map
+from pycrdt.store import FileYStore
+
+from crdtsign import blobs as blobs_module
+from crdtsign import server as server_module
+from crdtsign import ystore as ystore_module
+from crdtsign.blobs import BlobStore, BlobTransferClient
+from crdtsign.config import server_config
+from crdtsign.server import ServerRoom, SyncServer, SyncServerApp
+from crdtsign.ystore import (
+    FSYNC_ALWAYS,
+    FSYNC_INTERVAL,
+    FSYNC_NEVER,
+    BatchFileYStore,
+    BatchSQLiteYStore,
+    StoreWriter,
+)
+
+
+class MemoryYStore:
+    """Minimal YStore keeping the written updates in memory."""
+
+    def __init__(self):
+        """Initialize an empty MemoryYStore."""
+        self.updates = []
+        self.start_lock = anyio.Lock()
+        self.started = anyio.Event()
+
+    async def start(self, *, task_status=anyio.TASK_STATUS_IGNORED):
+        """Mark the store as started."""
+        self.started.set()
+        task_status.started()
+
+    async def write(self, update: bytes) -> None:
+        """Record a written update."""
+        self.updates.append(update)
+
+
+class FailingYStore(MemoryYStore):
+    """MemoryYStore failing its first writes, and recording the flushes of its batches."""
+
+    def __init__(self, failures: int):
+        """Initialize a store failing the given number of writes."""
+        super().__init__()
+        self.failures = failures
+        self.fsyncs = []
+
+    async def write_batch(self, updates, fsync=False):
+        """Record a batch of updates, unless the write has to fail."""
+        if self.failures:
+            self.failures -= 1
+            raise OSError("Disk full")
+        self.updates.extend(updates)
+        if fsync:
+            self.fsyncs.append(anyio.current_time())
+
+
+class RecordingClient:
+    """Client channel recording the messages sent to it."""
+
+    path = "recording-client"
+
+    def __init__(self):
+        """Initialize a client without messages."""
+        self.messages = []
+
+    async def send(self, message: bytes) -> None:
+        """Record a sent message."""
+        self.messages.append(message)
+
+
+def run_burst(coalesce_window: float, updates: int = 100):
+    """Apply a burst of updates to a room, returning the store, the client and the room's document."""
+    ystore = MemoryYStore()
+    client = RecordingClient()
+
+    async def run():
+        room = ServerRoom(ready=True, ystore=ystore, log=logger, coalesce_window=coalesce_window)
+        async with room:
+            room.clients.add(client)
+            await anyio.sleep(0.01)  # Let the room start observing its document
+            files_map = room.ydoc.get("files", type=Map)
+            for i in range(updates):
+                files_map[str(i)] = Map({"id": str(i), "name": f"{i}.pdf"})
+            await anyio.sleep(coalesce_window + 0.1)
+        return room.ydoc
+
+    return ystore, client, anyio.run(run)
+
+
+class TestServerRoom:
+    """Tests for the update coalescing of the sync rooms."""
+
+    def test_burst_is_coalesced(self):
+        """Test that a burst of updates is broadcast and stored as a few merged updates."""
+        ystore, client, doc = run_burst(coalesce_window=0.05)
+
+        assert 1 <= len(ystore.updates) <= 10
+        assert len(client.messages) == len(ystore.updates)
+
+        replica = Doc()
+        for update in ystore.updates:
+            replica.apply_update(update)
+        assert replica.get("files", type=Map).to_py() == doc.get("files", type=Map).to_py()
+
+    def test_coalescing_disabled(self):
+        """Test that every update is broadcast and stored on its own without a coalescing window."""
+        ystore, client, _ = run_burst(coalesce_window=0)
+
+        assert len(ystore.updates) == len(client.messages) == 100
+
+
+def make_updates(count: int):
+    """Create a document and the updates adding `count` entries to it one by one."""
+    doc = Doc()
+    files_map = doc.get("files", type=Map)
+    updates = []
+    doc.observe(lambda event: updates.append(event.update))
+    for i in range(count):
+        files_map[str(i)] = Map({"id": str(i), "name": f"{i}.pdf"})
+    return doc, updates
+
+
+async def read_store(store) -> Doc:
+    """Apply the updates of a YStore to a new document."""
+    doc = Doc()
+    async for update, _, _ in store.read():
+        doc.apply_update(update)
+    return doc
+
+
+class TestStoreWriter:
+    """Tests for the batching of the updates written to the room stores."""
+
+    def test_batch_roundtrip(self, tmp_path):
+        """Test that a batch of updates is stored in the format read by FileYStore."""
+        doc, updates = make_updates(20)
+        path = str(tmp_path / "room_store.bin")
+
+        async def run():
+            await BatchFileYStore(path).write_batch(updates[:10], fsync=True)
+            await BatchFileYStore(path).write_batch(updates[10:])
+            return await read_store(FileYStore(path))
+
+        replica = anyio.run(run)
+
+        assert replica.get("files", type=Map).to_py() == doc.get("files", type=Map).to_py()
+
+    def test_file_squash(self, tmp_path):
+        """Test that the history of a store file is squashed into a single record, which can be appended to."""
+        doc, updates = make_updates(30)
+        store = BatchFileYStore(str(tmp_path / "room_store.bin"))
+
+        async def run():
+            await store.write_batch(updates[:10])
+            await store.write_batch(updates[10:20])
+            sizes = await store.squash()
+            await store.write_batch(updates[20:])
+            records = [record async for record in store.read()]
+            return sizes, records
+
+        (before, after), records = anyio.run(run)
+
+        assert after < before
+        assert len(records) == 11
+        replica = Doc()
+        for update, _, _ in records:
+            replica.apply_update(update)
+        assert replica.get("files", type=Map).to_py() == doc.get("files", type=Map).to_py()
+
+    def test_updates_are_group_committed(self, tmp_path, monkeypatch):
+        """Test that updates queued together are written in a few batches, and flushed per batch."""
+        fsyncs = []
+        monkeypatch.setattr(ystore_module.os, "fsync", lambda fd: fsyncs.append(fd))
+        doc, updates = make_updates(100)
+        store = BatchFileYStore(str(tmp_path / "room_store.bin"))
+        writer = StoreWriter(store, max_batch_size=64, max_batch_delay=0.05, fsync=FSYNC_ALWAYS)
+
+        async def run():
+            async with anyio.create_task_group() as tg:
+                await tg.start(writer.run)
+                for update in updates:
+                    await writer.write(update)
+                await writer.aclose()
+            return await read_store(store)
+
+        replica = anyio.run(run)
+
+        assert writer.updates == 100
+        assert 2 <= writer.batches <= 10
+        assert len(fsyncs) == writer.batches
+        assert replica.get("files", type=Map).to_py() == doc.get("files", type=Map).to_py()
+
+    def test_bounded_queue(self):
+        """Test that writing waits once the queue is full, and that closing drains the queue."""
+        store = MemoryYStore()
+        writer = StoreWriter(store, max_queue_size=2, fsync=FSYNC_NEVER)
+
+        async def run():
+            await writer.write(b"first")
+            await writer.write(b"second")
+            with anyio.move_on_after(0.05) as scope:
+                await writer.write(b"third")
+            await writer.aclose()
+            return scope.cancelled_caught
+
+        assert anyio.run(run)
+        assert store.updates == [b"first", b"second"]
+
+    def test_failed_batch_is_retried(self):
+        """Test that a batch which cannot be written is retried instead of being dropped."""
+        store = FailingYStore(failures=2)
+        writer = StoreWriter(store, max_batch_delay=0.01, fsync=FSYNC_NEVER, retry_delay=0.01)
+
+        async def run():
+            async with anyio.create_task_group() as tg:
+                await tg.start(writer.run)
+                await writer.write(b"first")
+                await anyio.sleep(0.1)
+                await writer.write(b"second")
+                await writer.aclose()
+
+        anyio.run(run)
+
+        assert store.updates == [b"first", b"second"]
+        assert writer.updates == writer.history_updates == 2
+
+    def test_failed_batch_dropped_on_close(self):
+        """Test that closing the writer does not wait forever for a store which keeps failing."""
+        store = FailingYStore(failures=100)
+        writer = StoreWriter(store, fsync=FSYNC_NEVER, retry_delay=0.01, close_retries=2)
+
+        async def run():
+            await writer.write(b"first")
+            with anyio.fail_after(1):
+                await writer.aclose()
+
+        anyio.run(run)
+
+        assert store.updates == [] and writer.updates == 0
+
+    def test_interval_flush_when_idle(self):
+        """Test that the last batch is flushed after the fsync interval, even if no other batch follows."""
+        store = FailingYStore(failures=0)
+        writer = StoreWriter(store, max_batch_delay=0.01, fsync=FSYNC_INTERVAL, fsync_interval=0.1)
+
+        async def run():
+            async with anyio.create_task_group() as tg:
+                await tg.start(writer.run)
+                await writer.write(b"first")
+                await anyio.sleep(0.05)
+                await writer.write(b"second")
+                await anyio.sleep(0.05)
+                flushes = len(store.fsyncs)
+                await anyio.sleep(0.15)
+                idle_flushes = len(store.fsyncs)
+                tg.cancel_scope.cancel()
+            return flushes, idle_flushes
+
+        # The writer has been created long enough before it runs for the first batch to be flushed
+        writer._last_fsync -= 1
+        flushes, idle_flushes = anyio.run(run)
+
+        assert (flushes, idle_flushes) == (1, 2)
+        assert store.updates == [b"first", b"second"]
+
+    def test_unknown_fsync_policy(self):
+        """Test that an unknown fsync policy is rejected."""
+        with pytest.raises(ValueError):
+            StoreWriter(MemoryYStore(), fsync="sometimes")
+
+    def test_room_hands_updates_to_writer(self):
+        """Test that a room with a store writer stores its updates through it."""
+        store = MemoryYStore()
+        writer = StoreWriter(store, fsync=FSYNC_NEVER)
+
+        async def run():
+            room = ServerRoom(ready=True, ystore=store, log=logger, store_writer=writer)
+            async with anyio.create_task_group() as tg:
+                await tg.start(writer.run)
+                async with room:
+                    await anyio.sleep(0.01)  # Let the room start observing its document
+                    files_map = room.ydoc.get("files", type=Map)
+                    for i in range(10):
+                        files_map[str(i)] = Map({"id": str(i)})
+                    await anyio.sleep(0.1)
+                await writer.aclose()
+
+        anyio.run(run)
+
+        assert writer.updates == len(store.updates) == 10
+        assert writer.batches < 10
+
+
+class TestBatchSQLiteYStore:
+    """Tests for the SQLite backend of the room stores."""
+
+    def test_batches_and_squash(self, tmp_path):
+        """Test that batches of several rooms are stored in one database, and squashed in place."""
+        doc, updates = make_updates(30)
+        other_doc, other_updates = make_updates(5)
+        db_path = str(tmp_path / "rooms.db")
+
+        async def run():
+            store = BatchSQLiteYStore("room", db_path=db_path)
+            other_store = BatchSQLiteYStore("other", db_path=db_path)
+            async with anyio.create_task_group() as tg:
+                await tg.start(store.start)
+                await tg.start(other_store.start)
+                await store.write_batch(updates[:20], fsync=True)
+                await other_store.write_batch(other_updates)
+                await store.write_batch(updates[20:])
+
+                sizes = await store.squash()
+                squashed = await read_store(store)
+                await store.stop()
+                await other_store.stop()
+            return sizes, squashed
+
+        (before, after), replica = anyio.run(run)
+
+        assert before == sum(len(update) for update in updates)
+        assert after < before
+        assert replica.get("files", type=Map).to_py() == doc.get("files", type=Map).to_py()
+
+        with sqlite3.connect(db_path) as db:
+            assert db.execute("PRAGMA journal_mode").fetchone() == ("wal",)
+            counts = dict(db.execute("SELECT path, COUNT(*) FROM yupdates GROUP BY path"))
+        assert counts == {"room": 1, "other": 5}
+
+
+class TestSyncServer:
+    """Tests for the persistence of the rooms of the sync server."""
+
+    @pytest.mark.parametrize("backend", ["file", "sqlite"])
+    def test_room_reload_and_squash(self, tmp_path, monkeypatch, backend):
+        """Test that a room is loaded from its store, and that its store can be squashed."""
+        monkeypatch.setitem(server_config, "store_backend", backend)
+        monkeypatch.setitem(server_config, "store_squash_check_interval", 3600)
+        store_directory = str(tmp_path / "sync_stores")
+
+        async def fill_room():
+            async with SyncServer(store_directory=store_directory, log=logger) as server:
+                room = await server.get_room("room")
+                await anyio.sleep(0.01)  # Let the room start observing its document
+                files_map = room.ydoc.get("files", type=Map)
+                for i in range(20):
+                    files_map[str(i)] = Map({"id": str(i)})
+                    await anyio.sleep(0.02)  # Updates stored on their own
+                await anyio.sleep(0.1)
+                return files_map.to_py()
+
+        async def reload_room():
+            async with SyncServer(store_directory=store_directory, log=logger) as server:
+                room = await server.get_room("room")
+                history = server._store_writers["room"].history_updates
+                sizes = await server.squash_room("room")
+                return room.ydoc.get("files", type=Map).to_py(), history, sizes
+
+        files = anyio.run(fill_room)
+        reloaded, history, (before, after) = anyio.run(reload_room)
+
+        assert reloaded == files
+        assert history > 1
+        assert after < before
+        assert anyio.run(reload_room)[:2] == (files, 1)
+
+    def test_evict_and_reload(self, tmp_path):
+        """Test that a room without clients is evicted with its store, and loaded again from it."""
+        store_directory = str(tmp_path / "sync_stores")
+
+        async def run():
+            async with SyncServer(store_directory=store_directory, log=logger) as server:
+                room = await server.get_room("room")
+                await anyio.sleep(0.01)  # Let the room start observing its document
+                room.ydoc.get("files", type=Map)["a"] = Map({"id": "a"})
+                await anyio.sleep(0.1)
+
+                room.clients.add(RecordingClient())
+                assert not await server.evict_room("room")
+                room.clients.clear()
+                assert await server.evict_room("room")
+                evicted = ("room" in server.rooms, "room" in server._ystores, "room" in server._store_writers)
+
+                reloaded = await server.get_room("room")
+                return evicted, reloaded is room, reloaded.ydoc.get("files", type=Map).to_py()
+
+        evicted, same_room, files = anyio.run(run)
+
+        assert evicted == (False, False, False)
+        assert not same_room
+        assert files == {"a": {"id": "a"}}
+
+    def test_reopened_while_evicted(self, tmp_path):
+        """Test that a room opened while it is being evicted is loaded once, whoever opens it next."""
+        store_directory = str(tmp_path / "sync_stores")
+
+        async def run():
+            async with SyncServer(store_directory=store_directory, log=logger) as server:
+                await server.get_room("room")
+                opened = []
+                evicted = anyio.Event()
+
+                async def open_room():
+                    opened.append(await server.get_room("room"))
+
+                async def evict_room():
+                    assert await server.evict_room("room")
+                    evicted.set()
+
+                async with anyio.create_task_group() as tg:
+                    tg.start_soon(evict_room)
+                    await anyio.sleep(0)  # Let the eviction take the lock of the room
+                    tg.start_soon(open_room)  # Waits for the eviction
+                    await evicted.wait()
+                    tg.start_soon(open_room)
+                return opened, server.rooms["room"]
+
+        opened, room = anyio.run(run)
+
+        assert opened == [room, room]
+
+    @pytest.mark.parametrize(("idle_timeout", "memory_budget"), [(0.1, 0), (0, 1)])
+    def test_background_eviction(self, tmp_path, monkeypatch, idle_timeout, memory_budget):
+        """Test that idle rooms, or rooms over the memory budget, are evicted unless they have clients."""
+        monkeypatch.setitem(server_config, "room_eviction_check_interval", 0.05)
+        monkeypatch.setitem(server_config, "room_idle_timeout", idle_timeout)
+        monkeypatch.setitem(server_config, "room_memory_budget", memory_budget)
+        store_directory = str(tmp_path / "sync_stores")
+
+        async def run():
+            async with SyncServer(store_directory=store_directory, log=logger) as server:
+                for name in ("a", "b", "c"):
+                    room = await server.get_room(name)
+                    await anyio.sleep(0.01)  # Let the room start observing its document
+                    room.ydoc.get("files", type=Map)[name] = Map({"id": name})
+                room.clients.add(RecordingClient())
+                await anyio.sleep(0.5)
+                return set(server.rooms)
+
+        assert anyio.run(run) == {"c"}
+
+
+class TestSyncServerApp:
+    """Tests for the blob store served over HTTP."""
+
+    @pytest.fixture
+    def app(self, tmp_path):
+        """Create the ASGI application of a sync server storing its blobs in a temporary directory."""
+        return SyncServerApp(SyncServer(store_directory=str(tmp_path / "sync_stores"), log=logger))
+
+    def request(self, app, method: str, path: str, content: bytes = None) -> httpx.Response:
+        """Send a single HTTP request to the application."""
+
+        async def send():
+            transport = httpx.ASGITransport(app=app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://server") as client:
+                return await client.request(method, path, content=content)
+
+        return anyio.run(send)
+
+    def test_blob_roundtrip(self, app, tmp_path):
+        """Test that an uploaded blob can be checked for and downloaded."""
+        payload = BlobStore(tmp_path / "client").codec.compress(b"content" * 1000)
+        blob_hash = hashlib.sha256(b"content" * 1000).hexdigest()
+
+        assert self.request(app, "HEAD", f"/blobs/{blob_hash}").status_code == 404
+        assert self.request(app, "PUT", f"/blobs/{blob_hash}", payload).status_code == 201
+
+        head = self.request(app, "HEAD", f"/blobs/{blob_hash}")
+        assert head.status_code == 200 and int(head.headers["content-length"]) == len(payload)
+        assert self.request(app, "GET", f"/blobs/{blob_hash}").content == payload
+        assert self.request(app, "GET", "/blobs/not-a-hash").status_code == 404
+        assert self.request(app, "DELETE", f"/blobs/{blob_hash}").status_code == 405
+
+    def test_rejected_uploads(self, app, tmp_path, monkeypatch):
+        """Test that payloads not matching their hash, or over the size limit, are not stored."""
+        payload = BlobStore(tmp_path / "client").codec.compress(b"content")
+        other_hash = hashlib.sha256(b"other").hexdigest()
+        assert self.request(app, "PUT", f"/blobs/{other_hash}", payload).status_code == 400
+
+        monkeypatch.setattr(server_module, "MAX_BLOB_SIZE", 1024)
+        large = os.urandom(2048)
+        large_hash = hashlib.sha256(large).hexdigest()
+        assert self.request(app, "PUT", f"/blobs/{large_hash}", large).status_code == 413
+
+        assert self.request(app, "HEAD", f"/blobs/{other_hash}").status_code == 404
+        assert self.request(app, "HEAD", f"/blobs/{large_hash}").status_code == 404
+
+    def test_transfer_client(self, app, tmp_path, monkeypatch):
+        """Test that a file's chunks are uploaded and downloaded concurrently, skipping the ones already there."""
+        transport = httpx.ASGITransport(app=app)
+        client = functools.partial(httpx.AsyncClient, transport=transport)
+        monkeypatch.setattr(blobs_module.httpx, "AsyncClient", client)
+        source = tmp_path / "source.bin"
+        source.write_bytes(os.urandom(20 * 65536))
+        sender = BlobTransferClient(BlobStore(tmp_path / "sender"), "server", 0, max_concurrency=4)
+        receiver = BlobTransferClient(BlobStore(tmp_path / "receiver"), "server", 0, max_concurrency=4)
+        manifest = sender.blob_store.add_file(source)
+
+        assert anyio.run(sender.upload, manifest) == 20
+        assert anyio.run(sender.upload, manifest) == 0
+        assert anyio.run(receiver.fetch_missing, manifest) == 20
+        assert receiver.blob_store.write_file(manifest, tmp_path / "copy.bin")
+        assert (tmp_path / "copy.bin").read_bytes() == source.read_bytes()
@@ -1,5 +1,6 @@
 """Unit tests for sign.py."""
 
+import hashlib
 import os
 import tempfile
 from pathlib import Path
@@ -12,11 +13,14 @@ from cryptography.hazmat.primitives.asymmetric.ed25519 import (
 
 from crdtsign.sign import (
     is_verified_signature,
+    iter_file_chunks,
     load_keypair,
     load_public_key,
     new_keypair,
     sign,
+    sign_stream,
 )
+from crdtsign.utils.file_utils import decompress_chunk, serialize_file
 
 
 @pytest.fixture
@@ -138,3 +142,32 @@ class TestSigningAndVerification:
         # Verification should fail
         result = is_verified_signature(temp_file, signature, public_key)
         assert result is False
+
+
+class TestStreamingSign:
+    """Tests for the single-pass hash-and-sign pipeline."""
+
+    def test_sign_stream_matches_sign(self, temp_file):
+        """Test that streaming produces the same hash and a valid signature."""
+        private_key, public_key = new_keypair(persist=False)
+        with open(temp_file, "rb") as f:
+            file_hash, signature, _ = sign_stream(iter_file_chunks(f, 4), private_key)
+
+        content = temp_file.read_bytes()
+        assert file_hash == hashlib.sha256(content).hexdigest()
+        assert signature == sign(temp_file, private_key)
+        assert is_verified_signature(bytes.fromhex(file_hash), signature, public_key)
+
+    def test_sign_stream_serialization(self, temp_file, tmp_path):
+        """Test that streamed chunks match `serialize_file()` regardless of input chunking."""
+        private_key, _ = new_keypair(persist=False)
+        content = os.urandom(3 * 1024 + 17)
+        temp_file.write_bytes(content)
+        copy_path = tmp_path / "copy.bin"
+
+        with open(temp_file, "rb") as f:
+            _, _, serialized = sign_stream(iter_file_chunks(f, 1000), private_key, to_file=copy_path, chunk_size=1024)
+
+        assert serialized == serialize_file(temp_file, chunk_size=1024)
+        assert b"".join(decompress_chunk(c) for c in serialized) == content
+        assert copy_path.read_bytes() == content
@@ -0,0 +1,254 @@
+"""Unit tests for storage.py."""
+
+import asyncio
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+
+import pytest
+from pycrdt import Map
+
+from crdtsign.storage import FileSignatureStorage
+from crdtsign.utils.file_utils import CONTENT_FORMAT_BINARY, serialize_file
+
+LEGACY_ENTRY = {
+    "id": "a",
+    "name": "a.pdf",
+    "hash": "00" * 32,
+    "signature": "00" * 64,
+    "user_id": "user_a",
+    "username": "user_a",
+    "signed_on": "2025-01-01T00:00:00+00:00",
+    "file_content": ["ab" * 65536] * 16,
+}
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    """Create a file signature storage persisting to a temporary directory."""
+    monkeypatch.chdir(tmp_path)
+    return FileSignatureStorage("client", "localhost", 0)
+
+
+class TestNestedEntries:
+    """Tests for signature entries stored as nested maps."""
+
+    def test_migrate_legacy_entries(self, storage):
+        """Test that entries stored as plain dictionaries are converted to nested maps."""
+        storage.files_map["a"] = dict(LEGACY_ENTRY)
+
+        assert storage.migrate_legacy_entries() == 1
+        assert isinstance(storage.files_map["a"], Map)
+        assert storage.get_signature("a", include_content=True) == LEGACY_ENTRY
+        assert storage.migrate_legacy_entries() == 0
+
+    def test_field_level_update(self, storage):
+        """Test that changing a field does not re-encode the file content."""
+        storage.files_map["a"] = Map(dict(LEGACY_ENTRY))
+        updates = []
+        storage.doc.observe(lambda event: updates.append(event.update))
+
+        storage.apply_signature_changes(
+            {"a": {"flag_data_retention": True, "data_retention_new_exp_date": "2025-01-05"}}
+        )
+        storage.apply_signature_changes({"a": {"flag_data_retention": None}})
+
+        assert len(updates) == 2
+        assert all(len(update) < 256 for update in updates)
+        entry = storage.get_signature("a")
+        assert "flag_data_retention" not in entry
+        assert entry["data_retention_new_exp_date"] == "2025-01-05"
+
+
+class TestBatchSigning:
+    """Tests for the bulk insertion of file signatures."""
+
+    def test_single_transaction_and_write(self, storage):
+        """Test that a batch results in one update and one write of the persisted state."""
+        updates = []
+        storage.doc.observe(lambda event: updates.append(event.update))
+        signatures = [
+            {
+                "file_name": f"{i}.pdf",
+                "file_hash": f"{i:064x}",
+                "signature": "00" * 64,
+                "username": "user_a",
+                "user_id": "user_a",
+                "signed_on": datetime.now().astimezone(),
+                "serialized_file": [f"{i:064x}"],
+            }
+            for i in range(50)
+        ]
+
+        file_ids = asyncio.run(storage.add_file_signatures(signatures, persist=True))
+
+        assert len(updates) == 1
+        assert storage.save_scheduler.flushed_writes == 1
+        assert [storage.get_signature(file_id)["name"] for file_id in file_ids] == [f"{i}.pdf" for i in range(50)]
+
+
+class TestChunkUploads:
+    """Tests for the upload of the chunks of signed files to the sync server."""
+
+    @pytest.fixture
+    def uploads(self, storage, monkeypatch):
+        """Record the chunks uploaded by the storage, along with the signatures present at upload time."""
+        uploads = []
+
+        async def upload(manifest):
+            uploads.append((sorted(manifest), list(storage.files_map.keys())))
+            return len(manifest)
+
+        monkeypatch.setattr(storage._blob_client, "upload", upload)
+        return uploads
+
+    def sign(self, storage, content: bytes) -> str:
+        """Sign a file with the given content, returning the hash of its single chunk."""
+        chunk_hash = storage.serialize_chunk(content)
+        signature = {
+            "file_name": "a.pdf",
+            "file_hash": hashlib.sha256(content).hexdigest(),
+            "signature": "00" * 64,
+            "username": "user_a",
+            "user_id": "user_a",
+            "signed_on": datetime.now().astimezone(),
+            "serialized_file": [chunk_hash],
+        }
+        asyncio.run(storage.add_file_signatures([signature]))
+        return chunk_hash
+
+    def test_uploaded_before_broadcast(self, storage, uploads):
+        """Test that the chunks are uploaded before the signature is added to the map."""
+        storage._connected = True
+
+        chunk_hash = self.sign(storage, b"content")
+
+        assert uploads == [([chunk_hash], [])]
+        assert storage._pending_uploads == set()
+
+    def test_uploaded_on_reconnect(self, storage, uploads):
+        """Test that the chunks of files signed while disconnected are uploaded once connected."""
+        chunk_hash = self.sign(storage, b"content")
+        assert uploads == [] and storage._pending_uploads == {chunk_hash}
+
+        storage._connected = True
+        assert asyncio.run(storage.upload_pending_chunks())
+        assert [manifest for manifest, _ in uploads] == [[chunk_hash]]
+        assert storage._pending_uploads == set()
+
+    def test_pending_after_restart(self, storage, uploads, monkeypatch):
+        """Test that the chunks which were not uploaded before a restart are still pending."""
+        chunk_hash = self.sign(storage, b"content")
+
+        restarted = FileSignatureStorage("client", "localhost", 0)
+        monkeypatch.setattr(restarted._blob_client, "upload", storage._blob_client.upload)
+        assert restarted._pending_uploads == {chunk_hash}
+
+        restarted._connected = True
+        assert asyncio.run(restarted.upload_pending_chunks())
+        assert [manifest for manifest, _ in uploads] == [[chunk_hash]]
+        assert FileSignatureStorage("client", "localhost", 0)._pending_uploads == set()
+
+    def test_signing_skips_backlog(self, storage, uploads):
+        """Test that signing a file only uploads its own chunks, leaving the backlog to the background task."""
+        backlog = self.sign(storage, b"backlog")
+        storage._connected = True
+
+        chunk_hash = self.sign(storage, b"content")
+
+        assert [manifest for manifest, _ in uploads] == [[chunk_hash]]
+        assert storage._pending_uploads == {backlog}
+
+
+class TestEmbeddedContent:
+    """Tests for files embedded in the CRDT document."""
+
+    def test_materialize_current_and_legacy_layouts(self, storage, monkeypatch):
+        """Test that embedded files are restored whether or not their layout is recorded."""
+        monkeypatch.setattr(storage, "file_transfer", "embedded")
+        content = os.urandom(200_000)
+        source = Path("source.bin")
+        source.write_bytes(content)
+        file_hash = hashlib.sha256(content).hexdigest()
+
+        asyncio.run(
+            storage.add_file_signature(
+                "binary.bin",
+                file_hash,
+                "00",
+                "user_a",
+                "user_a",
+                datetime.now().astimezone(),
+                serialized_file_path=source,
+            )
+        )
+        legacy = dict(LEGACY_ENTRY, id="legacy", name="legacy.bin", hash=file_hash, file_content=serialize_file(source))
+        storage.files_map["legacy"] = Map(legacy)
+
+        asyncio.run(storage.handle_files_deserialization())
+
+        entry = next(sig for sig in storage.get_signatures() if sig["name"] == "binary.bin")
+        assert entry["content_format"] == CONTENT_FORMAT_BINARY
+        assert isinstance(entry["file_content"][0], (bytes, bytearray))
+        for name in ("binary.bin", "legacy.bin"):
+            assert (Path(".storage/uploads/user_a") / name).read_bytes() == content
+
+
+class TestSignaturesListing:
+    """Tests for the cached serialization of the signature list."""
+
+    def test_cached_until_changed(self, storage):
+        """Test that the listing is reused until the map or one of its entries changes."""
+        storage.files_map["a"] = Map(dict(LEGACY_ENTRY))
+
+        etag, body = storage.get_signatures_listing()
+        assert storage.get_signatures_listing()[1] is body
+        assert [sig["name"] for sig in json.loads(body)["signatures"]] == ["a.pdf"]
+        assert "file_content" not in body.decode()
+
+        storage.apply_signature_changes({"a": {"name": "renamed.pdf"}})
+        new_etag, new_body = storage.get_signatures_listing()
+        assert new_etag != etag
+        assert json.loads(new_body)["signatures"][0]["name"] == "renamed.pdf"
+
+    def test_etag_follows_document_state(self, storage):
+        """Test that documents with the same content have the same ETag."""
+        other = FileSignatureStorage("other", "localhost", 0)
+        storage.files_map["a"] = Map(dict(LEGACY_ENTRY))
+        other.doc.apply_update(storage.doc.get_update())
+
+        assert other.get_signatures_listing()[0] == storage.get_signatures_listing()[0]
+
+
+class TestSignatureChanges:
+    """Tests for the deltas of the signature list."""
+
+    def test_deltas(self, storage):
+        """Test that clients get the full list first, then only what changed."""
+        storage.files_map["a"] = Map(dict(LEGACY_ENTRY))
+        storage.files_map["b"] = Map(dict(LEGACY_ENTRY, id="b", name="b.pdf"))
+
+        full = storage.get_signature_changes()
+        assert full["reset"] and [sig["id"] for sig in full["changed"]] == ["a", "b"]
+        assert "file_content" not in full["changed"][0]
+
+        storage.apply_signature_changes({"a": {"name": "renamed.pdf"}})
+        storage.files_map["c"] = Map(dict(LEGACY_ENTRY, id="c"))
+        asyncio.run(storage.remove_file_signature("b"))
+
+        delta = storage.get_signature_changes(full["token"])
+        assert not delta["reset"]
+        assert [sig["name"] for sig in delta["changed"]] == ["renamed.pdf", "a.pdf"]
+        assert delta["removed"] == ["b"]
+
+        unchanged = storage.get_signature_changes(delta["token"])
+        assert unchanged == {"token": delta["token"], "reset": False, "changed": [], "removed": []}
+
+    def test_unknown_token(self, storage):
+        """Test that a token from before a restart results in the full list."""
+        storage.files_map["a"] = Map(dict(LEGACY_ENTRY))
+
+        changes = storage.get_signature_changes("0123abcd:42")
+        assert changes["reset"] and len(changes["changed"]) == 1
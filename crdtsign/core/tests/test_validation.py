@@ -0,0 +1,137 @@
+"""Unit tests for validation.py."""
+
+import asyncio
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pycrdt import Doc, Map
+
+from crdtsign.sign import new_keypair
+from crdtsign.utils.executor import shutdown_executors
+from crdtsign.validation import VerificationCache, validate_signatures
+
+
+@pytest.fixture
+def signed_entries(tmp_path, monkeypatch):
+    """Create valid, tampered, expired and orphaned signature entries."""
+    monkeypatch.chdir(tmp_path)
+    private_key, public_key = new_keypair()
+    public_keys = {"user_a": public_key.public_bytes_raw().hex()}
+
+    entries = []
+    for i in range(10):
+        digest = hashlib.sha256(str(i).encode()).digest()
+        entries.append(
+            {
+                "id": f"valid_{i}",
+                "name": f"{i}.pdf",
+                "hash": digest.hex(),
+                "signature": private_key.sign(digest).hex(),
+                "user_id": "user_a",
+            }
+        )
+    entries.append(dict(entries[0], id="tampered", hash="00" * 32))
+    entries.append(dict(entries[1], id="expired", expiration_date="2000-01-01T00:00:00+00:00"))
+    entries.append(dict(entries[2], id="orphaned", user_id="unknown"))
+    return entries, public_keys.get
+
+
+def collect(entries, get_public_key, **kwargs):
+    """Run the validation and return the results keyed by file ID."""
+
+    async def run():
+        return [result async for result in validate_signatures(entries, get_public_key, **kwargs)]
+
+    return {result["id"]: result for result in asyncio.run(run())}
+
+
+class TestBatchValidation:
+    """Tests for the validation of many signatures at once."""
+
+    def test_results(self, signed_entries):
+        """Test the outcome reported for each kind of signature."""
+        entries, get_public_key = signed_entries
+        with ThreadPoolExecutor(2) as executor:
+            results = collect(entries, get_public_key, executor=executor, batch_size=3)
+
+        assert len(results) == len(entries)
+        assert all(results[f"valid_{i}"]["is_valid"] for i in range(10))
+        assert not results["tampered"]["is_valid"]
+        assert results["expired"]["is_expired"] and not results["expired"]["is_valid"]
+        assert results["orphaned"]["error"] == "Public key not found"
+
+    def test_process_pool(self, signed_entries):
+        """Test that verification batches can run in worker processes."""
+        entries, get_public_key = signed_entries
+        try:
+            results = collect(entries, get_public_key, batch_size=4)
+        finally:
+            shutdown_executors()
+
+        assert sum(result["is_valid"] for result in results.values()) == 10
+
+
+class TestVerificationCache:
+    """Tests for the cache of public keys and verification outcomes."""
+
+    @pytest.fixture
+    def observed_cache(self, signed_entries):
+        """Create `files` and `users` maps observed by a verification cache."""
+        entries, get_public_key = signed_entries
+        doc = Doc()
+        files_map = doc.get("files", type=Map)
+        users_map = doc.get("users", type=Map)
+        users_map["user_a"] = {"public_key": get_public_key("user_a")}
+        lookups = []
+
+        def lookup(user_id):
+            lookups.append(user_id)
+            user = users_map.get(user_id)
+            return user["public_key"] if user else None
+
+        cache = VerificationCache(lookup)
+        files_map.observe_deep(cache.on_files_change)
+        users_map.observe(cache.on_users_change)
+        for entry in entries:
+            files_map[entry["id"]] = Map(entry)
+        return entries, files_map, users_map, cache, lookups
+
+    def test_hits(self, observed_cache):
+        """Test that repeated validations reuse the parsed key and the outcome."""
+        entries, _, _, cache, lookups = observed_cache
+
+        assert cache.verify(entries[0]) is True
+        assert cache.verify(entries[0]) is True
+        assert cache.verify(entries[1]) is True
+
+        assert lookups == ["user_a"]
+        assert cache.results.stats == {"size": 2, "hits": 1, "misses": 2}
+        assert cache.verify(dict(entries[0], user_id="unknown")) is None
+
+    def test_invalidation(self, observed_cache):
+        """Test that outcomes and keys are dropped when the entries or users change."""
+        entries, files_map, users_map, cache, lookups = observed_cache
+        cache.verify(entries[0])
+        cache.verify(entries[1])
+
+        files_map["valid_0"]["signature"] = "00" * 64
+        del files_map["valid_1"]
+        assert len(cache.results) == 0
+
+        users_map["user_a"] = {"public_key": users_map["user_a"]["public_key"]}
+        cache.verify(entries[2])
+        assert lookups == ["user_a", "user_a"]
+
+    def test_batch_uses_cache(self, observed_cache):
+        """Test that the batch validation reuses and fills the outcome cache."""
+        entries, _, _, cache, _ = observed_cache
+        get_public_key = cache._get_public_key
+        cache.verify(entries[0])
+
+        with ThreadPoolExecutor(2) as executor:
+            results = collect(entries, get_public_key, executor=executor, cache=cache)
+
+        assert results["valid_0"]["is_valid"]
+        assert cache.results.hits == 1
+        assert len(cache.results) == 11  # Distinct (hash, signature, key) triplets, without the orphaned signature
@@ -27,25 +27,48 @@ class FileSignatureCardContainer(ft.Column):
         # Initially show placeholder since no cards
         self.placeholder.visible = True
 
+        # Cards by file ID, and token of the signature changes already displayed
+        self.cards_by_id = {}
+        self.changes_token = None
+
     def add_card(self, new_file_signature: FileSignature, update_page=True):
         new_card = FileSignatureCard(new_file_signature, self.card_delete)
-        self.cards.controls.append(new_card.card)
+        existing = self.cards_by_id.get(new_file_signature.file_id)
+        if existing is not None:
+            # Replace the card of a changed signature in place
+            index = self.cards.controls.index(existing.card)
+            self.cards.controls[index] = new_card.card
+        else:
+            self.cards.controls.append(new_card.card)
+        self.cards_by_id[new_file_signature.file_id] = new_card
         # Update placeholder visibility based on current cards count
         self.placeholder.visible = len(self.cards.controls) == 0
         if update_page:
             self.page.update()
 
     def card_delete(self, card_instance):
-        self.cards.controls.remove(card_instance.card)
+        self.cards_by_id.pop(card_instance.file_id, None)
+        if card_instance.card in self.cards.controls:
+            self.cards.controls.remove(card_instance.card)
         # Update placeholder visibility based on current cards count
         self.placeholder.visible = len(self.cards.controls) == 0
         self.page.update()
 
     def update_container(self):
         time.sleep(0.1)
-        signatures = file_storage.get_signatures()
-        self.cards.controls = []
-        for signature in signatures:
+        # Only rebuild the cards of the signatures changed since the last update
+        changes = file_storage.get_signature_changes(self.changes_token)
+        self.changes_token = changes["token"]
+        if changes["reset"]:
+            self.cards.controls = []
+            self.cards_by_id = {}
+
+        for file_id in changes["removed"]:
+            card = self.cards_by_id.pop(file_id, None)
+            if card is not None and card.card in self.cards.controls:
+                self.cards.controls.remove(card.card)
+
+        for signature in changes["changed"]:
             file_signature = FileSignature(
                 file_id=signature["id"],
                 file_name=signature["name"],